@@ -17,6 +17,13 @@ def parse():
                         help='name of corpus')
     parser.add_argument('--n_gpus', type=int, default=1,
                         help='number of GPUs (0 indicates CPU)')
+    parser.add_argument('--distributed', type=strtobool, default=False,
+                        help='train with DistributedDataParallel (torch>=1.1), '
+                        'one process per GPU launched by torch.distributed.launch')
+    parser.add_argument('--dist_backend', type=str, default='nccl', choices=['nccl', 'gloo'],
+                        help='backend of torch.distributed (gloo for CPU)')
+    parser.add_argument('--local_rank', type=int, default=0,
+                        help='index of the GPU in this node (set by torch.distributed.launch)')
     parser.add_argument('--model', type=str, default=False,
                         help='directory to save a model')
     parser.add_argument('--resume', type=str, default=False, nargs='?',
@@ -77,6 +84,18 @@ def parse():
                         help='minimum number of input frames')
     parser.add_argument('--dynamic_batching', type=strtobool, default=True,
                         help='')
+    parser.add_argument('--collate', type=strtobool, default=False,
+                        help='pad input features and labels into tensors in the data loader')
+    parser.add_argument('--max_n_frames_batch', type=int, default=0,
+                        help='maximum total number of input frames in a mini-batch (0 means no limit)')
+    parser.add_argument('--max_n_tokens_batch', type=int, default=0,
+                        help='maximum total number of output tokens in a mini-batch (0 means no limit)')
+    parser.add_argument('--count_padding', type=strtobool, default=True,
+                        help='include padding in max_n_frames_batch and max_n_tokens_batch')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='number of worker processes to make mini-batches')
+    parser.add_argument('--n_ques', type=int, default=0,
+                        help='number of mini-batches to prefetch with worker processes (0 means no prefetching)')
     parser.add_argument('--sequence_summary_network', type=strtobool, default=False,
                         help='Use sequence summary network')
     # topology (encoder)
@@ -120,6 +139,10 @@ def parse():
                         help='type of subsampling in the encoder')
     parser.add_argument('--freeze_encoder', type=strtobool, default=False,
                         help='freeze the encoder parameter')
+    parser.add_argument('--checkpoint_encoder_layers', type=strtobool, default=False,
+                        help='recompute activations of each encoder layer in backward to save memory. '
+                        'Running statistics of batch normalization in the encoder are updated twice per step '
+                        '(once more in recomputation)')
     # topology (decoder)
     parser.add_argument('--attn_type', type=str, default='location',
                         choices=['no', 'location', 'add', 'dot',
@@ -183,6 +206,8 @@ def parse():
                         help='')
     parser.add_argument('--print_step', type=int, default=200,
                         help='step to print log')
+    parser.add_argument('--save_step', type=int, default=0,
+                        help='step to save a checkpoint to resume in the middle of an epoch (0 means disabled)')
     parser.add_argument('--metric', type=str, default='edit_distance',
                         choices=['edit_distance', 'loss', 'acc', 'ppl', 'bleu'],
                         help='metric for evaluation during training')
@@ -220,6 +245,11 @@ def parse():
     # regularization
     parser.add_argument('--clip_grad_norm', type=float, default=5.0,
                         help='')
+    parser.add_argument('--accum_grad_n_steps', type=int, default=1,
+                        help='number of mini-batches to accumulate gradients over before each optimizer update')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of autocast in training (fp16/bf16 require torch>=1.10, and fp16 requires GPUs)')
     parser.add_argument('--dropout_in', type=float, default=0.0,
                         help='dropout probability for the input')
     parser.add_argument('--dropout_enc', type=float, default=0.0,
@@ -288,8 +318,19 @@ def parse():
     parser.add_argument('--transformer_dec_n_layers', type=int, default=6,
                         help='')
     parser.add_argument('--transformer_attn_type', type=str, default='scaled_dot_product',
-                        choices=['scaled_dot_product', 'average'],
-                        help='type of attention for transformer')
+                        choices=['scaled_dot_product', 'average', 'local'],
+                        help='type of attention for transformer. local restricts self-attention in the encoder to windows')
+    parser.add_argument('--transformer_attn_window_left', type=int, default=32,
+                        help='number of frames in the left window for local attention')
+    parser.add_argument('--transformer_attn_window_right', type=int, default=32,
+                        help='number of frames in the right window for local attention')
+    parser.add_argument('--transformer_attn_global_stride', type=int, default=0,
+                        help='interval of global frames attending to all frames for local attention (0 disables them)')
+    parser.add_argument('--transformer_attn_block_size', type=int, default=0,
+                        help='size of query/key blocks to compute full self-attention in the encoder '
+                             'with linear memory (0 disables it)')
+    parser.add_argument('--transformer_attn_recompute', type=strtobool, default=False,
+                        help='recompute self-attention weights in backward when transformer_attn_block_size > 0')
     parser.add_argument('--transformer_attn_n_heads', type=int, default=8,
                         help='number of heads in the self-attention layer')
     parser.add_argument('--pe_type', type=str, default='add',
@@ -341,6 +382,15 @@ def parse():
                         help='weight of LM score')
     parser.add_argument('--recog_ctc_weight', type=float, default=0.0,
                         help='weight of CTC score')
+    parser.add_argument('--recog_streaming_chunk_size', type=int, default=0,
+                        help='number of input frames in each chunk for streaming encoding (0 means disabled)')
+    parser.add_argument('--recog_streaming_n_left', type=int, default=0,
+                        help='number of left context frames for each chunk in streaming encoding')
+    parser.add_argument('--recog_streaming_n_lookahead', type=int, default=0,
+                        help='number of lookahead frames for each chunk in streaming encoding')
+    parser.add_argument('--recog_precision', type=str, default='fp32',
+                        choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of autocast in decoding (fp16/bf16 require torch>=1.10)')
     parser.add_argument('--recog_lm', type=str, default=None, nargs='?',
                         help='path to the RMMLM')
     parser.add_argument('--recog_lm_bwd', type=str, default=None, nargs='?',
@@ -17,6 +17,13 @@ def parse():
                         help='name of corpus')
     parser.add_argument('--n_gpus', type=int, default=1,
                         help='number of GPUs (0 indicates CPU)')
+    parser.add_argument('--distributed', type=strtobool, default=False,
+                        help='train with DistributedDataParallel (torch>=1.1), '
+                        'one process per GPU launched by torch.distributed.launch')
+    parser.add_argument('--dist_backend', type=str, default='nccl', choices=['nccl', 'gloo'],
+                        help='backend of torch.distributed (gloo for CPU)')
+    parser.add_argument('--local_rank', type=int, default=0,
+                        help='index of the GPU in this node (set by torch.distributed.launch)')
     parser.add_argument('--model', type=str, default=False,
                         help='directory to save a model')
     parser.add_argument('--resume', type=str, default=False, nargs='?',
@@ -44,6 +51,10 @@ def parse():
                         help='minimum number of input tokens')
     parser.add_argument('--dynamic_batching', type=strtobool, default=False,
                         help='')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='number of worker processes to make mini-batches')
+    parser.add_argument('--n_ques', type=int, default=0,
+                        help='number of mini-batches to prefetch with worker processes (0 means no prefetching)')
     # topology
     parser.add_argument('--lm_type', type=str, default='lstm',
                         choices=['lstm', 'gru', 'gated_conv_small',
@@ -82,6 +93,8 @@ def parse():
                         help='')
     parser.add_argument('--print_step', type=int, default=100,
                         help='step to print log')
+    parser.add_argument('--save_step', type=int, default=0,
+                        help='step to save a checkpoint to resume in the middle of an epoch (0 means disabled)')
     parser.add_argument('--decay_type', type=str, default='epoch',
                         choices=['epoch', 'metric'],
                         help='')
@@ -112,6 +125,11 @@ def parse():
     # regularization
     parser.add_argument('--clip_grad_norm', type=float, default=5.0,
                         help='')
+    parser.add_argument('--accum_grad_n_steps', type=int, default=1,
+                        help='number of mini-batches to accumulate gradients over before each optimizer update')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of autocast in training (fp16/bf16 require torch>=1.10, and fp16 requires GPUs)')
     parser.add_argument('--dropout_hidden', type=float, default=0.0,
                         help='dropout probability for the hidden layers')
     parser.add_argument('--dropout_out', type=float, default=0.0,
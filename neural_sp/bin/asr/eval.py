@@ -30,6 +30,7 @@ from neural_sp.models.lm.gated_convlm import GatedConvLM
 from neural_sp.models.lm.rnnlm import RNNLM
 from neural_sp.models.seq2seq.seq2seq import Seq2seq
 from neural_sp.models.seq2seq.skip_thought import SkipThought
+from neural_sp.models.torch_utils import autocast
 
 
 def main():
@@ -181,50 +182,52 @@ def main():
 
         start_time = time.time()
 
-        if args.recog_metric == 'edit_distance':
-            if args.recog_unit in ['word', 'word_char']:
-                wer, cer, _ = eval_word(ensemble_models, dataset, recog_params,
-                                        epoch=epoch - 1,
-                                        recog_dir=args.recog_dir,
-                                        progressbar=True)
-                wer_avg += wer
-                cer_avg += cer
-            elif args.recog_unit == 'wp':
-                wer, cer = eval_wordpiece(ensemble_models, dataset, recog_params,
-                                          epoch=epoch - 1,
-                                          recog_dir=args.recog_dir,
-                                          progressbar=True)
-                wer_avg += wer
-                cer_avg += cer
-            elif 'char' in args.recog_unit:
-                wer, cer = eval_char(ensemble_models, dataset, recog_params,
+        # NOTE: parameters are kept in fp32, and operations run in half precision if possible
+        with autocast(args.recog_precision, device_id=0):
+            if args.recog_metric == 'edit_distance':
+                if args.recog_unit in ['word', 'word_char']:
+                    wer, cer, _ = eval_word(ensemble_models, dataset, recog_params,
+                                            epoch=epoch - 1,
+                                            recog_dir=args.recog_dir,
+                                            progressbar=True)
+                    wer_avg += wer
+                    cer_avg += cer
+                elif args.recog_unit == 'wp':
+                    wer, cer = eval_wordpiece(ensemble_models, dataset, recog_params,
+                                              epoch=epoch - 1,
+                                              recog_dir=args.recog_dir,
+                                              progressbar=True)
+                    wer_avg += wer
+                    cer_avg += cer
+                elif 'char' in args.recog_unit:
+                    wer, cer = eval_char(ensemble_models, dataset, recog_params,
+                                         epoch=epoch - 1,
+                                         recog_dir=args.recog_dir,
+                                         progressbar=True,
+                                         task_idx=0)
+                    #  task_idx=1 if args.recog_unit and 'char' in args.recog_unit else 0)
+                    wer_avg += wer
+                    cer_avg += cer
+                elif 'phone' in args.recog_unit:
+                    per = eval_phone(ensemble_models, dataset, recog_params,
                                      epoch=epoch - 1,
                                      recog_dir=args.recog_dir,
-                                     progressbar=True,
-                                     task_idx=0)
-                #  task_idx=1 if args.recog_unit and 'char' in args.recog_unit else 0)
-                wer_avg += wer
-                cer_avg += cer
-            elif 'phone' in args.recog_unit:
-                per = eval_phone(ensemble_models, dataset, recog_params,
-                                 epoch=epoch - 1,
-                                 recog_dir=args.recog_dir,
-                                 progressbar=True)[0]
-                per_avg += per
+                                     progressbar=True)[0]
+                    per_avg += per
+                else:
+                    raise ValueError(args.recog_unit)
+            elif args.recog_metric == 'acc':
+                raise NotImplementedError
+            elif args.recog_metric in ['ppl', 'loss']:
+                ppl, loss = eval_ppl(ensemble_models, dataset,
+                                     recog_params=recog_params,
+                                     progressbar=True)
+                ppl_avg += ppl
+                loss_avg += loss
+            elif args.recog_metric == 'bleu':
+                raise NotImplementedError
             else:
-                raise ValueError(args.recog_unit)
-        elif args.recog_metric == 'acc':
-            raise NotImplementedError
-        elif args.recog_metric in ['ppl', 'loss']:
-            ppl, loss = eval_ppl(ensemble_models, dataset,
-                                 recog_params=recog_params,
-                                 progressbar=True)
-            ppl_avg += ppl
-            loss_avg += loss
-        elif args.recog_metric == 'bleu':
-            raise NotImplementedError
-        else:
-            raise NotImplementedError
+                raise NotImplementedError
         logger.info('Elasped time: %.2f [sec]:' % (time.time() - start_time))
 
     if args.recog_metric == 'edit_distance':
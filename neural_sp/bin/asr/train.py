@@ -13,16 +13,21 @@ from __future__ import print_function
 import argparse
 import copy
 import cProfile
+import contextlib
+import logging
 import numpy as np
 import os
 from setproctitle import setproctitle
 import shutil
 import time
 import torch
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 
 from neural_sp.bin.args_asr import parse
 from neural_sp.bin.lr_controller import Controller
+from neural_sp.bin.train_utils import broadcast_object
+from neural_sp.bin.train_utils import init_distributed
 from neural_sp.bin.train_utils import load_config
 from neural_sp.bin.train_utils import save_config
 from neural_sp.bin.train_utils import set_logger
@@ -39,6 +44,7 @@ from neural_sp.evaluators.wordpiece import eval_wordpiece
 from neural_sp.models.data_parallel import CustomDataParallel
 from neural_sp.models.seq2seq.seq2seq import Seq2seq
 from neural_sp.models.seq2seq.skip_thought import SkipThought
+from neural_sp.models.torch_utils import autocast
 from neural_sp.utils import mkdir_join
 
 
@@ -59,8 +65,15 @@ def main():
                 setattr(args, k, v)
     recog_params = vars(args)
 
+    # Set process group for distributed training
+    rank, world_size = 0, 1
+    if args.distributed:
+        args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+        rank, world_size = init_distributed(args.dist_backend, args.local_rank)
+    is_master = rank == 0
+
     # Automatically reduce batch size in multi-GPU setting
-    if args.n_gpus > 1:
+    if args.n_gpus > 1 and not args.distributed:
         args.batch_size -= 10
         args.print_step //= args.n_gpus
 
@@ -96,7 +109,7 @@ def main():
                         wp_model=args.wp_model,
                         wp_model_sub1=args.wp_model_sub1,
                         wp_model_sub2=args.wp_model_sub2,
-                        batch_size=args.batch_size * args.n_gpus,
+                        batch_size=args.batch_size * (1 if args.distributed else args.n_gpus),
                         n_epochs=args.n_epochs,
                         min_n_frames=args.min_n_frames,
                         max_n_frames=args.max_n_frames,
@@ -104,6 +117,14 @@ def main():
                         short2long=True,
                         sort_stop_epoch=args.sort_stop_epoch,
                         dynamic_batching=args.dynamic_batching,
+                        collate=args.collate,
+                        max_n_frames_batch=args.max_n_frames_batch * (1 if args.distributed else args.n_gpus),
+                        max_n_tokens_batch=args.max_n_tokens_batch * (1 if args.distributed else args.n_gpus),
+                        count_padding=args.count_padding,
+                        n_ques=args.n_ques if args.n_ques > 0 else None,
+                        n_workers=args.n_workers,
+                        rank=rank,
+                        world_size=world_size,
                         ctc=args.ctc_weight > 0,
                         ctc_sub1=args.ctc_weight_sub1 > 0,
                         ctc_sub2=args.ctc_weight_sub2 > 0,
@@ -130,6 +151,8 @@ def main():
                       min_n_frames=args.min_n_frames,
                       max_n_frames=args.max_n_frames,
                       shuffle=True if args.contextualize else False,
+                      n_ques=args.n_ques if args.n_ques > 0 else None,
+                      n_workers=args.n_workers,
                       ctc=args.ctc_weight > 0,
                       ctc_sub1=args.ctc_weight_sub1 > 0,
                       ctc_sub2=args.ctc_weight_sub2 > 0,
@@ -178,10 +201,17 @@ def main():
     else:
         dir_name = make_model_name(args, subsample_factor)
         save_path = mkdir_join(args.model, '_'.join(os.path.basename(args.train_set).split('.')[:-1]), dir_name)
-        save_path = set_save_path(save_path)  # avoid overwriting
+        if is_master:
+            save_path = set_save_path(save_path)  # avoid overwriting
+        save_path = broadcast_object(save_path)
 
     # Set logger
-    logger = set_logger(os.path.join(save_path, 'train.log'), key='training')
+    if is_master:
+        logger = set_logger(os.path.join(save_path, 'train.log'), key='training')
+    else:
+        # NOTE: only the master process writes logs
+        logger = logging.getLogger('training')
+        logger.setLevel(logging.WARNING)
 
     # Model setting
     if skip_thought:
@@ -211,19 +241,20 @@ def main():
                                 weight_decay=float(conf['weight_decay']))
             logger.info('========== Convert to SGD ==========')
     else:
-        # Save the conf file as a yaml file
-        save_config(vars(args), os.path.join(model.save_path, 'conf.yml'))
-        if args.lm_fusion:
-            save_config(args.lm_conf, os.path.join(model.save_path, 'conf_lm.yml'))
-
-        # Save the nlsyms, dictionar, and wp_model
-        if args.nlsyms:
-            shutil.copy(args.nlsyms, os.path.join(model.save_path, 'nlsyms.txt'))
-        for sub in ['', '_sub1', '_sub2']:
-            if getattr(args, 'dict' + sub):
-                shutil.copy(getattr(args, 'dict' + sub), os.path.join(model.save_path, 'dict' + sub + '.txt'))
-            if getattr(args, 'unit' + sub) == 'wp':
-                shutil.copy(getattr(args, 'wp_model' + sub), os.path.join(model.save_path, 'wp' + sub + '.model'))
+        if is_master:
+            # Save the conf file as a yaml file
+            save_config(vars(args), os.path.join(model.save_path, 'conf.yml'))
+            if args.lm_fusion:
+                save_config(args.lm_conf, os.path.join(model.save_path, 'conf_lm.yml'))
+
+            # Save the nlsyms, dictionar, and wp_model
+            if args.nlsyms:
+                shutil.copy(args.nlsyms, os.path.join(model.save_path, 'nlsyms.txt'))
+            for sub in ['', '_sub1', '_sub2']:
+                if getattr(args, 'dict' + sub):
+                    shutil.copy(getattr(args, 'dict' + sub), os.path.join(model.save_path, 'dict' + sub + '.txt'))
+                if getattr(args, 'unit' + sub) == 'wp':
+                    shutil.copy(getattr(args, 'wp_model' + sub), os.path.join(model.save_path, 'wp' + sub + '.model'))
 
         for k, v in sorted(vars(args).items(), key=lambda x: x[0]):
             logger.info('%s: %s' % (k, str(v)))
@@ -286,9 +317,20 @@ def main():
                                    transformer=args.enc_type == 'transformer' or args.dec_type == 'transformer')
 
     train_set.epoch = epoch - 1  # start from index:0
+    if args.resume and checkpoint['dataset_state'] is not None:
+        # Restore the position of the data loader
+        train_set.load_state_dict(checkpoint['dataset_state'])
 
     # GPU setting
-    if args.n_gpus >= 1:
+    if args.distributed:
+        # NOTE: parameters unused in some tasks (e.g. mtl_per_batch) are allowed
+        if args.n_gpus >= 1:
+            model.cuda(args.local_rank)
+            model = DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank,
+                                            find_unused_parameters=True)
+        else:
+            model = DistributedDataParallel(model, find_unused_parameters=True)
+    elif args.n_gpus >= 1:
         model = CustomDataParallel(model,
                                    device_ids=list(range(0, args.n_gpus, 1)),
                                    deterministic=False,
@@ -305,7 +347,14 @@ def main():
         setproctitle(dir_name)
 
     # Set reporter
-    reporter = Reporter(model.module.save_path, tensorboard=True)
+    reporter = Reporter(model.module.save_path, tensorboard=True) if is_master else None
+
+    # Set mixed precision
+    device_id = 0 if args.n_gpus >= 1 else -1
+    scaler = None
+    if args.precision == 'fp16':
+        # NOTE: loss scaling is necessary only for fp16 (torch>=1.10)
+        scaler = torch.cuda.amp.GradScaler()
 
     if args.mtl_per_batch:
         # NOTE: from easier to harder tasks
@@ -335,52 +384,89 @@ def main():
     start_time_epoch = time.time()
     start_time_step = time.time()
     not_improved_n_epochs = 0
-    pbar_epoch = tqdm(total=len(train_set))
+    accum_n_steps = 0
+    model.module.optimizer.zero_grad()
+    pbar_epoch = tqdm(total=len(train_set), disable=not is_master)
     while True:
         # Compute loss in the training set
         batch_train, is_new_epoch = train_set.next()
 
+        # Update parameters every accum_grad_n_steps mini-batches and at the end of each epoch
+        accum_n_steps += 1
+        is_update = accum_n_steps == args.accum_grad_n_steps or is_new_epoch
+
         # Change tasks depending on task
-        for task in tasks:
-            model.module.optimizer.zero_grad()
-            if skip_thought:
-                loss, reporter = model(batch_train['ys'],
-                                       ys_prev=batch_train['ys_prev'],
-                                       ys_next=batch_train['ys_next'],
-                                       reporter=reporter)
-            else:
-                loss, reporter = model(batch_train, reporter=reporter, task=task)
-            if len(model.device_ids) > 1:
-                loss.backward(torch.ones(len(model.device_ids)))
-            else:
-                loss.backward()
+        for i_task, task in enumerate(tasks):
+            # NOTE: gradients are synchronized across processes only before the update
+            # (at every mini-batch in torch<1.2, where DistributedDataParallel.no_sync is not available)
+            no_sync = args.distributed and not is_update and hasattr(model, 'no_sync')
+            with model.no_sync() if no_sync else contextlib.suppress():
+                with autocast(args.precision, device_id):
+                    if skip_thought:
+                        loss, reporter = model(batch_train['ys'],
+                                               ys_prev=batch_train['ys_prev'],
+                                               ys_next=batch_train['ys_next'],
+                                               reporter=reporter)
+                    else:
+                        loss, reporter = model(batch_train, reporter=reporter, task=task)
+                loss_train = loss.item()
+                loss = loss / args.accum_grad_n_steps
+                if scaler is not None:
+                    loss = scaler.scale(loss)
+                if isinstance(model, CustomDataParallel) and len(model.device_ids) > 1:
+                    loss.backward(torch.ones(len(model.device_ids)))
+                else:
+                    loss.backward()
             loss.detach()  # Trancate the graph
-            if args.clip_grad_norm > 0:
-                torch.nn.utils.clip_grad_norm_(model.module.parameters(), args.clip_grad_norm)
-            model.module.optimizer.step()
-            loss_train = loss.item()
             del loss
 
-        reporter.step(is_eval=False)
+            # NOTE: gradients of all tasks are accumulated when accum_grad_n_steps > 1
+            if is_update and (args.accum_grad_n_steps == 1 or i_task == len(tasks) - 1):
+                if accum_n_steps < args.accum_grad_n_steps:
+                    # NOTE: the last window of an epoch is shorter, so the gradients are
+                    # rescaled to the average over the actual number of mini-batches
+                    for p in model.module.parameters():
+                        if p.grad is not None:
+                            p.grad.data.mul_(args.accum_grad_n_steps / accum_n_steps)
+                if args.clip_grad_norm > 0:
+                    if scaler is not None:
+                        scaler.unscale_(model.module.optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.module.parameters(), args.clip_grad_norm)
+                if scaler is not None:
+                    # NOTE: the update is skipped if gradients overflow in fp16
+                    scaler.step(model.module.optimizer)
+                    scaler.update()
+                else:
+                    model.module.optimizer.step()
+                model.module.optimizer.zero_grad()
+        if is_update:
+            accum_n_steps = 0
+            n_updates = lr_controller.count_update()
+
+        if is_master:
+            reporter.step(is_eval=False)
 
         # Update learning rate
-        if step < args.warmup_n_steps:
-            model.module.optimizer = lr_controller.warmup(model.module.optimizer, step=step)
+        if is_update and n_updates < args.warmup_n_steps:
+            model.module.optimizer = lr_controller.warmup(model.module.optimizer, step=n_updates)
 
-        if step % args.print_step == 0:
+        if step % args.print_step == 0 and is_master:
             # Compute loss in the dev set
             batch_dev = dev_set.next()[0]
+            # NOTE: DistributedDataParallel expects backward after every forward
+            model_dev = model.module if args.distributed else model
             # Change tasks depending on task
             for task in tasks:
-                if skip_thought:
-                    loss, reporter = model(batch_dev['ys'],
-                                           ys_prev=batch_dev['ys_prev'],
-                                           ys_next=batch_dev['ys_next'],
-                                           reporter=reporter,
-                                           is_eval=True)
-                else:
-                    loss, reporter = model(batch_dev, reporter=reporter, task=task,
-                                           is_eval=True)
+                with autocast(args.precision, device_id):
+                    if skip_thought:
+                        loss, reporter = model_dev(batch_dev['ys'],
+                                                   ys_prev=batch_dev['ys_prev'],
+                                                   ys_next=batch_dev['ys_next'],
+                                                   reporter=reporter,
+                                                   is_eval=True)
+                    else:
+                        loss, reporter = model_dev(batch_dev, reporter=reporter, task=task,
+                                                   is_eval=True)
                 loss_dev = loss.item()
                 del loss
             reporter.step(is_eval=True)
@@ -396,29 +482,42 @@ def main():
                          lr_controller.lr, len(batch_train['utt_ids']),
                          xlen, duration_step / 60))
             start_time_step = time.time()
-        step += args.n_gpus
-        pbar_epoch.update(len(batch_train['utt_ids']))
+        step += 1 if args.distributed else args.n_gpus
+        pbar_epoch.update(len(batch_train['utt_ids']) * world_size)
 
         # Save fugures of loss and accuracy
-        if step % (args.print_step * 10) == 0:
+        if step % (args.print_step * 10) == 0 and is_master:
             reporter.snapshot()
 
+        # Save checkpoint in the middle of an epoch to resume from the next mini-batch
+        # NOTE: saved only after the update so that no accumulated gradient is lost
+        if args.save_step > 0 and step % args.save_step == 0 and accum_n_steps == 0 and not is_new_epoch and is_master:
+            save_checkpoint(model.module, model.module.save_path, lr_controller,
+                            epoch - 1, step - 1, metric_dev_best,
+                            dataset_state=train_set.state_dict(), step_checkpoint=True)
+
         # Save checkpoint and evaluate model per epoch
         if is_new_epoch:
             duration_epoch = time.time() - start_time_epoch
             logger.info('========== EPOCH:%d (%.2f min) ==========' % (epoch, duration_epoch / 60))
 
             if epoch < args.eval_start_epoch:
-                # Save the model
-                save_checkpoint(model.module, model.module.save_path, lr_controller,
-                                epoch, step - 1, metric_dev_best,
-                                remove_old_checkpoints=True)
-                reporter._epoch += 1
-                # TODO(hirofumi): fix later
+                if is_master:
+                    # Save the model
+                    save_checkpoint(model.module, model.module.save_path, lr_controller,
+                                    epoch, step - 1, metric_dev_best,
+                                    remove_old_checkpoints=True,
+                                    dataset_state=train_set.state_dict())
+                    reporter._epoch += 1
+                    # TODO(hirofumi): fix later
             else:
                 start_time_eval = time.time()
                 # dev
-                if args.metric == 'edit_distance':
+                # NOTE: evaluated in the master process and shared with the others
+                metric_dev = None
+                if not is_master:
+                    pass
+                elif args.metric == 'edit_distance':
                     if args.unit in ['word', 'word_char']:
                         metric_dev = eval_word([model.module], dev_set, recog_params,
                                                epoch=epoch)[0]
@@ -445,7 +544,9 @@ def main():
                     logger.info('Loss (%s): %.2f' % (dev_set.set, metric_dev))
                 else:
                     raise NotImplementedError(args.metric)
-                reporter.epoch(metric_dev)
+                metric_dev = broadcast_object(metric_dev)
+                if is_master:
+                    reporter.epoch(metric_dev)
 
                 # Update learning rate
                 model.module.optimizer = lr_controller.decay(
@@ -457,12 +558,14 @@ def main():
                     logger.info('||||| Best Score |||||')
 
                     # Save the model
-                    save_checkpoint(model.module, model.module.save_path, lr_controller,
-                                    epoch, step - 1, metric_dev_best,
-                                    remove_old_checkpoints=True)
+                    if is_master:
+                        save_checkpoint(model.module, model.module.save_path, lr_controller,
+                                        epoch, step - 1, metric_dev_best,
+                                        remove_old_checkpoints=True,
+                                        dataset_state=train_set.state_dict())
 
                     # test
-                    for s in eval_sets:
+                    for s in eval_sets if is_master else []:
                         if args.metric == 'edit_distance':
                             if args.unit in ['word', 'word_char']:
                                 wer_test = eval_word([model.module], s, recog_params,
@@ -506,6 +609,7 @@ def main():
 
                 # Convert to fine-tuning stage
                 if epoch == args.convert_to_sgd_epoch:
+                    n_updates_total = lr_controller.n_updates
                     model.module.set_optimizer('sgd',
                                                learning_rate=args.learning_rate,
                                                weight_decay=float(args.weight_decay))
@@ -514,9 +618,10 @@ def main():
                                                decay_start_epoch=epoch,
                                                decay_rate=0.5,
                                                lower_better=True)
+                    lr_controller.n_updates = n_updates_total
                     logger.info('========== Convert to SGD ==========')
 
-            pbar_epoch = tqdm(total=len(train_set))
+            pbar_epoch = tqdm(total=len(train_set), disable=not is_master)
 
             if epoch == args.n_epochs:
                 break
@@ -528,9 +633,14 @@ def main():
     duration_train = time.time() - start_time_train
     logger.info('Total time: %.2f hour' % (duration_train / 3600))
 
-    if reporter.tensorboard:
+    if is_master and reporter.tensorboard:
         reporter.tf_writer.close()
     pbar_epoch.close()
+    # Shut down data loader workers left running by early stopping
+    train_set.close()
+    dev_set.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
     return model.module.save_path
 
@@ -550,6 +660,10 @@ def make_model_name(args, subsample_factor):
     if args.enc_type == 'transformer':
         dir_name += str(args.d_model) + 'H'
         dir_name += str(args.transformer_enc_n_layers) + 'L'
+        if args.transformer_attn_type == 'local':
+            dir_name += '_local' + str(args.transformer_attn_window_left) + '-' + str(args.transformer_attn_window_right)
+            if args.transformer_attn_global_stride > 0:
+                dir_name += 'g' + str(args.transformer_attn_global_stride)
     else:
         dir_name += str(args.enc_n_units) + 'H'
         dir_name += str(args.enc_n_projs) + 'P'
@@ -593,6 +707,8 @@ def make_model_name(args, subsample_factor):
     dir_name += '_' + args.optimizer
     dir_name += '_lr' + str(args.learning_rate)
     dir_name += '_bs' + str(args.batch_size)
+    if args.accum_grad_n_steps > 1:
+        dir_name += '_accum' + str(args.accum_grad_n_steps)
     if args.ctc_weight < 1:
         dir_name += '_ss' + str(args.ss_prob)
     dir_name += '_ls' + str(args.lsm_prob)
@@ -11,16 +11,21 @@ from __future__ import division
 from __future__ import print_function
 
 import cProfile
+import contextlib
+import logging
 import numpy as np
 import os
 from setproctitle import setproctitle
 import shutil
 import time
 import torch
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 
 from neural_sp.bin.args_lm import parse
 from neural_sp.bin.lr_controller import Controller
+from neural_sp.bin.train_utils import broadcast_object
+from neural_sp.bin.train_utils import init_distributed
 from neural_sp.bin.train_utils import load_config
 from neural_sp.bin.train_utils import save_config
 from neural_sp.bin.train_utils import set_logger
@@ -33,6 +38,7 @@ from neural_sp.evaluators.ppl import eval_ppl
 from neural_sp.models.data_parallel import CustomDataParallel
 from neural_sp.models.lm.gated_convlm import GatedConvLM
 from neural_sp.models.lm.rnnlm import RNNLM
+from neural_sp.models.torch_utils import autocast
 from neural_sp.utils import mkdir_join
 
 
@@ -51,6 +57,13 @@ def main():
             if k != 'resume':
                 setattr(args, k, v)
 
+    # Set process group for distributed training
+    rank, world_size = 0, 1
+    if args.distributed:
+        args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+        rank, world_size = init_distributed(args.dist_backend, args.local_rank)
+    is_master = rank == 0
+
     # Load dataset
     train_set = Dataset(corpus=args.corpus,
                         tsv_path=args.train_set,
@@ -58,12 +71,16 @@ def main():
                         nlsyms=args.nlsyms,
                         unit=args.unit,
                         wp_model=args.wp_model,
-                        batch_size=args.batch_size * args.n_gpus,
+                        batch_size=args.batch_size * (1 if args.distributed else args.n_gpus),
                         n_epochs=args.n_epochs,
                         min_n_tokens=args.min_n_tokens,
                         bptt=args.bptt,
                         backward=args.backward,
-                        serialize=args.serialize)
+                        serialize=args.serialize,
+                        n_ques=args.n_ques if args.n_ques > 0 else None,
+                        n_workers=args.n_workers,
+                        rank=rank,
+                        world_size=world_size)
     dev_set = Dataset(corpus=args.corpus,
                       tsv_path=args.dev_set,
                       dict_path=args.dict,
@@ -73,7 +90,9 @@ def main():
                       batch_size=args.batch_size * args.n_gpus,
                       bptt=args.bptt,
                       backward=args.backward,
-                      serialize=args.serialize)
+                      serialize=args.serialize,
+                      n_ques=args.n_ques if args.n_ques > 0 else None,
+                      n_workers=args.n_workers)
     eval_sets = []
     for s in args.eval_sets:
         eval_sets += [Dataset(corpus=args.corpus,
@@ -96,10 +115,17 @@ def main():
     else:
         dir_name = make_model_name(args)
         save_path = mkdir_join(args.model, '_'.join(os.path.basename(args.train_set).split('.')[:-1]), dir_name)
-        save_path = set_save_path(save_path)  # avoid overwriting
+        if is_master:
+            save_path = set_save_path(save_path)  # avoid overwriting
+        save_path = broadcast_object(save_path)
 
     # Set logger
-    logger = set_logger(os.path.join(save_path, 'train.log'), key='training')
+    if is_master:
+        logger = set_logger(os.path.join(save_path, 'train.log'), key='training')
+    else:
+        # NOTE: only the master process writes logs
+        logger = logging.getLogger('training')
+        logger.setLevel(logging.WARNING)
 
     # Model setting
     if 'gated_conv' in args.lm_type:
@@ -129,15 +155,16 @@ def main():
                                 weight_decay=float(conf['weight_decay']))
             logger.info('========== Convert to SGD ==========')
     else:
-        # Save the conf file as a yaml file
-        save_config(vars(args), os.path.join(model.save_path, 'conf.yml'))
+        if is_master:
+            # Save the conf file as a yaml file
+            save_config(vars(args), os.path.join(model.save_path, 'conf.yml'))
 
-        # Save the nlsyms, dictionar, and wp_model
-        if args.nlsyms:
-            shutil.copy(args.nlsyms, os.path.join(model.save_path, 'nlsyms.txt'))
-        shutil.copy(args.dict, os.path.join(model.save_path, 'dict.txt'))
-        if args.unit == 'wp':
-            shutil.copy(args.wp_model, os.path.join(model.save_path, 'wp.model'))
+            # Save the nlsyms, dictionar, and wp_model
+            if args.nlsyms:
+                shutil.copy(args.nlsyms, os.path.join(model.save_path, 'nlsyms.txt'))
+            shutil.copy(args.dict, os.path.join(model.save_path, 'dict.txt'))
+            if args.unit == 'wp':
+                shutil.copy(args.wp_model, os.path.join(model.save_path, 'wp.model'))
 
         for k, v in sorted(vars(args).items(), key=lambda x: x[0]):
             logger.info('%s: %s' % (k, str(v)))
@@ -167,9 +194,19 @@ def main():
                                    best_value=ppl_dev_best)
 
     train_set.epoch = epoch - 1  # start from index:0
+    if args.resume and checkpoint['dataset_state'] is not None:
+        # Restore the position of the data loader
+        train_set.load_state_dict(checkpoint['dataset_state'])
 
     # GPU setting
-    if args.n_gpus >= 1:
+    if args.distributed:
+        if args.n_gpus >= 1:
+            model.cuda(args.local_rank)
+            model = DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank,
+                                            find_unused_parameters=True)
+        else:
+            model = DistributedDataParallel(model, find_unused_parameters=True)
+    elif args.n_gpus >= 1:
         model = CustomDataParallel(model,
                                    device_ids=list(range(0, args.n_gpus, 1)),
                                    deterministic=False,
@@ -186,38 +223,79 @@ def main():
         setproctitle(dir_name)
 
     # Set reporter
-    reporter = Reporter(model.module.save_path, tensorboard=True)
+    reporter = Reporter(model.module.save_path, tensorboard=True) if is_master else None
+
+    # Set mixed precision
+    device_id = 0 if args.n_gpus >= 1 else -1
+    scaler = None
+    if args.precision == 'fp16':
+        # NOTE: loss scaling is necessary only for fp16 (torch>=1.10)
+        scaler = torch.cuda.amp.GradScaler()
 
     hidden = None
     start_time_train = time.time()
     start_time_epoch = time.time()
     start_time_step = time.time()
     not_improved_epoch = 0
-    pbar_epoch = tqdm(total=len(train_set))
+    accum_n_steps = 0
+    model.module.optimizer.zero_grad()
+    pbar_epoch = tqdm(total=len(train_set), disable=not is_master)
     while True:
         # Compute loss in the training set
         ys_train, is_new_epoch = train_set.next()
 
-        model.module.optimizer.zero_grad()
-        loss, hidden, reporter = model(ys_train, hidden, reporter)
-        if len(model.device_ids) > 1:
-            loss.backward(torch.ones(len(model.device_ids)))
-        else:
-            loss.backward()
+        # Update parameters every accum_grad_n_steps mini-batches and at the end of each epoch
+        accum_n_steps += 1
+        is_update = accum_n_steps == args.accum_grad_n_steps or is_new_epoch
+
+        # NOTE: gradients are synchronized across processes only before the update
+        # (at every mini-batch in torch<1.2, where DistributedDataParallel.no_sync is not available)
+        no_sync = args.distributed and not is_update and hasattr(model, 'no_sync')
+        with model.no_sync() if no_sync else contextlib.suppress():
+            with autocast(args.precision, device_id):
+                loss, hidden, reporter = model(ys_train, hidden, reporter)
+            loss_train = loss.item()
+            loss = loss / args.accum_grad_n_steps
+            if scaler is not None:
+                loss = scaler.scale(loss)
+            if isinstance(model, CustomDataParallel) and len(model.device_ids) > 1:
+                loss.backward(torch.ones(len(model.device_ids)))
+            else:
+                loss.backward()
         loss.detach()  # Trancate the graph
-        if args.clip_grad_norm > 0:
-            torch.nn.utils.clip_grad_norm_(model.module.parameters(), args.clip_grad_norm)
-        model.module.optimizer.step()
-        loss_train = loss.item()
         del loss
+        if is_update:
+            if accum_n_steps < args.accum_grad_n_steps:
+                # NOTE: the last window of an epoch is shorter, so the gradients are
+                # rescaled to the average over the actual number of mini-batches
+                for p in model.module.parameters():
+                    if p.grad is not None:
+                        p.grad.data.mul_(args.accum_grad_n_steps / accum_n_steps)
+            if args.clip_grad_norm > 0:
+                if scaler is not None:
+                    scaler.unscale_(model.module.optimizer)
+                torch.nn.utils.clip_grad_norm_(model.module.parameters(), args.clip_grad_norm)
+            if scaler is not None:
+                # NOTE: the update is skipped if gradients overflow in fp16
+                scaler.step(model.module.optimizer)
+                scaler.update()
+            else:
+                model.module.optimizer.step()
+            model.module.optimizer.zero_grad()
+            accum_n_steps = 0
+            lr_controller.count_update()
         if 'gated_conv' not in args.lm_type:
             hidden = model.module.repackage_hidden(hidden)
-        reporter.step(is_eval=False)
+        if is_master:
+            reporter.step(is_eval=False)
 
-        if step % args.print_step == 0:
+        if step % args.print_step == 0 and is_master:
             # Compute loss in the dev set
             ys_dev = dev_set.next()[0]
-            loss, _, reporter = model(ys_dev, None, reporter, is_eval=True)
+            # NOTE: DistributedDataParallel expects backward after every forward
+            model_dev = model.module if args.distributed else model
+            with autocast(args.precision, device_id):
+                loss, _, reporter = model_dev(ys_dev, None, reporter, is_eval=True)
             loss_dev = loss.item()
             del loss
             reporter.step(is_eval=True)
@@ -228,13 +306,20 @@ def main():
                          np.exp(loss_train), np.exp(loss_dev),
                          lr_controller.lr, ys_train.shape[0], duration_step / 60))
             start_time_step = time.time()
-        step += args.n_gpus
-        pbar_epoch.update(ys_train.shape[0] * (ys_train.shape[1] - 1))
+        step += 1 if args.distributed else args.n_gpus
+        pbar_epoch.update(ys_train.shape[0] * (ys_train.shape[1] - 1) * world_size)
 
         # Save fugures of loss and accuracy
-        if step % (args.print_step * 10) == 0:
+        if step % (args.print_step * 10) == 0 and is_master:
             reporter.snapshot()
 
+        # Save checkpoint in the middle of an epoch to resume from the next mini-batch
+        # NOTE: saved only after the update so that no accumulated gradient is lost
+        if args.save_step > 0 and step % args.save_step == 0 and accum_n_steps == 0 and not is_new_epoch and is_master:
+            save_checkpoint(model.module, model.module.save_path, lr_controller,
+                            epoch - 1, step - 1, ppl_dev_best,
+                            dataset_state=train_set.state_dict(), step_checkpoint=True)
+
         # Save checkpoint and evaluate model per epoch
         if is_new_epoch:
             duration_epoch = time.time() - start_time_epoch
@@ -242,15 +327,21 @@ def main():
 
             if epoch < args.eval_start_epoch:
                 # Save the model
-                save_checkpoint(model.module, model.module.save_path, lr_controller,
-                                epoch, step - 1, ppl_dev_best,
-                                remove_old_checkpoints=True)
+                if is_master:
+                    save_checkpoint(model.module, model.module.save_path, lr_controller,
+                                    epoch, step - 1, ppl_dev_best,
+                                    remove_old_checkpoints=True,
+                                    dataset_state=train_set.state_dict())
             else:
                 start_time_eval = time.time()
                 # dev
-                ppl_dev, _ = eval_ppl([model.module], dev_set,
-                                      batch_size=1, bptt=args.bptt)
-                logger.info('PPL (%s): %.2f' % (dev_set.set, ppl_dev))
+                # NOTE: evaluated in the master process and shared with the others
+                ppl_dev = None
+                if is_master:
+                    ppl_dev, _ = eval_ppl([model.module], dev_set,
+                                          batch_size=1, bptt=args.bptt)
+                    logger.info('PPL (%s): %.2f' % (dev_set.set, ppl_dev))
+                ppl_dev = broadcast_object(ppl_dev)
 
                 # Update learning rate
                 model.module.optimizer = lr_controller.decay(
@@ -263,18 +354,20 @@ def main():
                     logger.info('||||| Best Score |||||')
 
                     # Save the model
-                    save_checkpoint(model.module, model.module.save_path, lr_controller,
-                                    epoch, step - 1, ppl_dev_best,
-                                    remove_old_checkpoints=True)
+                    if is_master:
+                        save_checkpoint(model.module, model.module.save_path, lr_controller,
+                                        epoch, step - 1, ppl_dev_best,
+                                        remove_old_checkpoints=True,
+                                        dataset_state=train_set.state_dict())
 
                     # test
                     ppl_test_avg = 0.
-                    for eval_set in eval_sets:
+                    for eval_set in eval_sets if is_master else []:
                         ppl_test, _ = eval_ppl([model.module], eval_set,
                                                batch_size=1, bptt=args.bptt)
                         logger.info('PPL (%s): %.2f' % (eval_set.set, ppl_test))
                         ppl_test_avg += ppl_test
-                    if len(eval_sets) > 0:
+                    if len(eval_sets) > 0 and is_master:
                         logger.info('PPL (avg.): %.2f' % (ppl_test_avg / len(eval_sets)))
                 else:
                     not_improved_epoch += 1
@@ -288,6 +381,7 @@ def main():
 
                 # Convert to fine-tuning stage
                 if epoch == args.convert_to_sgd_epoch:
+                    n_updates_total = lr_controller.n_updates
                     model.module.set_optimizer('sgd',
                                                learning_rate=args.learning_rate,
                                                weight_decay=float(args.weight_decay))
@@ -296,9 +390,10 @@ def main():
                                                decay_start_epoch=epoch,
                                                decay_rate=0.5,
                                                lower_better=True)
+                    lr_controller.n_updates = n_updates_total
                     logger.info('========== Convert to SGD ==========')
 
-            pbar_epoch = tqdm(total=len(train_set))
+            pbar_epoch = tqdm(total=len(train_set), disable=not is_master)
 
             if epoch == args.n_epochs:
                 break
@@ -310,9 +405,14 @@ def main():
     duration_train = time.time() - start_time_train
     logger.info('Total time: %.2f hour' % (duration_train / 3600))
 
-    if reporter.tensorboard:
+    if is_master and reporter.tensorboard:
         reporter.tf_writer.close()
     pbar_epoch.close()
+    # Shut down data loader workers left running by early stopping
+    train_set.close()
+    dev_set.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
     return model.module.save_path
 
@@ -327,6 +427,8 @@ def make_model_name(args):
     dir_name += '_' + args.optimizer
     dir_name += '_lr' + str(args.learning_rate)
     dir_name += '_bs' + str(args.batch_size)
+    if args.accum_grad_n_steps > 1:
+        dir_name += '_accum' + str(args.accum_grad_n_steps)
     dir_name += '_bptt' + str(args.bptt)
     if args.tie_embedding:
         dir_name += '_tie'
@@ -59,6 +59,7 @@ class Controller(object):
                 self.lr_init = learning_rate
         self.warmup_start_lr = warmup_start_learning_rate
         self.warmup_n_steps = warmup_n_steps
+        self.n_updates = 0  # number of optimizer updates
 
         self.lr = self.lr_init
 
@@ -120,7 +121,7 @@ class Controller(object):
 
         Args:
             optimizer ():
-            epoch (int): the current epoch
+            step (int): the number of optimizer updates
         Returns:
             optimizer ():
 
@@ -138,3 +139,15 @@ class Controller(object):
             param_group['lr'] = self.lr
 
         return optimizer
+
+    def count_update(self):
+        """Count an optimizer update.
+           Updates are counted explicitly because the last update of each epoch
+           can be made with fewer mini-batches than accum_grad_n_steps.
+
+        Returns:
+            n_updates (int): the number of optimizer updates so far
+
+        """
+        self.n_updates += 1
+        return self.n_updates
@@ -13,7 +13,9 @@ from __future__ import print_function
 import functools
 from glob import glob
 import logging
+import numpy as np
 import os
+import pickle
 import time
 import torch
 import yaml
@@ -84,6 +86,69 @@ def set_logger(save_path, key):
     return logger
 
 
+def init_distributed(backend, local_rank):
+    """Initialize the process group for DistributedDataParallel.
+       MASTER_ADDR, MASTER_PORT, RANK and WORLD_SIZE are read from environment variables,
+       which are set by torch.distributed.launch.
+
+    Args:
+        backend (str): nccl or gloo (for CPU)
+        local_rank (int): index of the GPU used in this process
+    Returns:
+        rank (int): index of this process
+        world_size (int): number of processes
+
+    """
+    # NOTE: DistributedDataParallel(find_unused_parameters=True) requires torch>=1.1
+    if tuple(int(v) for v in torch.__version__.split('.')[:2]) < (1, 1):
+        raise ValueError('Distributed training requires torch>=1.1, but torch %s is installed.'
+                         % torch.__version__)
+    torch.distributed.init_process_group(backend=backend, init_method='env://')
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+
+def broadcast_object(obj, src=0):
+    """Send a picklable object from the process src to all processes.
+
+    Args:
+        obj (): the object to send (ignored in processes other than src)
+        src (int): rank of the source process
+    Returns:
+        obj (): the object of the process src
+
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return obj
+    if hasattr(torch.distributed, 'broadcast_object_list'):
+        objs = [obj]
+        torch.distributed.broadcast_object_list(objs, src=src)
+        return objs[0]
+
+    # NOTE: broadcast_object_list is available from torch 1.8.
+    # Otherwise, the pickled object is sent as a ByteTensor after its length.
+    if torch.distributed.get_backend() == 'nccl':
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+    is_src = torch.distributed.get_rank() == src
+    if is_src:
+        data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy())
+        length = torch.LongTensor([data.numel()])
+    else:
+        length = torch.LongTensor([0])
+    length = length.to(device)
+    torch.distributed.broadcast(length, src)
+    if not is_src:
+        data = torch.ByteTensor(int(length.item()))
+    data = data.to(device)
+    torch.distributed.broadcast(data, src)
+    if is_src:
+        return obj
+    return pickle.loads(data.cpu().numpy().tobytes())
+
+
 def set_save_path(save_path):
     """Change directory name to avoid name ovarlapping.
 
@@ -113,7 +178,7 @@ def load_checkpoint(model, checkpoint_path, resume=False):
 
     Args:
         model (torch.nn.Module):
-        checkpoint_path (str): path to the saved model (model..epoch-*)
+        checkpoint_path (str): path to the saved model (model.epoch-* or model.step-*.epoch-*)
         epoch (int): negative values mean the offset from the last saved model
         resume (bool): if True, restore the save optimizer
     Returns:
@@ -122,6 +187,7 @@ def load_checkpoint(model, checkpoint_path, resume=False):
             epoch (int): the currnet epoch
             step (int): the current step
             metric_dev_best (float): the current best performance
+            dataset_state (dict): the iteration state of the training set (None for old checkpoints)
 
     """
     if not os.path.isfile(checkpoint_path):
@@ -156,17 +222,23 @@ def load_checkpoint(model, checkpoint_path, resume=False):
     else:
         logger.info("=> Loading checkpoint (epoch:%d): %s" % (epoch, checkpoint_path))
 
+    lr_controller = checkpoint['lr_controller']
+    if not hasattr(lr_controller, 'n_updates'):
+        # NOTE: old checkpoints do not count optimizer updates
+        lr_controller.n_updates = checkpoint['step'] // getattr(lr_controller, 'accum_grad_n_steps', 1)
+
     return_values = {
-        'lr_controller': checkpoint['lr_controller'],
+        'lr_controller': lr_controller,
         'epoch': epoch + 1,
         'step': checkpoint['step'] + 1,
-        'metric_dev_best': checkpoint['metric_dev_best']
+        'metric_dev_best': checkpoint['metric_dev_best'],
+        'dataset_state': checkpoint.get('dataset_state', None)
     }
     return model, return_values
 
 
 def save_checkpoint(model, save_path, lr_controller, epoch, step, metric_dev_best,
-                    remove_old_checkpoints=False):
+                    remove_old_checkpoints=False, dataset_state=None, step_checkpoint=False):
     """Save checkpoint.
 
     Args:
@@ -178,14 +250,25 @@ def save_checkpoint(model, save_path, lr_controller, epoch, step, metric_dev_bes
         metric_dev_best (float):
         remove_old_checkpoints (bool): if True, all checkpoints
             other than the best one will be deleted
+        dataset_state (dict): the iteration state of the training set
+            (Dataset.state_dict()) to resume from the next mini-batch
+        step_checkpoint (bool): if True, save a checkpoint in the middle of an epoch
+            as model.step-*.epoch-*, where epoch is the number of finished epochs.
+            Only the latest one is kept.
 
     """
-    model_path = os.path.join(save_path, 'model.epoch-' + str(epoch))
+    if step_checkpoint:
+        model_path = os.path.join(save_path, 'model.step-%d.epoch-%d' % (step, epoch))
+    else:
+        model_path = os.path.join(save_path, 'model.epoch-' + str(epoch))
 
     # Remove old checkpoints
     if remove_old_checkpoints:
         for path in glob(os.path.join(save_path, 'model.epoch-*')):
             os.remove(path)
+    # NOTE: checkpoints in the middle of epochs are only used for resuming
+    for path in glob(os.path.join(save_path, 'model.step-*')):
+        os.remove(path)
 
     # Save parameters, optimizer, step index etc.
     checkpoint = {
@@ -194,7 +277,8 @@ def save_checkpoint(model, save_path, lr_controller, epoch, step, metric_dev_bes
         "lr_controller": lr_controller,
         "epoch": epoch,
         "step": step,
-        "metric_dev_best": metric_dev_best
+        "metric_dev_best": metric_dev_best,
+        "dataset_state": dataset_state
     }
     torch.save(checkpoint, model_path)
 
@@ -11,10 +11,15 @@ from __future__ import division
 from __future__ import print_function
 
 import codecs
+import collections
 import logging
+import numpy as np
 import random
 import six
+from six.moves import queue
 import time
+import torch
+import traceback
 from torch.multiprocessing import Process
 from torch.multiprocessing import Queue
 
@@ -34,9 +39,34 @@ class Base(object):
         self._epoch = 0
 
         # Setting for multiprocessing
-        self.preloading_process = None
-        self.queue = Queue()
-        self.queue_size = 0
+        self.n_ques = None
+        self.n_workers = 1
+        self.workers = []
+        self.index_queue = None
+        self.data_queue = None
+        self.queue_generation = 0
+        self.n_enqueued = 0  # number of mini-batches sent to workers
+        self.n_dequeued = 0  # number of mini-batches returned to the caller
+        self.pending = collections.deque()  # (data_indices, is_new_epoch, sampler state) of enqueued mini-batches
+        self.reorder_buffer = {}
+        self.buffer_queue = None  # pool of shared memory buffers for input features
+        self.buffer_in_use = None
+
+        # Pad features and labels into tensors in the data loader
+        self.collate = False
+
+        # Setting for frame-budget batching
+        self.max_n_frames_batch = 0
+        self.max_n_tokens_batch = 0
+        self.count_padding = True
+        self.perm = None  # data indices in the order of sampling in the current epoch
+        self.batches = None  # list of data_indices of each mini-batch in the current epoch
+        self.batch_cursor = 0
+
+        # Setting for distributed training
+        self.rank = 0
+        self.world_size = 1
+        self.seed = 1
 
     def count_vocab_size(self, dict_path):
         vocab_count = 1  # for <blank>
@@ -74,54 +104,59 @@ class Base(object):
         if batch_size is None:
             batch_size = self.batch_size
 
-        if self.n_ques is None:
-            if self.max_epoch is not None and self.epoch >= self.max_epoch:
-                raise StopIteration()
-            # NOTE: max_epoch == None means infinite loop
+        if self.max_epoch is not None and self.epoch >= self.max_epoch:
+            self.close()
+            raise StopIteration()
+        # NOTE: max_epoch == None means infinite loop
 
-            data_indices, is_new_epoch = self.sample_index(batch_size)
-            batch = self.make_batch(data_indices)
-            self.iteration += len(data_indices)
-        else:
-            # Clean up multiprocessing
-            if self.preloading_process is not None and self.queue_size == 0:
-                self.preloading_process.terminate()
-                self.preloading_process.join()
-
-            if self.max_epoch is not None and self.epoch >= self.max_epoch:
-                # Clean up multiprocessing
-                self.preloading_process.terminate()
-                self.preloading_process.join()
-                raise StopIteration()
-            # NOTE: max_epoch == None means infinite loop
-
-            # Enqueue mini-batches
-            if self.queue_size == 0:
-                self.df_indices_list = []
-                self.is_new_epoch_list = []
-                for _ in six.moves.range(self.n_ques):
-                    data_indices, is_new_epoch = self.sample_index(batch_size)
-                    self.df_indices_list.append(data_indices)
-                    self.is_new_epoch_list.append(is_new_epoch)
-                self.preloading_process = Process(self.preloading_loop,
-                                                  args=(self.queue, self.df_indices_list))
-                self.preloading_process.start()
-                self.queue_size += self.n_ques
-                time.sleep(3)
-
-            # print(self.queue.qsize())
-            # print(self.queue_size)
-
-            self.iteration += len(self.df_indices_list[self.n_ques - self.queue_size])
-            self.queue_size -= 1
-            batch = self.queue.get()
-            is_new_epoch = self.is_new_epoch_list.pop(0)
+        data_indices, batch, is_new_epoch = self.fetch_batch(batch_size)
+
+        if self.collate and torch.cuda.is_available():
+            batch = self.pin_batch(batch)
 
+        self.iteration += len(data_indices)
         if is_new_epoch:
             self.epoch += 1
 
         return batch, is_new_epoch
 
+    def fetch_batch(self, batch_size):
+        """Sample the next mini-batch and make it in the main process,
+           or receive it from worker processes when n_ques is set.
+
+        Args:
+            batch_size (int): the size of mini-batch
+        Returns:
+            data_indices: returned by sample_index
+            batch (dict): returned by make_batch
+            is_new_epoch (bool):
+
+        """
+        if self.n_ques is None:
+            data_indices, is_new_epoch = self.sample_index(batch_size)
+            batch = self.make_batch(data_indices)
+            if self.collate:
+                batch = self.collate_batch(batch)
+            return data_indices, batch, is_new_epoch
+
+        if len(self.workers) == 0:
+            self.start_workers()
+
+        # Keep n_ques mini-batches in flight
+        while len(self.pending) < self.n_ques:
+            sampler_state = self.sampler_state()
+            data_indices, is_new_epoch = self.sample_index(batch_size)
+            self.index_queue.put((self.queue_generation, self.n_enqueued, data_indices))
+            self.pending.append((data_indices, is_new_epoch, sampler_state))
+            self.n_enqueued += 1
+
+        # NOTE: features of the previous mini-batch are overwritten from here
+        self.release_buffer(self.buffer_in_use)
+        data_indices, is_new_epoch, _ = self.pending.popleft()
+        batch, self.buffer_in_use = self.unshare_batch(self.dequeue(self.n_dequeued))
+        self.n_dequeued += 1
+        return data_indices, batch, is_new_epoch
+
     def next(self, batch_size=None):
         # For python2
         return self.__next__(batch_size)
@@ -136,50 +171,156 @@ class Base(object):
             is_new_epoch (bool):
 
         """
-        is_new_epoch = False
+        if self.max_n_frames_batch > 0 or self.max_n_tokens_batch > 0:
+            return self.sample_bucket_index()
 
-        if self.sort_by_input_length or not self.shuffle:
-            if self.sort_by_input_length:
-                # Change batch size dynamically
-                min_n_frames_batch = self.df[self.offset:self.offset + 1]['xlen'].values[0]
-                batch_size_tmp = self.select_batch_size(batch_size, min_n_frames_batch)
-            else:
-                batch_size_tmp = batch_size
-
-            if len(self.rest) > batch_size_tmp:
-                data_indices = list(self.df[self.offset:self.offset + batch_size_tmp].index)
-                self.rest -= set(data_indices)
-                # NOTE: rest is in uttrance length order when sort_by_input_length == True
+        in_order = self.sort_by_input_length or not self.shuffle
+        if self.perm is None:
+            if in_order:
+                # NOTE: in uttrance length order when sort_by_input_length == True
                 # NOTE: otherwise in name length order when shuffle == False
-                self.offset += len(data_indices)
+                self.perm = self.df.index.values
             else:
-                # Last mini-batch
-                data_indices = list(self.df[self.offset: self.offset + len(self.rest)].index)
-                self._reset()
-                is_new_epoch = True
-                self._epoch += 1
-                if self._epoch == self.sort_stop_epoch:
-                    self.sort_by_input_length = False
-                    self.shuffle = True
+                # Randomly sample uttrances
+                self.perm = self.epoch_rng(self._epoch).permutation(self.df.index.values)
+
+        if self.sort_by_input_length:
+            # Change batch size dynamically
+            min_n_frames_batch = self.df['xlen'].values[self.offset]
+            batch_size = self.select_batch_size(batch_size, min_n_frames_batch)
 
+        # NOTE: a global mini-batch is shared by all processes in distributed training
+        n_utts = batch_size * self.world_size
+        is_new_epoch = False
+        data_indices = self.perm[self.offset:self.offset + n_utts]
+        if self.world_size > 1:
+            data_indices = self.shard(data_indices)
+        data_indices = data_indices.tolist()
+        if self.offset + n_utts < len(self.perm):
+            self.offset += n_utts
+        else:
+            # Last mini-batch
+            self._reset()
+            is_new_epoch = True
+            self._epoch += 1
+            if in_order and self._epoch == self.sort_stop_epoch:
+                self.sort_by_input_length = False
+                self.shuffle = True
+
+        if in_order:
             # Sort in the descending order for pytorch
             data_indices = data_indices[::-1]
-        else:
-            # Randomly sample uttrances
-            if len(self.rest) > batch_size:
-                data_indices = random.sample(list(self.rest), batch_size)
-                self.rest -= set(data_indices)
-            else:
-                # Last mini-batch
-                data_indices = list(self.rest)
-                self._reset()
-                is_new_epoch = True
-                self._epoch += 1
 
-            self.offset += len(data_indices)
+        return data_indices, is_new_epoch
+
+    def sample_bucket_index(self):
+        """Sample data indices of mini-batch packed under the frame/token budget.
+
+        Returns:
+            data_indices (list):
+            is_new_epoch (bool):
+
+        """
+        if self.batches is None:
+            self.batches = self.make_buckets()
+
+        # NOTE: each process takes one of world_size consecutive mini-batches
+        batches = self.batches[self.batch_cursor:self.batch_cursor + self.world_size]
+        data_indices = batches[self.rank]
+        self.batch_cursor += self.world_size
+        self.offset += sum(len(indices) for indices in batches)
+
+        is_new_epoch = False
+        if self.batch_cursor == len(self.batches):
+            # Last mini-batch
+            self._reset()
+            is_new_epoch = True
+            self._epoch += 1
+            if self._epoch == self.sort_stop_epoch:
+                self.sort_by_input_length = False
+                self.shuffle = True
 
         return data_indices, is_new_epoch
 
+    def epoch_rng(self, epoch):
+        """Return the random number generator to shuffle utterances in the epoch.
+           The permutation is determined by the seed and epoch, so that all processes in
+           distributed training and worker processes draw the same one without communication.
+        """
+        return np.random.RandomState(self.seed + epoch)
+
+    def shard(self, data_indices):
+        """Return the part of a global mini-batch for this process.
+           The global mini-batch is padded with utterances from the beginning of the epoch
+           so that all processes receive the same number of utterances.
+
+        Args:
+            data_indices (np.ndarray): data indices of the global mini-batch
+        Returns:
+            data_indices (np.ndarray):
+
+        """
+        n_pad = -len(data_indices) % self.world_size
+        if n_pad > 0:
+            data_indices = np.concatenate([data_indices, np.resize(self.perm, n_pad)])
+        return data_indices[self.rank::self.world_size]
+
+    def make_buckets(self):
+        """Pack utterances of similar lengths into mini-batches for one epoch.
+           Each mini-batch contains utterances as many as possible so that the total
+           number of input frames (output tokens) does not exceed max_n_frames_batch
+           (max_n_tokens_batch). Padding is included in the total when count_padding is True.
+           An utterance exceeding the budget by itself makes a mini-batch alone.
+
+        Returns:
+            batches (list): A list of data_indices, which are sorted in the descending order of xlen.
+                In distributed training, the number of mini-batches is padded to a multiple of world_size.
+
+        """
+        rng = self.epoch_rng(self._epoch)
+        xlens = self.df['xlen'].values
+        ylens = self.df['ylen'].values
+        if self.sort_by_input_length:
+            order = np.arange(len(self.df))
+        else:
+            # Sort by length with random tie-breaking
+            order = np.lexsort((rng.rand(len(self.df)), xlens))
+
+        def n_total(n_utts, max_len, sum_len):
+            return n_utts * max_len if self.count_padding else sum_len
+
+        positions = []
+        batches_pos = []
+        max_xlen = sum_xlen = max_ylen = sum_ylen = 0
+        for i, xlen, ylen in zip(order.tolist(), xlens[order].tolist(), ylens[order].tolist()):
+            n_utts = len(positions) + 1
+            max_xlen_i, max_ylen_i = max(max_xlen, xlen), max(max_ylen, ylen)
+            if len(positions) > 0 and (
+                    (self.max_n_frames_batch > 0 and n_total(n_utts, max_xlen_i, sum_xlen + xlen) > self.max_n_frames_batch) or
+                    (self.max_n_tokens_batch > 0 and n_total(n_utts, max_ylen_i, sum_ylen + ylen) > self.max_n_tokens_batch)):
+                batches_pos.append(positions)
+                positions = []
+                max_xlen = sum_xlen = max_ylen = sum_ylen = 0
+                max_xlen_i, max_ylen_i = xlen, ylen
+            positions.append(i)
+            max_xlen, max_ylen = max_xlen_i, max_ylen_i
+            sum_xlen += xlen
+            sum_ylen += ylen
+        if len(positions) > 0:
+            batches_pos.append(positions)
+
+        if not self.sort_by_input_length:
+            # Shuffle the order of buckets every epoch
+            batches_pos = [batches_pos[j] for j in rng.permutation(len(batches_pos))]
+
+        # Repeat mini-batches so that all processes have the same number of steps
+        # NOTE: mini-batches are cycled when there are fewer mini-batches than processes
+        n_pad = -len(batches_pos) % self.world_size
+        batches_pos += [batches_pos[j % len(batches_pos)] for j in range(n_pad)]
+
+        # Sort in the descending order for pytorch
+        return [self.df.index[sorted(pos, key=lambda i: -xlens[i])].tolist() for pos in batches_pos]
+
     def select_batch_size(self, batch_size, min_n_frames_batch):
         if not self.dynamic_batching:
             return batch_size
@@ -196,31 +337,291 @@ class Base(object):
 
         return batch_size
 
+    def sampler_state(self):
+        """Return the state of sample_index.
+           The permutation (or mini-batches) of the epoch is not saved because it is
+           regenerated from the seed and epoch by epoch_rng.
+        """
+        return {'_epoch': self._epoch,
+                'offset': self.offset,
+                'batch_cursor': self.batch_cursor,
+                'seed': self.seed,
+                'sort_by_input_length': self.sort_by_input_length,
+                'shuffle': self.shuffle,
+                'random_state': np.random.get_state()}
+
+    def state_dict(self):
+        """Return the iteration state to resume from the next mini-batch of the last returned one.
+           Mini-batches prefetched by workers are not regarded as consumed.
+
+        Returns:
+            state (dict):
+
+        """
+        state = dict(self.pending[0][2]) if len(self.pending) > 0 else self.sampler_state()
+        state['epoch'] = self.epoch
+        state['iteration'] = self.iteration
+        return state
+
+    def load_state_dict(self, state):
+        """Restore the iteration state saved by state_dict.
+           Worker processes are restarted so that they share the restored seed.
+
+        Args:
+            state (dict):
+
+        """
+        self.close()
+        self.reset()
+        self.epoch = state['epoch']
+        self.iteration = state['iteration']
+        self._epoch = state['_epoch']
+        self.offset = state['offset']
+        self.batch_cursor = state['batch_cursor']
+        self.seed = state['seed']
+        self.sort_by_input_length = state['sort_by_input_length']
+        self.shuffle = state['shuffle']
+        np.random.set_state(state['random_state'])
+        # NOTE: perm and batches are regenerated in sample_index for self._epoch
+
     def reset(self):
         self._reset()
 
-        self.queue = Queue()
-        self.queue_size = 0
-
-        # Clean up multiprocessing
-        if self.preloading_process is not None:
-            self.preloading_process.terminate()
-            self.preloading_process.join()
+        # Discard mini-batches prefetched before resetting
+        self.queue_generation += 1
+        self.pending.clear()
+        for batch in self.reorder_buffer.values():
+            self.release_buffer(batch.get('xs_buffer'))
+        self.reorder_buffer = {}
+        self.n_enqueued = 0
+        self.n_dequeued = 0
 
     def _reset(self):
         """Reset data counter and offset."""
-        self.rest = set(list(self.df.index))
+        self.perm = None
         self.offset = 0
+        self.batches = None
+        self.batch_cursor = 0
+
+    def start_workers(self):
+        """Start persistent processes to make mini-batches in parallel."""
+        self.index_queue = Queue()
+        self.data_queue = Queue(maxsize=self.n_ques)
+        self.buffer_queue = Queue()
+        self.workers = []
+        for _ in six.moves.range(self.n_workers):
+            worker = Process(target=self.worker_loop,
+                             args=(self.index_queue, self.data_queue, self.buffer_queue))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def worker_loop(self, index_queue, data_queue, buffer_queue):
+        """Make mini-batches until receiving None.
 
-    def preloading_loop(self, queue, df_indices_list):
-        """.
+        Args:
+            index_queue (Queue): (generation, sequence number, data_indices)
+            data_queue (Queue): (generation, sequence number, batch, error message)
+            buffer_queue (Queue): shared memory buffers which can be reused
+
+        """
+        while True:
+            job = index_queue.get()
+            if job is None:
+                break
+            generation, seq, data_indices = job
+            try:
+                batch = self.make_batch(data_indices)
+                if self.collate:
+                    batch = self.collate_batch(batch)
+                batch = self.share_batch(batch, buffer_queue)
+                data_queue.put((generation, seq, batch, None))
+            except Exception:
+                data_queue.put((generation, seq, None, traceback.format_exc()))
+
+    def dequeue(self, seq):
+        """Return the mini-batch of the sequence number seq in the sampled order.
 
         Args:
-            queue ():
-            df_indices_list (np.ndarray):
+            seq (int): sequence number of the mini-batch
+        Returns:
+            batch (dict):
 
         """
-        # print("Pre-loading started.")
-        for i in six.moves.range(len(df_indices_list)):
-            queue.put(self.make_batch(df_indices_list[i]))
-        # print("Pre-loading done.")
+        while seq not in self.reorder_buffer:
+            try:
+                generation, seq_i, batch, error = self.data_queue.get(timeout=10)
+            except queue.Empty:
+                if not all(w.is_alive() for w in self.workers):
+                    self.close()
+                    raise RuntimeError('A data loader worker died unexpectedly.')
+                continue
+            if error is not None:
+                self.close()
+                raise RuntimeError('Error in a data loader worker:\n' + error)
+            if generation == self.queue_generation:
+                self.reorder_buffer[seq_i] = batch
+            elif batch is not None:
+                self.release_buffer(batch.get('xs_buffer'))
+        return self.reorder_buffer.pop(seq)
+
+    @staticmethod
+    def collate_batch(batch):
+        """Pad input features and labels into tensors.
+
+        Args:
+            batch (dict):
+        Returns:
+            batch (dict):
+                xs (FloatTensor): `[B, T, input_dim]`, padded with 0
+                xlens (list): lengths of each element in xs
+                ys_pad (LongTensor): `[B, L]`, padded with -1. ys is kept as it is.
+                ys_sub*_pad (LongTensor): `[B, L_sub*]`, padded with -1
+
+        """
+        if len(batch.get('xs', [])) > 0 and isinstance(batch['xs'][0], np.ndarray):
+            xlens = [len(x) for x in batch['xs']]
+            xs_pad = np.zeros((len(xlens), max(xlens), batch['xs'][0].shape[-1]), dtype=np.float32)
+            for b, x in enumerate(batch['xs']):
+                xs_pad[b, :xlens[b]] = x
+            batch['xs'] = torch.from_numpy(xs_pad)
+            batch['xlens'] = xlens
+
+        for key in ['ys', 'ys_sub1', 'ys_sub2', 'ys_sub3']:
+            ys = batch.get(key, [])
+            if len(ys) == 0:
+                continue
+            ys_pad = np.full((len(ys), max(len(y) for y in ys)), -1, dtype=np.int64)
+            for b, y in enumerate(ys):
+                ys_pad[b, :len(y)] = y
+            batch[key + '_pad'] = torch.from_numpy(ys_pad)
+        return batch
+
+    @staticmethod
+    def pin_batch(batch):
+        """Copy padded tensors into page-locked memory for asynchronous transfer to GPUs."""
+        for key, value in batch.items():
+            if torch.is_tensor(value) and key != 'xs_buffer':
+                batch[key] = value.pin_memory()
+        return batch
+
+    @staticmethod
+    def share_batch(batch, buffer_queue):
+        """Copy input features into a single shared memory buffer (in worker processes).
+           Only the buffer handle and small metadata are sent to the main process.
+
+        Args:
+            batch (dict):
+            buffer_queue (Queue): shared memory buffers which can be reused
+        Returns:
+            batch (dict): `xs` is replaced with shapes of each utterance
+                (or the shape of the padded tensor), and `xs_buffer` is a 1d FloatTensor in shared memory
+
+        """
+        xs = batch.get('xs', [])
+        if torch.is_tensor(xs):
+            n_elements = xs.numel()
+        elif len(xs) > 0 and isinstance(xs[0], np.ndarray):
+            n_elements = sum(x.size for x in xs)
+        else:
+            return batch
+
+        try:
+            buffer = buffer_queue.get_nowait()
+        except queue.Empty:
+            buffer = None
+        if buffer is None or buffer.numel() < n_elements:
+            # NOTE: allocate with margin to reduce re-allocation
+            buffer = torch.empty(int(n_elements * 1.25), dtype=torch.float32).share_memory_()
+
+        if torch.is_tensor(xs):
+            buffer[:n_elements].view_as(xs).copy_(xs)
+            batch['xs'] = xs.size()
+        else:
+            buffer_np = buffer.numpy()
+            offset = 0
+            for x in xs:
+                buffer_np[offset:offset + x.size] = x.reshape(-1)
+                offset += x.size
+            batch['xs'] = [x.shape for x in xs]
+        batch['xs_buffer'] = buffer
+        return batch
+
+    @staticmethod
+    def unshare_batch(batch):
+        """Restore input features as views of the shared memory buffer.
+
+        Args:
+            batch (dict):
+        Returns:
+            batch (dict):
+            buffer (FloatTensor): shared memory buffer, which must be released
+                after the mini-batch is consumed
+
+        """
+        buffer = batch.pop('xs_buffer', None)
+        if buffer is None:
+            return batch, None
+
+        if isinstance(batch['xs'], torch.Size):
+            # padded tensor
+            batch['xs'] = buffer[:int(np.prod(batch['xs']))].view(batch['xs'])
+            return batch, buffer
+
+        buffer_np = buffer.numpy()
+        xs = []
+        offset = 0
+        for shape in batch['xs']:
+            n_elements = int(np.prod(shape))
+            xs.append(buffer_np[offset:offset + n_elements].reshape(shape))
+            offset += n_elements
+        batch['xs'] = xs
+        return batch, buffer
+
+    def release_buffer(self, buffer):
+        """Return a shared memory buffer to the pool for reuse."""
+        if buffer is not None and self.buffer_queue is not None:
+            self.buffer_queue.put(buffer)
+
+    def close(self):
+        """Shut down worker processes and release shared memory buffers.
+           This is called at the end of the last epoch, and must be called when
+           the iteration is stopped earlier (e.g., early stopping).
+        """
+        if len(self.workers) == 0:
+            return
+        for _ in self.workers:
+            self.index_queue.put(None)
+        # Drain the data queue so that workers blocked on put() can exit
+        deadline = time.time() + 5
+        while any(w.is_alive() for w in self.workers) and time.time() < deadline:
+            try:
+                self.data_queue.get(timeout=0.1)
+            except Exception:
+                # NOTE: queue.Empty, or shared memory of exited workers cannot be received
+                pass
+        for w in self.workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+                w.join()
+        # Release shared memory buffers pooled in the main process
+        while True:
+            try:
+                self.buffer_queue.get(timeout=0.1)
+            except Exception:
+                break
+        # NOTE: wait for the feeder threads of queues so that they are not forked
+        # in the middle of pickling by worker processes started later
+        for q in [self.index_queue, self.data_queue, self.buffer_queue]:
+            q.close()
+            q.join_thread()
+        self.workers = []
+        self.index_queue = None
+        self.data_queue = None
+        self.buffer_queue = None
+        self.buffer_in_use = None
+        self.pending.clear()
+        self.reorder_buffer = {}
+        self.n_enqueued = 0
+        self.n_dequeued = 0
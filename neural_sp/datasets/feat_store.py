@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Read acoustic features from Kaldi ark files or a memory-mapped feature store.
+
+   A feature store is a single `.npy` file of size `[total_n_frames, xdim]`
+   made by utils/make_feat_store.py. Each utterance is referred by
+   `path/to/feats.npy:begin:end` in the feat_path column of the tsv file.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from utils import kaldi_io
+
+# path to the feature store -> np.memmap (opened once per process)
+_stores = {}
+
+
+def is_feat_store(feat_path):
+    return '.npy:' in feat_path
+
+
+def open_feat_store(path):
+    """Open a feature store as a read-only memory map.
+
+    Args:
+        path (str): path to the `.npy` file
+    Returns:
+        store (np.memmap): `[total_n_frames, xdim]`
+
+    """
+    if path not in _stores:
+        _stores[path] = np.load(path, mmap_mode='r')
+    return _stores[path]
+
+
+def read_feat(feat_path):
+    """Read features of an utterance.
+
+    Args:
+        feat_path (str): `path/to/feats.ark:offset` or `path/to/feats.npy:begin:end`
+    Returns:
+        feat (np.ndarray): `[T, xdim]`. Utterances in the feature store are returned as views
+            of the memory map (no copy), whose dtype is float32 or float16.
+
+    """
+    if is_feat_store(feat_path):
+        path, begin, end = feat_path.rsplit(':', 2)
+        return open_feat_store(path)[int(begin):int(end)]
+    return kaldi_io.read_mat(feat_path)
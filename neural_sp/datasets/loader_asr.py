@@ -13,11 +13,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import numpy as np
 import os
 import pandas as pd
 
 from neural_sp.datasets.base import Base
+from neural_sp.datasets.feat_store import read_feat
+from neural_sp.datasets.ragged import RaggedArray
 from neural_sp.datasets.token_converter.character import Char2idx
 from neural_sp.datasets.token_converter.character import Idx2char
 from neural_sp.datasets.token_converter.phone import Idx2phone
@@ -26,19 +29,21 @@ from neural_sp.datasets.token_converter.word import Idx2word
 from neural_sp.datasets.token_converter.word import Word2idx
 from neural_sp.datasets.token_converter.wordpiece import Idx2wp
 from neural_sp.datasets.token_converter.wordpiece import Wp2idx
-from utils import kaldi_io
 
 np.random.seed(1)
 
 
 class Dataset(Base):
 
+    # NOTE: increment when the format of the cache is changed
+    cache_version = 1
+
     def __init__(self, tsv_path, dict_path,
                  unit, batch_size, nlsyms=False, n_epochs=None,
                  is_test=False, min_n_frames=40, max_n_frames=2000,
                  shuffle=False, sort_by_input_length=False,
                  short2long=False, sort_stop_epoch=None,
-                 n_ques=None, dynamic_batching=False,
+                 n_ques=None, n_workers=1, dynamic_batching=False,
                  ctc=False, subsample_factor=1,
                  wp_model=False, corpus='',
                  concat_prev_n_utterances=0, n_caches=0,
@@ -50,7 +55,10 @@ class Dataset(Base):
                  ctc_sub2=False, subsample_factor_sub2=1,
                  wp_model_sub3=False,
                  tsv_path_sub3=False, dict_path_sub3=False, unit_sub3=False,
-                 ctc_sub3=False, subsample_factor_sub3=1):
+                 ctc_sub3=False, subsample_factor_sub3=1,
+                 use_cache=True, cache_dir=None, collate=False,
+                 max_n_frames_batch=0, max_n_tokens_batch=0, count_padding=True,
+                 rank=0, world_size=1):
         """A class for loading dataset.
 
         Args:
@@ -69,7 +77,9 @@ class Dataset(Base):
             short2long (bool): sort utterances in the descending order
             sort_stop_epoch (int): After sort_stop_epoch, training will revert
                 back to a random order
-            n_ques (int): number of elements to enqueue
+            n_ques (int): number of mini-batches to prefetch with worker processes.
+                None means that mini-batches are made in the main process.
+            n_workers (int): number of worker processes for prefetching
             dynamic_batching (bool): change batch size dynamically in training
             ctc (bool):
             subsample_factor (int):
@@ -77,6 +87,21 @@ class Dataset(Base):
             corpus (str): name of corpus
             concat_prev_n_utterances (int): number of utterances to concatenate
             n_caches (int): number of previous tokens for cache (for training)
+            use_cache (bool): save the filtered tsv records as a binary file
+                and reuse it in the next construction
+            cache_dir (str): directory to save the cache.
+                The `.cache` directory next to tsv_path is used by default.
+            collate (bool): pad input features and labels into tensors in the data loader
+                (in pinned memory when GPUs are available). Labels are kept as lists as well.
+            max_n_frames_batch (int): maximum total number of input frames in a mini-batch.
+                If this or max_n_tokens_batch is positive, utterances of similar lengths are packed
+                into mini-batches under the budget and batch_size and dynamic_batching are ignored.
+            max_n_tokens_batch (int): maximum total number of output tokens in a mini-batch
+            count_padding (bool): include padding in the total number of frames (tokens)
+            rank (int): index of this process in distributed training
+            world_size (int): number of processes in distributed training.
+                Each process reads a disjoint part of global mini-batches of batch_size * world_size
+                utterances (or one of world_size consecutive mini-batches under the frame/token budget).
 
         """
         super(Dataset, self).__init__()
@@ -91,11 +116,19 @@ class Dataset(Base):
         self.sort_stop_epoch = sort_stop_epoch
         self.sort_by_input_length = sort_by_input_length
         self.n_ques = n_ques
+        self.n_workers = n_workers
+        self.collate = collate
+        self.max_n_frames_batch = max_n_frames_batch
+        self.max_n_tokens_batch = max_n_tokens_batch
+        self.count_padding = count_padding
+        self.rank = rank
+        self.world_size = world_size
         self.dynamic_batching = dynamic_batching
         self.corpus = corpus
         self.concat_prev_n_utterances = concat_prev_n_utterances
         self.n_caches = n_caches
         self.vocab = self.count_vocab_size(dict_path)
+        self.pad_xlen = 20
 
         self.eos = 2
         self.pad = 3
@@ -144,113 +177,243 @@ class Dataset(Base):
                 setattr(self, 'vocab_sub' + str(i), -1)
 
         # Load dataset tsv file
-        self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
-        self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
-                                  'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
+        tsv_path_subs = [tsv_path_sub1, tsv_path_sub2, tsv_path_sub3]
+        ctc_subs = [ctc_sub1, ctc_sub2, ctc_sub3]
+        subsample_factor_subs = [subsample_factor_sub1, subsample_factor_sub2, subsample_factor_sub3]
+        cache_path = None
+        if use_cache:
+            cache_path = self.cache_path(
+                cache_dir if cache_dir else os.path.join(os.path.dirname(tsv_path), '.cache'),
+                tsv_path, tsv_path_subs,
+                is_test=is_test, min_n_frames=min_n_frames, max_n_frames=max_n_frames,
+                ctc=ctc, subsample_factor=subsample_factor,
+                ctc_subs=ctc_subs, subsample_factor_subs=subsample_factor_subs,
+                corpus=corpus, concat_prev_n_utterances=concat_prev_n_utterances, n_caches=n_caches)
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            cache = pd.read_pickle(cache_path)
+            print('Loaded %d utterances from the cache: %s' % (len(cache['df']), cache_path))
+        else:
+            cache = self.load_tsv(tsv_path, tsv_path_subs, is_test, min_n_frames, max_n_frames,
+                                  ctc, subsample_factor, ctc_subs, subsample_factor_subs,
+                                  corpus, concat_prev_n_utterances, n_caches)
+            if cache_path is not None:
+                try:
+                    if not os.path.isdir(os.path.dirname(cache_path)):
+                        os.makedirs(os.path.dirname(cache_path))
+                    pd.to_pickle(cache, cache_path)
+                except (IOError, OSError):
+                    print('Failed to save the cache: %s' % cache_path)
+        self.df = cache['df']
+        self.df_ctx = cache['df_ctx']
+        self.token_ids = cache['token_ids']
+        self.token_ids_ctx = cache['token_ids_ctx']
+        self.token_ids_ctx_sub1 = cache['token_ids_ctx_sub1']
         for i in range(1, 4):
-            if locals()['tsv_path_sub' + str(i)]:
-                df_sub = pd.read_csv(locals()['tsv_path_sub' + str(i)], encoding='utf-8', delimiter='\t')
-                df_sub = df_sub.loc[:, ['utt_id', 'speaker', 'feat_path',
-                                        'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
-                setattr(self, 'df_sub' + str(i), df_sub)
+            setattr(self, 'df_sub' + str(i), cache['df_sub' + str(i)])
+            setattr(self, 'token_ids_sub' + str(i), cache['token_ids_sub' + str(i)])
+
+        # Sort tsv records
+        if not is_test:
+            if sort_by_input_length:
+                self.df = self.df.sort_values(by='xlen', ascending=short2long)
+            elif shuffle:
+                self.df = self.df.reindex(self.epoch_rng(-1).permutation(self.df.index))
+
+        self._reset()
+        self.input_dim = read_feat(self.df['feat_path'].iloc[0]).shape[-1]
+
+    @staticmethod
+    def cache_path(cache_dir, tsv_path, tsv_path_subs, **kwargs):
+        """Return path to the cache of the filtered tsv records.
+
+        Args:
+            cache_dir (str): directory to save the cache
+            tsv_path (str): path to the dataset tsv file
+            tsv_path_subs (list): paths to the dataset tsv files for the auxiliary tasks
+            kwargs: filtering parameters
+        Returns:
+            cache_path (str):
+
+        """
+        key = [Dataset.cache_version]
+        for path in [tsv_path] + tsv_path_subs:
+            if path:
+                key += [os.path.abspath(path), os.path.getmtime(path)]
+            else:
+                key += [path, None]
+        key += sorted(kwargs.items())
+        md5 = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir, os.path.basename(tsv_path).split('.')[0] + '.' + md5 + '.pkl')
+
+    def load_tsv(self, tsv_path, tsv_path_subs, is_test, min_n_frames, max_n_frames,
+                 ctc, subsample_factor, ctc_subs, subsample_factor_subs,
+                 corpus, concat_prev_n_utterances, n_caches):
+        """Load tsv files and remove inappropriate utterances.
+
+        Returns:
+            cache (dict):
+                df (pd.DataFrame): tsv records for the main task
+                df_sub1 (pd.DataFrame): tsv records for the 1st auxiliary task
+                df_sub2 (pd.DataFrame): tsv records for the 2nd auxiliary task
+                df_sub3 (pd.DataFrame): tsv records for the 3rd auxiliary task
+                df_ctx (pd.DataFrame): tsv records of all utterances in the onset order,
+                    which are referred by `prev_begin` and `prev_end`
+                token_ids (RaggedArray): token indices for the main task
+                token_ids_sub1 (RaggedArray): token indices for the 1st auxiliary task
+                token_ids_sub2 (RaggedArray): token indices for the 2nd auxiliary task
+                token_ids_sub3 (RaggedArray): token indices for the 3rd auxiliary task
+                token_ids_ctx (RaggedArray): token indices of df_ctx for the main task
+                token_ids_ctx_sub1 (RaggedArray): token indices of df_ctx for the 1st auxiliary task
+
+        """
+        columns = ['utt_id', 'speaker', 'feat_path', 'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']
+        df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
+        df = df.loc[:, columns]
+        df_subs = []
+        for tsv_path_sub in tsv_path_subs:
+            if tsv_path_sub:
+                df_sub = pd.read_csv(tsv_path_sub, encoding='utf-8', delimiter='\t')
+                df_subs.append(df_sub.loc[:, columns])
             else:
-                setattr(self, 'df_sub' + str(i), None)
+                df_subs.append(None)
 
         if corpus == 'swbd':
-            self.df['session'] = self.df['speaker'].apply(lambda x: str(x).split('-')[0])
+            df['session'] = df['speaker'].astype(str).str.split('-').str[0]
         else:
-            self.df['session'] = self.df['speaker'].apply(lambda x: str(x))
+            df['session'] = df['speaker'].astype(str)
 
+        df_ctx = None
         if concat_prev_n_utterances > 0 or n_caches > 0:
             max_n_frames = 10000
             min_n_frames = 1
 
             # Sort by onset
-            self.df = self.df.assign(prev_utt='')
             if corpus == 'swbd':
-                self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
+                df['onset'] = df['utt_id'].str.split('_').str[-1].str.split('-').str[0].astype(int)
             elif corpus == 'csj':
-                self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[1]))
+                df['onset'] = df['utt_id'].str.split('_').str[1].astype(int)
             else:
                 raise NotImplementedError
-            self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
+            df = df.sort_values(by=['session', 'onset'], ascending=True)
 
             # Extract previous utterances
             if not (is_test and n_caches > 0):
-                self.df = self.df.assign(line_no=list(range(len(self.df))))
-                groups = self.df.groupby('session').groups  # dict
-                self.df['prev_utt'] = self.df.apply(
-                    lambda x: [self.df.loc[i, 'line_no']
-                               for i in groups[x['session']] if self.df.loc[i, 'onset'] < x['onset']], axis=1)
+                df = self.index_prev_utterances(df, concat_prev_n_utterances)
+
+                # Keep all utterances for context even if they are removed below
+                df_ctx = df.loc[:, ['feat_path', 'xlen', 'token_id']].reset_index(drop=True)
+                if df_subs[0] is not None:
+                    df_ctx['token_id_sub1'] = df_subs[0]['token_id'].reindex(df.index).values
         elif is_test and corpus == 'swbd':
             # Sort by onset
-            self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
-            self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
+            df['onset'] = df['utt_id'].str.split('_').str[-1].str.split('-').str[0].astype(int)
+            df = df.sort_values(by=['session', 'onset'], ascending=True)
 
         if concat_prev_n_utterances > 0:
             assert n_caches == 0
-            self.pad_xlen = 20
-
-            # Truncate history
-            self.df['prev_utt'] = self.df['prev_utt'].apply(lambda x: x[-concat_prev_n_utterances:])
 
-            # Update xlen, ylen, text
-            self.pad_xlen = 20
-            self.df['xlen'] = self.df.apply(
-                lambda x: sum([self.df.loc[i, 'xlen'] + self.pad_xlen
-                               for i in x['prev_utt']] + [x['xlen']]) if len(x['prev_utt']) > 0 else x['xlen'], axis=1)
-            # self.df['text'] = self.df.apply(
-            #     lambda x: ' '.join([self.df.loc[i, 'text']
-            #                         for i in x['prev_utt']] + [x['text']]) if len(x['prev_utt']) > 0 else x['text'], axis=1)
+            # Update xlen
+            xlen_cumsum = np.concatenate([[0], np.cumsum(df['xlen'].values + self.pad_xlen)])
+            df['xlen'] = df['xlen'].values + xlen_cumsum[df['prev_end'].values] - \
+                xlen_cumsum[df['prev_begin'].values]
 
         if n_caches > 0:
             assert concat_prev_n_utterances == 0
 
         # Remove inappropriate utterances
+        print('Original utterance num: %d' % len(df))
+        n_utts = len(df)
         if is_test:
-            print('Original utterance num: %d' % len(self.df))
-            n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
-            print('Removed %d empty utterances' % (n_utts - len(self.df)))
+            df = df[df['ylen'] > 0]
+            print('Removed %d empty utterances' % (n_utts - len(df)))
         else:
-            print('Original utterance num: %d' % len(self.df))
-            n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: min_n_frames <= x[
-                                            'xlen'] <= max_n_frames, axis=1)]
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
-            print('Removed %d utterances (threshold)' % (n_utts - len(self.df)))
+            df = df[(df['xlen'] >= min_n_frames) & (df['xlen'] <= max_n_frames) & (df['ylen'] > 0)]
+            print('Removed %d utterances (threshold)' % (n_utts - len(df)))
 
             if ctc and subsample_factor > 1:
-                n_utts = len(self.df)
-                self.df = self.df[self.df.apply(lambda x: x['ylen'] <= (x['xlen'] // subsample_factor), axis=1)]
-                print('Removed %d utterances (for CTC)' % (n_utts - len(self.df)))
-
-            for i in range(1, 4):
-                df_sub = getattr(self, 'df_sub' + str(i))
-                ctc_sub = locals()['ctc_sub' + str(i)]
-                subsample_factor_sub = locals()['subsample_factor_sub' + str(i)]
-                if df_sub is not None:
-                    if ctc_sub and subsample_factor_sub > 1:
-                        df_sub = df_sub[df_sub.apply(
-                            lambda x: x['ylen'] <= (x['xlen'] // subsample_factor_sub), axis=1)]
-
-                    if len(self.df) != len(df_sub):
-                        n_utts = len(self.df)
-                        self.df = self.df.drop(self.df.index.difference(df_sub.index))
-                        print('Removed %d utterances (for CTC, sub%d)' % (n_utts - len(self.df), i))
-                        for j in range(1, i + 1):
-                            setattr(self, 'df_sub' + str(j),
-                                    getattr(self, 'df_sub' + str(j)).drop(getattr(self, 'df_sub' + str(j)).index.difference(self.df.index)))
+                n_utts = len(df)
+                df = df[df['ylen'] <= (df['xlen'] // subsample_factor)]
+                print('Removed %d utterances (for CTC)' % (n_utts - len(df)))
+
+            for i, df_sub in enumerate(df_subs):
+                if df_sub is None:
+                    continue
+                if ctc_subs[i] and subsample_factor_subs[i] > 1:
+                    df_sub = df_sub[df_sub['ylen'] <= (df_sub['xlen'] // subsample_factor_subs[i])]
+
+                if len(df) != len(df_sub):
+                    n_utts = len(df)
+                    df = df[df.index.isin(df_sub.index)]
+                    print('Removed %d utterances (for CTC, sub%d)' % (n_utts - len(df), i + 1))
+                    for j in range(i + 1):
+                        df_subs[j] = df_subs[j][df_subs[j].index.isin(df.index)]
+
+        # Parse token indices only once
+        cache = {}
+        cache['df'], cache['token_ids'] = self.parse_token_ids(df)
+        for i, df_sub in enumerate(df_subs):
+            cache['df_sub' + str(i + 1)], cache['token_ids_sub' + str(i + 1)] = self.parse_token_ids(df_sub)
+        cache['df_ctx'], cache['token_ids_ctx'] = self.parse_token_ids(df_ctx)
+        cache['token_ids_ctx_sub1'] = None
+        if df_ctx is not None and 'token_id_sub1' in df_ctx.columns:
+            cache['token_ids_ctx_sub1'] = RaggedArray.from_strings(df_ctx['token_id_sub1'].values)
+            cache['df_ctx'] = cache['df_ctx'].drop(columns='token_id_sub1')
+        return cache
+
+    @staticmethod
+    def parse_token_ids(df):
+        """Move token indices from strings in the tsv records to a ragged array.
 
-        # Sort tsv records
-        if not is_test:
-            if sort_by_input_length:
-                self.df = self.df.sort_values(by='xlen', ascending=short2long)
-            elif shuffle:
-                self.df = self.df.reindex(np.random.permutation(self.df.index))
+        Args:
+            df (pd.DataFrame): tsv records
+        Returns:
+            df (pd.DataFrame): tsv records without `token_id`.
+                `token_idx` points to the sequence in token_ids.
+            token_ids (RaggedArray):
+
+        """
+        if df is None:
+            return None, None
+        token_ids = RaggedArray.from_strings(df['token_id'].values)
+        df = df.drop(columns='token_id').assign(token_idx=np.arange(len(df), dtype=np.int32))
+        return df, token_ids
 
-        self.rest = set(list(self.df.index))
-        self.input_dim = kaldi_io.read_mat(self.df['feat_path'][0]).shape[-1]
+    @staticmethod
+    def index_prev_utterances(df, n_utterances=0):
+        """Index previous utterances in the same session in linear time.
+
+        Args:
+            df (pd.DataFrame): tsv records sorted by session and onset
+            n_utterances (int): number of previous utterances to keep.
+                0 means all previous utterances in the session.
+        Returns:
+            df (pd.DataFrame): tsv records with `line_no`, `prev_begin` and `prev_end`.
+                Previous utterances of each record are `line_no` in [prev_begin, prev_end).
+
+        """
+        line_no = np.arange(len(df), dtype=np.int32)
+        # the first line in the same session
+        session_begin = line_no - df.groupby('session', sort=False).cumcount().values.astype(np.int32)
+        # exclude utterances having the same onset
+        prev_end = line_no - df.groupby(['session', 'onset'], sort=False).cumcount().values.astype(np.int32)
+        prev_begin = session_begin
+        if n_utterances > 0:
+            prev_begin = np.maximum(session_begin, prev_end - n_utterances)
+        return df.assign(line_no=line_no, prev_begin=prev_begin, prev_end=prev_end)
+
+    def prev_utterances(self, i):
+        """Return line numbers of previous utterances in `df_ctx`.
+
+        Args:
+            i (int): index of the tsv record
+        Returns:
+            line_nos (range): in the onset order
+
+        """
+        if self.df_ctx is None:
+            return range(0)
+        return range(self.df['prev_begin'][i], self.df['prev_end'][i])
 
     def make_batch(self, df_indices):
         """Create mini-batch per step.
@@ -271,47 +434,50 @@ class Dataset(Base):
 
         """
         # inputs
-        xs = [kaldi_io.read_mat(self.df['feat_path'][i]) for i in df_indices]
+        xs = [read_feat(self.df['feat_path'][i]) for i in df_indices]
         if self.concat_prev_n_utterances > 0:
             for j, i in enumerate(df_indices):
-                for idx in self.df['prev_utt'][i][::-1]:
-                    x_prev = kaldi_io.read_mat(self.df['feat_path'][idx])
+                for idx in self.prev_utterances(i)[::-1]:
+                    x_prev = read_feat(self.df_ctx['feat_path'][idx])
                     xs[j] = np.concatenate(
                         [x_prev, np.zeros((self.pad_xlen, self.input_dim), dtype=np.float32), xs[j]], axis=0)
 
         # outputs
-        ys = [list(map(int, str(self.df['token_id'][i]).split())) for i in df_indices]
+        ys = [self.token_ids[k].tolist() for k in self.df.loc[df_indices, 'token_idx'].values]
         if self.concat_prev_n_utterances > 0:
             for j, i in enumerate(df_indices):
-                for idx in self.df['prev_utt'][i][::-1]:
-                    y_prev = list(map(int, str(self.df['token_id'][idx]).split()))
+                for idx in self.prev_utterances(i)[::-1]:
+                    y_prev = self.token_ids_ctx[idx].tolist()
                     ys[j] = y_prev + [self.eos] + ys[j][:]
 
         ys_cache = []
         if self.n_caches > 0:
             ys_cache = [[] for _ in range(len(df_indices))]
             for j, i in enumerate(df_indices):
-                for idx in self.df['prev_utt'][i]:
-                    y_prev = list(map(int, str(self.df['token_id'][idx]).split()))
-                    ys_cache[j] += [self.eos] + y_prev
+                # Read previous utterances backward until the cache is filled
+                for idx in self.prev_utterances(i)[::-1]:
+                    if len(ys_cache[j]) >= self.n_caches:
+                        break
+                    y_prev = self.token_ids_ctx[idx].tolist()
+                    ys_cache[j] = [self.eos] + y_prev + ys_cache[j]
 
             # Truencate
             ys_cache = [y[-self.n_caches:] for y in ys_cache]
 
         ys_sub1 = []
         if self.df_sub1 is not None:
-            ys_sub1 = [list(map(int, self.df_sub1['token_id'][i].split())) for i in df_indices]
+            ys_sub1 = [self.token_ids_sub1[k].tolist() for k in self.df_sub1.loc[df_indices, 'token_idx'].values]
             if self.concat_prev_n_utterances > 0:
                 for j, i in enumerate(df_indices):
-                    for idx in self.df['prev_utt'][i][::-1]:
-                        y_prev = list(map(int, str(self.df_sub1['token_id'][idx]).split()))
+                    for idx in self.prev_utterances(i)[::-1]:
+                        y_prev = self.token_ids_ctx_sub1[idx].tolist()
                         ys_sub1[j] = y_prev + [self.eos] + ys_sub1[j][:]
         elif self.vocab_sub1 > 0:
             ys_sub1 = [self.token2idx[1](self.df['text'][i]) for i in df_indices]
 
         ys_sub2 = []
         if self.df_sub2 is not None:
-            ys_sub2 = [list(map(int, self.df_sub2['token_id'][i].split())) for i in df_indices]
+            ys_sub2 = [self.token_ids_sub2[k].tolist() for k in self.df_sub2.loc[df_indices, 'token_idx'].values]
             if self.concat_prev_n_utterances > 0:
                 raise NotImplementedError
         elif self.vocab_sub2 > 0:
@@ -319,7 +485,7 @@ class Dataset(Base):
 
         ys_sub3 = []
         if self.df_sub3 is not None:
-            ys_sub3 = [list(map(int, self.df_sub3['token_id'][i].split())) for i in df_indices]
+            ys_sub3 = [self.token_ids_sub3[k].tolist() for k in self.df_sub3.loc[df_indices, 'token_idx'].values]
             if self.concat_prev_n_utterances > 0:
                 raise NotImplementedError
         elif self.vocab_sub3 > 0:
@@ -19,6 +19,8 @@ import random
 import os
 
 from neural_sp.datasets.base import Base
+from neural_sp.datasets.ragged import ConcatView
+from neural_sp.datasets.ragged import RaggedArray
 from neural_sp.datasets.token_converter.character import Char2idx
 from neural_sp.datasets.token_converter.character import Idx2char
 from neural_sp.datasets.token_converter.phone import Idx2phone
@@ -38,11 +40,13 @@ class Dataset(Base):
                  unit, batch_size, nlsyms=False, n_epochs=None,
                  is_test=False, min_n_tokens=1, bptt=2,
                  shuffle=False, backward=False, serialize=False,
-                 wp_model=None, corpus=''):
+                 wp_model=None, corpus='', n_ques=None, n_workers=1,
+                 rank=0, world_size=1):
         """A class for loading dataset.
 
         Args:
-            tsv_path (str): path to the dataset tsv file
+            tsv_path (str): path to the dataset tsv file,
+                or the token store (.npy) made by utils/make_token_store.py
             dict_path (str): path to the dictionary
             unit (str): word or wp or char or phone or word_char
             batch_size (int): size of mini-batch
@@ -57,7 +61,13 @@ class Dataset(Base):
             serialize (bool): serialize text according to contexts in dialogue
             wp_model (): path to the word-piece model for sentencepiece
             corpus (str): name of corpus
-
+            n_ques (int): number of mini-batches to prefetch with worker processes.
+                None means that mini-batches are made in the main process.
+            n_workers (int): number of worker processes for prefetching
+            rank (int): index of this process in distributed training
+            world_size (int): number of processes in distributed training.
+                The concatenated corpus is split into batch_size * world_size streams
+                and each process reads batch_size streams of them.
 
         """
         super(Dataset, self).__init__()
@@ -71,6 +81,10 @@ class Dataset(Base):
         self.eos = 2
         self.max_epoch = n_epochs
         self.shuffle = shuffle
+        self.n_ques = n_ques
+        self.n_workers = n_workers
+        self.rank = rank
+        self.world_size = world_size
         self.vocab = self.count_vocab_size(dict_path)
         assert bptt >= 2
 
@@ -93,58 +107,97 @@ class Dataset(Base):
         else:
             raise ValueError(unit)
 
-        # Load dataset tsv file
-        self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
-        self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
-                                  'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
-
-        # Remove inappropriate utterances
-        if is_test:
-            print('Original utterance num: %d' % len(self.df))
-            n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
-            print('Removed %d empty utterances' % (n_utts - len(self.df)))
-        else:
-            print('Original utterance num: %d' % len(self.df))
-            n_utts = len(self.df)
-            self.df = self.df[self.df.apply(lambda x: x['ylen'] >= min_n_tokens, axis=1)]
-            print('Removed %d utterances (threshold)' % (n_utts - len(self.df)))
-
-        # Sort tsv records
-        if shuffle:
-            self.df = self.df.reindex(np.random.permutation(self.df.index))
-        elif serialize:
-            assert corpus == 'swbd'
-            self.df['session'] = self.df['speaker'].apply(lambda x: str(x).split('-')[0])
-            self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
-            self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
+        if tsv_path.endswith('.npy'):
+            # Load the token store made by utils/make_token_store.py
+            self.df = None
+            self.token_ids = RaggedArray.from_store(tsv_path)
+            ylens = self.token_ids.lengths
+            print('Original utterance num: %d' % len(ylens))
+            if is_test:
+                indices = np.where(ylens > 0)[0]
+                print('Removed %d empty utterances' % (len(ylens) - len(indices)))
+            else:
+                indices = np.where(ylens >= min_n_tokens)[0]
+                print('Removed %d utterances (threshold)' % (len(ylens) - len(indices)))
+
+            # NOTE: utterances are kept in the order of the token store unless shuffled
+            if shuffle:
+                indices = self.epoch_rng(-1).permutation(indices)
+            elif serialize:
+                raise NotImplementedError
         else:
-            self.df = self.df.sort_values(by='utt_id', ascending=True)
+            # Load dataset tsv file
+            self.df = pd.read_csv(tsv_path, encoding='utf-8', delimiter='\t')
+            self.df = self.df.loc[:, ['utt_id', 'speaker', 'feat_path',
+                                      'xlen', 'xdim', 'text', 'token_id', 'ylen', 'ydim']]
+
+            # Remove inappropriate utterances
+            if is_test:
+                print('Original utterance num: %d' % len(self.df))
+                n_utts = len(self.df)
+                self.df = self.df[self.df.apply(lambda x: x['ylen'] > 0, axis=1)]
+                print('Removed %d empty utterances' % (n_utts - len(self.df)))
+            else:
+                print('Original utterance num: %d' % len(self.df))
+                n_utts = len(self.df)
+                self.df = self.df[self.df.apply(lambda x: x['ylen'] >= min_n_tokens, axis=1)]
+                print('Removed %d utterances (threshold)' % (n_utts - len(self.df)))
+
+            # Sort tsv records
+            if shuffle:
+                self.df = self.df.reindex(self.epoch_rng(-1).permutation(self.df.index))
+            elif serialize:
+                assert corpus == 'swbd'
+                self.df['session'] = self.df['speaker'].apply(lambda x: str(x).split('-')[0])
+                self.df['onset'] = self.df['utt_id'].apply(lambda x: int(x.split('_')[-1].split('-')[0]))
+                self.df = self.df.sort_values(by=['session', 'onset'], ascending=True)
+            else:
+                self.df = self.df.sort_values(by='utt_id', ascending=True)
+
+            # Parse token indices only once
+            self.token_ids = RaggedArray.from_strings(self.df['token_id'].values)
+            self.df = self.df.drop(columns='token_id')
+            indices = np.arange(len(self.df))
+        self.utt_indices = np.sort(indices)
 
         # Concatenate into a single sentence
-        concat_ids = []
-        indices = list(self.df.index)
         if backward:
             indices = indices[::-1]
-        for i in indices:
-            assert self.df['token_id'][i] != ''
-            concat_ids += [self.eos] + list(map(int, self.df['token_id'][i].split()))
-        concat_ids += [self.eos]
+        self.n_rows = batch_size
+        self.initial_order = indices
+        self.order_epoch = 0
+        self.set_order(indices)
         # NOTE: <sos> and <eos> have the same index
+        print('Removed %d tokens / %d tokens' % (len(self.stream) - len(self), len(self.stream)))
 
-        # Reshape
-        n_utts = len(concat_ids)
-        concat_ids = concat_ids[:n_utts // batch_size * batch_size]
-        print('Removed %d tokens / %d tokens' % (n_utts - len(concat_ids), n_utts))
-        self.concat_ids = np.array(concat_ids).reshape((batch_size, -1))
+    def set_order(self, indices):
+        """Concatenate utterances in this order into a single sentence.
+           Tokens are gathered from token_ids at each step, so the order can be
+           changed without re-parsing or copying the corpus.
+
+        Args:
+            indices (np.ndarray): indices of utterances in token_ids
+
+        """
+        self.order = indices
+        self.stream = ConcatView(self.token_ids, indices, self.eos)
+
+    def epoch_order(self, epoch):
+        """Return the order of utterances to concatenate in the epoch.
+           Utterances are shuffled from the 2nd epoch when shuffle is True.
+        """
+        if not self.shuffle or epoch == 0:
+            return self.initial_order
+        return self.epoch_rng(epoch).permutation(self.utt_indices)
 
     def __len__(self):
-        return len(self.concat_ids.reshape((-1,)))
+        n_rows = self.n_rows * self.world_size
+        return len(self.stream) // n_rows * n_rows
 
     @property
     def epoch_detail(self):
         # Floating point version of epoch
-        return self.epoch + (float(self.offset * self.batch_size) / len(self))
+        return self.epoch + (float(self.offset * self.n_rows * self.world_size) / len(self))
 
     def __next__(self, batch_size=None):
         """Generate each mini-batch.
@@ -152,48 +205,96 @@ class Dataset(Base):
         Args:
             batch_size (int): the size of mini-batch
         Returns:
-            batch (dict):
-                ys (list): target labels in the main task of size `[B, L]`
-                ylens (list):
-                utt_ids (list): file names of input data of size `[B]`
+            ys (np.ndarray): target labels in the main task of size `[B, bptt]`
             is_new_epoch (bool): If true, 1 epoch is finished
 
         """
-        is_new_epoch = False
-
-        if batch_size is None:
-            batch_size = self.batch_size
-        elif self.concat_ids.shape[0] != batch_size:
-            self.concat_ids = self.concat_ids.reshape((batch_size, -1))
+        if batch_size is not None:
+            self.n_rows = batch_size
 
         if self.max_epoch is not None and self.epoch >= self.max_epoch:
+            self.close()
             raise StopIteration()
         # NOTE: max_epoch == None means infinite loop
 
-        ys = self.concat_ids[:, self.offset:self.offset + self.bptt]
+        _, batch, is_new_epoch = self.fetch_batch(self.n_rows)
+        if is_new_epoch:
+            self.epoch += 1
+
+        return batch['ys'], is_new_epoch
+
+    def sample_index(self, batch_size):
+        """Sample the position of mini-batch in the single sentence.
+
+        Args:
+            batch_size (int): the size of mini-batch
+        Returns:
+            data_indices (tuple): (epoch, offset, batch_size)
+            is_new_epoch (bool):
+
+        """
+        data_indices = (self._epoch, self.offset, batch_size)
+
+        row_len = len(self.stream) // (batch_size * self.world_size)
         self.offset += self.bptt - 1
         # NOTE: the last token in ys must be feeded as inputs in the next mini-batch
 
         # Last mini-batch
-        if (self.offset + 1) * batch_size >= len(self):
+        is_new_epoch = False
+        if self.offset + 1 >= row_len:
             self.offset = 0
             is_new_epoch = True
-            self.epoch += 1
+            self._epoch += 1
+
+        return data_indices, is_new_epoch
+
+    def make_batch(self, data_indices):
+        """Gather tokens of mini-batch from the single sentence.
 
-            if self.shuffle:
-                # Sort tsv records
-                self.df = self.df.reindex(np.random.permutation(self.df.index))
+        Args:
+            data_indices (tuple): (epoch, offset, batch_size)
+        Returns:
+            batch (dict):
+                ys (np.ndarray): `[B, bptt]`
+
+        """
+        epoch, offset, batch_size = data_indices
+        if epoch != self.order_epoch:
+            # Concatenate into a single sentence in the order of the epoch
+            self.set_order(self.epoch_order(epoch))
+            self.order_epoch = epoch
+
+        # The single sentence is split into batch_size * world_size streams of the same length
+        row_len = len(self.stream) // (batch_size * self.world_size)
+        rows = np.arange(self.rank * batch_size, (self.rank + 1) * batch_size)
+        cols = np.arange(offset, min(offset + self.bptt, row_len))
+        return {'ys': self.stream.take(rows[:, None] * row_len + cols[None, :])}
+
+    def sampler_state(self):
+        """Return the state of sample_index.
+           The order of utterances is not saved because it is regenerated by epoch_order.
+        """
+        return {'_epoch': self._epoch,
+                'offset': self.offset,
+                'n_rows': self.n_rows,
+                'seed': self.seed,
+                'random_state': np.random.get_state()}
 
-                # Concatenate into a single sentence
-                concat_ids = []
-                for i in list(self.df.index):
-                    assert self.df['token_id'][i] != ''
-                    concat_ids += [self.eos] + list(map(int, self.df['token_id'][i].split()))
-                concat_ids += [self.eos]
-                # NOTE: <sos> and <eos> have the same index
+    def load_state_dict(self, state):
+        """Restore the iteration state saved by state_dict.
 
-                # Reshape
-                concat_ids = concat_ids[:len(concat_ids) // self.batch_size * self.batch_size]
-                self.concat_ids = np.array(concat_ids).reshape((self.batch_size, -1))
+        Args:
+            state (dict):
 
-        return ys, is_new_epoch
+        """
+        self.close()
+        self.reset()
+        self.epoch = state['epoch']
+        self.iteration = state['iteration']
+        self._epoch = state['_epoch']
+        self.offset = state['offset']
+        self.n_rows = state['n_rows']
+        self.seed = state['seed']
+        self.set_order(self.epoch_order(self._epoch))
+        self.order_epoch = self._epoch
+        np.random.set_state(state['random_state'])
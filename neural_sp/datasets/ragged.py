@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Ragged array of token indices.
+
+   A token store is a pair of `.npy` files made by utils/make_token_store.py.
+   `<store>.npy` contains token indices of all sentences (uint16 or uint32) and
+   `<store>.offsets.npy` contains the start position of each sentence followed by
+   the total number of tokens (int64).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def offsets_path(path):
+    """Return path to the sentence-offset index of a token store."""
+    return path[:-len('.npy')] + '.offsets.npy'
+
+
+class RaggedArray(object):
+    """Variable-length int sequences stored as a flat values array plus offsets.
+
+    Args:
+        values (np.ndarray): concatenation of all sequences
+        offsets (np.ndarray): start position of each sequence in values,
+            followed by len(values)
+
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings, dtype=np.int32):
+        """Parse space-delimited token indices only once.
+
+        Args:
+            strings (iterable): strings such as `12 5 8`. NaN is regarded as an empty sequence.
+            dtype (np.dtype): dtype of values
+        Returns:
+            RaggedArray
+
+        """
+        lengths = []
+        values = []
+        for s in strings:
+            if isinstance(s, float):
+                if s != s:
+                    # NaN for empty cells in the tsv file
+                    lengths.append(0)
+                    continue
+                # NOTE: pandas parses a column of single tokens as float64 if any cell is empty
+                s = int(s)
+            y = str(s).split()
+            lengths.append(len(y))
+            values += y
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.array(values, dtype=dtype), offsets)
+
+    @classmethod
+    def from_store(cls, path):
+        """Open a token store as a read-only memory map.
+
+        Args:
+            path (str): path to the `.npy` file of token indices
+        Returns:
+            RaggedArray
+
+        """
+        return cls(np.load(path, mmap_mode='r'), np.load(offsets_path(path)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """Return the i-th sequence as a view of values."""
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    def concat(self, indices, sep):
+        """Concatenate sequences with a separator.
+
+        Args:
+            indices (np.ndarray): indices of sequences to concatenate in this order
+            sep (int): separator inserted at the beginning, between sequences and at the end
+        Returns:
+            concat_ids (np.ndarray): `[sep, *seq0, sep, *seq1, ..., sep]`
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        n_tokens = int(lengths.sum())
+        concat_ids = np.full(n_tokens + len(indices) + 1, sep, dtype=self.values.dtype)
+        if n_tokens > 0:
+            # position of each token in the flattened sequences
+            pos = np.arange(n_tokens) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            src = np.repeat(self.offsets[indices], lengths) + pos
+            dst = np.repeat(np.cumsum(lengths + 1) - lengths, lengths) + pos
+            concat_ids[dst] = self.values[src]
+        return concat_ids
+
+
+class ConcatView(object):
+    """Concatenation of sequences with a separator, `[sep, *seq0, sep, *seq1, ..., sep]`,
+       without materializing it. Only the start position of each sequence is kept.
+
+    Args:
+        ragged (RaggedArray):
+        indices (np.ndarray): indices of sequences to concatenate in this order
+        sep (int): separator inserted at the beginning, between sequences and at the end
+
+    """
+
+    def __init__(self, ragged, indices, sep):
+        self.ragged = ragged
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.sep = sep
+        self.starts = np.zeros(len(self.indices) + 1, dtype=np.int64)
+        np.cumsum(ragged.lengths[self.indices] + 1, out=self.starts[1:])
+
+    def __len__(self):
+        return int(self.starts[-1]) + 1
+
+    def take(self, positions):
+        """Gather tokens at positions in the concatenation.
+
+        Args:
+            positions (np.ndarray): positions of any shape
+        Returns:
+            ids (np.ndarray): int32 token indices of the same shape as positions
+
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        k = np.searchsorted(self.starts, positions, side='right') - 1
+        pos = positions - self.starts[k]
+        ids = np.full(positions.shape, self.sep, dtype=np.int32)
+        is_token = pos > 0
+        src = self.ragged.offsets[self.indices[k[is_token]]] + pos[is_token] - 1
+        ids[is_token] = self.ragged.values[src]
+        return ids
@@ -11,11 +11,11 @@ from __future__ import division
 from __future__ import print_function
 
 import math
-import numpy as np
 
 import torch
 import torch.nn.functional as F
 
+from neural_sp.models.torch_utils import make_length_mask
 from neural_sp.models.torch_utils import to_onehot
 
 
@@ -25,26 +25,26 @@ def cross_entropy_lsm(logits, ys, ylens, lsm_prob, size_average=False):
     Args:
         logits (FloatTensor): `[B, T, vocab]`
         ys (LongTensor): Indices of labels. `[B, L]`.
-        ylens (list): A list of length `[B]`
+        ylens (list or IntTensor): A list of length `[B]`
         lsm_prob (float):
         size_average (bool):
     Returns:
         loss (FloatTensor): `[1]`
 
     """
-    bs, _, vocab = logits.size()
+    logits = logits.float()  # NOTE: compute in fp32 under autocast
+    bs, max_ylen, vocab = logits.size()
+    mask = make_length_mask(ylens, max_ylen, logits.device)  # `[B, T]`
 
     # Create one-hot vector
     ys_lsm = logits.new_zeros(logits.size()).fill_(lsm_prob / (vocab - 1 - 2))
     ys_lsm[:, :, 0] = 0  # blank
     ys_lsm[:, :, 3] = 0  # pad
-    for b in range(bs):
-        for t in range(ylens[b]):
-            ys_lsm[b, t, ys[b, t]] = 1 - lsm_prob
+    ys_lsm.scatter_(2, ys.masked_fill(mask == 0, 0).unsqueeze(2), 1 - lsm_prob)
 
     # Compute XE for label smoothing
     log_probs = F.log_softmax(logits, dim=-1)
-    loss = np.sum([(- ys_lsm[b, :ylens[b]] * log_probs[b, :ylens[b]]).sum() for b in range(bs)])
+    loss = (- ys_lsm * log_probs).sum(-1).masked_fill(mask == 0, 0).sum()
     if size_average:
         loss /= bs
     return loss
@@ -55,13 +55,15 @@ def kldiv_lsm_ctc(logits, ylens, size_average=False):
 
     Args:
         logits (FloatTensor): `[B, T, vocab]`
-        ylens (list): A list of length `[B]`
+        ylens (list or IntTensor): A list of length `[B]`
         size_average (bool):
     Returns:
         loss (FloatTensor): `[1]`
 
     """
-    bs, _, vocab = logits.size()
+    logits = logits.float()
+    bs, max_ylen, vocab = logits.size()
+    mask = make_length_mask(ylens, max_ylen, logits.device)  # `[B, T]`
 
     # Create uniform distribution
     log_uniform = logits.new_zeros(logits.size()).fill_(math.log(1 / (vocab - 2)))
@@ -72,7 +74,7 @@ def kldiv_lsm_ctc(logits, ylens, size_average=False):
     probs = F.softmax(logits, dim=-1)
     log_probs = F.log_softmax(logits, dim=-1)
     kl_div = torch.mul(probs, log_probs - log_uniform)
-    loss = np.sum([kl_div[b, :ylens[b]].sum() for b in range(bs)])
+    loss = kl_div.sum(-1).masked_fill(mask == 0, 0).sum()
     if size_average:
         loss /= bs
     return loss
@@ -84,14 +86,15 @@ def focal_loss(logits, ys, ylens, gamma, size_average=False):
     Args:
         logits (FloatTensor): `[B, T, vocab]`
         ys (LongTensor): Indices of labels. `[B, L]`
-        ylens (list): A list of length `[B]`
+        ylens (list or IntTensor): A list of length `[B]`
         gamma (float):
         size_average (bool):
     Returns:
         loss (FloatTensor): `[1]`
 
     """
-    bs = ys.size(0)
+    bs, max_ylen = ys.size()
+    mask = make_length_mask(ylens, max_ylen, logits.device)  # `[B, L]`
 
     # Create one-hot vector
     ys_onehot = to_onehot(ys, vocab=logits.size(-1), ylens=ylens)
@@ -99,11 +102,11 @@ def focal_loss(logits, ys, ylens, gamma, size_average=False):
     raise ValueError
 
     # Compute focal loss
+    logits = logits.float()
     log_probs = F.log_softmax(logits, dim=-1)
     probs = F.softmax(logits, dim=-1)
-    ones = torch.ones_like(log_probs)
-    loss = np.sum([(- ys_onehot[b, :ylens[b]] * log_probs[b, :ylens[b]] * torch.pow(ones[b, :ylens[b]] - probs[b, :ylens[b]], gamma)).sum()
-                   for b in range(bs)])
+    loss = (- ys_onehot.float() * log_probs * torch.pow(1 - probs, gamma)).sum(-1)
+    loss = loss.masked_fill(mask == 0, 0).sum()
     if size_average:
         loss /= bs
     return loss
@@ -220,7 +220,7 @@ class GatedConvLM(ModelBase):
             assert ys_out.size(1) == 1
             assert ys_out.size(0) == 1
             if self.adaptive_softmax is None:
-                probs = F.softmax(logits, dim=-1)
+                probs = F.softmax(logits.float(), dim=-1)
             else:
                 probs = self.adaptive_softmax.log_prob(logits).exp()
             cache_probs = probs.new_zeros(probs.size())
@@ -245,7 +245,7 @@ class GatedConvLM(ModelBase):
             loss = -torch.log(probs[:, :, ys_out[:, -1]])
         else:
             if self.adaptive_softmax is None:
-                loss = F.cross_entropy(logits.view((-1, logits.size(2))),
+                loss = F.cross_entropy(logits.view((-1, logits.size(2))).float(),
                                        ys_out.contiguous().view(-1),
                                        ignore_index=self.pad, size_average=True)
             else:
@@ -30,15 +30,12 @@ class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout, pe_type, max_len=5000):
         super(PositionalEncoding, self).__init__()
 
+        self.d_model = d_model
         self.pe_type = pe_type
 
         # Compute the positional encodings once in log space.
-        pe = torch.zeros(max_len, d_model, dtype=torch.float32)
-        position = torch.arange(0, max_len, dtype=torch.float32).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.0) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)  # for batch dimension
+        position = torch.arange(0, max_len, dtype=torch.float32)
+        pe = self.sinusoid(position, d_model).unsqueeze(0)  # for batch dimension
         # self.pe = pe
         self.register_buffer('pe', pe)
 
@@ -46,11 +43,46 @@ class PositionalEncoding(nn.Module):
 
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, xs):
+    @staticmethod
+    def sinusoid(position, d_model):
+        """Compute sinusoidal positional encodings.
+
+        Args:
+            position (FloatTensor): `[T]`
+            d_model (int):
+        Returns:
+            pe (FloatTensor): `[T, d_model]`
+
+        """
+        pe = position.new_zeros(position.size(0), d_model)
+        div_term = torch.exp(torch.arange(0, d_model, 2, device=position.device).float()
+                             * -(math.log(10000.0) / d_model))
+        pe[:, 0::2] = torch.sin(position.unsqueeze(1) * div_term)
+        pe[:, 1::2] = torch.cos(position.unsqueeze(1) * div_term)
+        return pe
+
+    def forward(self, xs, offset=0):
+        """Add positional encodings.
+
+        Args:
+            xs (FloatTensor): `[B, T, d_model]`
+            offset (int): position of the first frame (for streaming inference)
+        Returns:
+            xs (FloatTensor): `[B, T, d_model]`
+
+        """
+        end = offset + xs.size(1)
+        if end <= self.pe.size(1):
+            pe = self.pe[:, offset:end]
+        else:
+            # NOTE: positions beyond max_len (e.g., long streams) are computed on demand
+            position = torch.arange(offset, end, dtype=torch.float32, device=self.pe.device)
+            pe = self.sinusoid(position, self.d_model).to(self.pe.dtype).unsqueeze(0)
+
         if self.pe_type == 'add':
-            xs = xs + self.pe[:, :xs.size(1)]
+            xs = xs + pe
         elif self.pe_type == 'concat':
-            xs = torch.cat([xs, self.pe[:, :xs.size(1)]], dim=-1)
+            xs = torch.cat([xs, pe], dim=-1)
         else:
             raise NotImplementedError
         return self.dropout(xs)
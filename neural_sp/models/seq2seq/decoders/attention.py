@@ -15,6 +15,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import make_length_mask
 
 
 class AttentionMechanism(nn.Module):
@@ -132,10 +133,7 @@ class AttentionMechanism(nn.Module):
 
         # Mask attention distribution
         if self.mask is None:
-            self.mask = key.new_ones(bs, key_len)
-            for b in range(bs):
-                if key_lens[b] < key_len:
-                    self.mask[b, key_lens[b]:] = 0
+            self.mask = make_length_mask(key_lens, key_len, key.device)  # `[B, key_len]`
 
         if self.attn_type == 'add':
             query = query.expand_as(torch.zeros((bs, key_len, query.size(2))))
@@ -116,7 +116,7 @@ class BeamSearchDecoder(object):
                         if lm_weight > 0 and lm is not None:
                             lmout, lmstate = lm.decode(
                                 lm.encode(log_probs.new_zeros(1, 1).fill_(c).long()), (lm_hxs, lm_cxs))
-                            lm_scores = F.log_softmax(lm.generate(lmout).squeeze(1), dim=-1)
+                            lm_scores = F.log_softmax(lm.generate(lmout).squeeze(1).float(), dim=-1)
                             lm_score = lm_scores[0, c]
 
                         new_beam.append({'hyp': beam[i_beam]['hyp'] + [c],
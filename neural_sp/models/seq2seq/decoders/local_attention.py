@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Multi-head attention layer restricted to local windows."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import make_length_mask
+
+
+class LocalMultiheadAttentionMechanism(nn.Module):
+    """Multi-headed self-attention layer where each query attends to keys in
+       [t - window_left, t + window_right] only.
+
+       Queries are split into blocks of `window_left + window_right` frames, and each block
+       attends to the keys gathered for the block, so that time and memory grow linearly with
+       the sequence length. Optionally, every global_stride-th frame is regarded as a global frame,
+       which attends to all frames and is attended by all frames.
+
+    Args:
+        key_dim (int): dimensions of key
+        query_dim (int): dimensions of query
+        attn_dim: (int) dimension of the attention layer
+        dropout (float):
+        n_heads (int): number of heads in the multi-head attention
+        window_left (int): number of frames in the left window
+        window_right (int): number of frames in the right window
+        global_stride (int): interval of global frames (0 disables global frames)
+
+    """
+
+    def __init__(self,
+                 key_dim,
+                 query_dim,
+                 attn_dim,
+                 dropout=0,
+                 n_heads=4,
+                 window_left=32,
+                 window_right=32,
+                 global_stride=0):
+
+        super(LocalMultiheadAttentionMechanism, self).__init__()
+
+        self.d_k = attn_dim // n_heads
+        self.n_heads = n_heads
+        self.window_left = window_left
+        self.window_right = window_right
+        self.global_stride = global_stride
+        self.block_size = max(window_left + window_right, 1)
+
+        # attention dropout applied AFTER the softmax layer
+        self.attn_dropout = nn.Dropout(p=dropout)
+
+        self.w_key = LinearND(key_dim, attn_dim, bias=False)
+        self.w_value = LinearND(key_dim, attn_dim, bias=False)
+        self.w_query = LinearND(query_dim, attn_dim, bias=False)
+        self.w_out = LinearND(attn_dim, key_dim)
+
+    def reset(self):
+        pass
+
+    def forward(self, key, key_lens, value, query, aw=None):
+        """Forward computation.
+
+        Args:
+            key (FloatTensor): `[B, key_len, key_dim]`
+            key_lens (list): A list of length `[B]`
+            value (FloatTensor): `[B, key_len, value_dim]`
+            query (FloatTensor): `[B, query_len, query_dim]`.
+                Queries correspond to the last query_len keys.
+            aw (FloatTensor): dummy (not used)
+        Returns:
+            cv (FloatTensor): `[B, query_len, value_dim]`
+            aw: None (attention weights are not kept for local windows)
+
+        """
+        bs, key_len = key.size()[: 2]
+        query_len = query.size(1)
+        offset = key_len - query_len
+        assert offset >= 0
+        w = self.block_size
+        n_blocks = (query_len + w - 1) // w
+        window = w + self.window_left + self.window_right
+
+        key = self.w_key(key).view(bs, key_len, self.n_heads, self.d_k).transpose(2, 1)
+        value = self.w_value(value).view(bs, key_len, self.n_heads, self.d_k).transpose(2, 1)
+        query = self.w_query(query).view(bs, query_len, self.n_heads, self.d_k).transpose(2, 1)
+        # `[B, n_heads, time, d_k]`
+
+        # Split queries into blocks: `[B, n_heads, n_blocks, w, d_k]`
+        query_blocks = F.pad(query, (0, 0, 0, n_blocks * w - query_len))
+        query_blocks = query_blocks.view(bs, self.n_heads, n_blocks, w, self.d_k)
+
+        # Gather keys/values in the window of each block: `[B, n_heads, n_blocks, d_k, window]`
+        begin = offset - self.window_left
+        end = offset + n_blocks * w + self.window_right
+        pad_left = max(0, -begin)
+        pad_right = max(0, end - key_len)
+        key_blocks = F.pad(key, (0, 0, pad_left, pad_right))[:, :, begin + pad_left:end + pad_left]
+        key_blocks = key_blocks.unfold(2, window, w)
+        value_blocks = F.pad(value, (0, 0, pad_left, pad_right))[:, :, begin + pad_left:end + pad_left]
+        value_blocks = value_blocks.unfold(2, window, w)
+
+        # Mask keys outside the window or beyond the length: `[B, 1, n_blocks, w, window]`
+        key_pos = begin + torch.arange(n_blocks, device=key.device).unsqueeze(1) * w + \
+            torch.arange(window, device=key.device).unsqueeze(0)  # `[n_blocks, window]`
+        rel_pos = torch.arange(window, device=key.device).unsqueeze(0) - \
+            torch.arange(w, device=key.device).unsqueeze(1)  # `[w, window]`
+        in_window = (rel_pos >= 0) & (rel_pos <= self.window_left + self.window_right)
+        key_lens = torch.as_tensor(key_lens, dtype=torch.int64, device=key.device)
+        mask = (key_pos >= 0).unsqueeze(0) & (key_pos.unsqueeze(0) < key_lens.view(bs, 1, 1))
+        mask = mask.unsqueeze(2) & in_window.view(1, 1, w, window)
+        mask = mask.unsqueeze(1)
+
+        e = torch.matmul(query_blocks, key_blocks) * (self.d_k ** -0.5)
+        e = e.masked_fill_(mask == 0, -1024)  # `[B, n_heads, n_blocks, w, window]`
+
+        if self.global_stride > 0:
+            # Global keys: `[B, n_heads, n_global, d_k]`
+            global_key = key[:, :, ::self.global_stride]
+            global_value = value[:, :, ::self.global_stride]
+            n_global = global_key.size(2)
+
+            # NOTE: mask global keys in the local window not to attend them twice
+            global_pos = torch.arange(0, key_len, self.global_stride, device=key.device)
+            query_pos = offset + torch.arange(n_blocks * w, device=key.device).view(n_blocks, w)
+            rel_pos = global_pos.view(1, 1, n_global) - query_pos.unsqueeze(2)
+            global_mask = (rel_pos < -self.window_left) | (rel_pos > self.window_right)
+            global_mask = global_mask.unsqueeze(0) & (global_pos.view(1, 1, 1, n_global) < key_lens.view(bs, 1, 1, 1))
+            global_mask = global_mask.unsqueeze(1)  # `[B, 1, n_blocks, w, n_global]`
+
+            e_global = torch.matmul(query_blocks, global_key.transpose(3, 2).unsqueeze(2)) * (self.d_k ** -0.5)
+            e_global = e_global.masked_fill_(global_mask == 0, -1024)
+            aw = F.softmax(torch.cat([e, e_global], dim=-1), dim=-1)
+            aw = self.attn_dropout(aw)
+            cv = torch.matmul(aw[..., :window], value_blocks.transpose(4, 3))
+            cv += torch.matmul(aw[..., window:], global_value.unsqueeze(2))
+        else:
+            aw = F.softmax(e, dim=-1)
+            aw = self.attn_dropout(aw)
+            cv = torch.matmul(aw, value_blocks.transpose(4, 3))
+        cv = cv.view(bs, self.n_heads, n_blocks * w, self.d_k)[:, :, :query_len]
+        # `[B, n_heads, query_len, d_k]`
+
+        if self.global_stride > 0:
+            # Global queries attend to all keys
+            query_idx = torch.arange((-offset) % self.global_stride, query_len, self.global_stride,
+                                     device=key.device)
+            if len(query_idx) > 0:
+                e = torch.matmul(query[:, :, query_idx], key.transpose(3, 2)) * (self.d_k ** -0.5)
+                e = e.masked_fill_(make_length_mask(key_lens, key_len, key.device).view(bs, 1, 1, key_len) == 0,
+                                   -1024)
+                aw = self.attn_dropout(F.softmax(e, dim=-1))
+                cv[:, :, query_idx] = torch.matmul(aw, value)
+
+        cv = cv.permute(0, 2, 3, 1).contiguous().view(bs, query_len, self.d_k * self.n_heads)
+        cv = self.w_out(cv)
+
+        return cv, None
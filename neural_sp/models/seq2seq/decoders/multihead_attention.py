@@ -10,11 +10,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import checkpoint
+from neural_sp.models.torch_utils import make_length_mask
 
 
 class MultiheadAttentionMechanism(nn.Module):
@@ -34,6 +37,11 @@ class MultiheadAttentionMechanism(nn.Module):
             This must be the odd number.
         dropout (float):
         n_heads (int): number of heads in the multi-head attention
+        block_size (int): size of query/key blocks for memory-efficient attention.
+            If positive, attention weights are computed block by block with the online
+            softmax without materializing `[B, n_heads, query_len, key_len]` tensors.
+        recompute (bool): recompute attention weights of each query block in backward
+            instead of keeping them. This is used only if block_size is positive.
 
     """
 
@@ -42,15 +50,20 @@ class MultiheadAttentionMechanism(nn.Module):
                  query_dim,
                  attn_dim,
                  dropout=0,
-                 n_heads=4):
+                 n_heads=4,
+                 block_size=0,
+                 recompute=False):
 
         super(MultiheadAttentionMechanism, self).__init__()
 
         self.d_k = attn_dim // n_heads
         self.n_heads = n_heads
+        self.block_size = block_size
+        self.recompute = recompute
         self.key = None
         self.value = None
         self.mask = None
+        self.causal_mask = None
 
         # attention dropout applied AFTER the softmax layer
         self.attn_dropout = nn.Dropout(p=dropout)
@@ -65,6 +78,67 @@ class MultiheadAttentionMechanism(nn.Module):
         self.value = None
         self.mask = None
 
+    def make_causal_mask(self, length, device):
+        """Return a lower triangular mask. It is cached and only sliced for shorter inputs.
+
+        Args:
+            length (int): length of queries and keys
+            device (torch.device):
+        Returns:
+            causal_mask (BoolTensor): `[length, length]`
+
+        """
+        if self.causal_mask is None or self.causal_mask.size(0) < length or self.causal_mask.device != device:
+            self.causal_mask = torch.tril(torch.ones((length, length), device=device), diagonal=0) > 0
+        return self.causal_mask[:length, :length]
+
+    def _attend_block(self, query, key, value, mask, q_begin, diagonal):
+        """Attend a block of queries to all keys with the online softmax.
+           Key blocks are processed one by one while the running maximum and sum of
+           exponentiated scores are kept, so that the output is identical to that of
+           the softmax over all keys.
+
+        Args:
+            query (FloatTensor): `[B, n_heads, q_len, d_k]`
+            key (FloatTensor): `[B, n_heads, d_k, key_len]`
+            value (FloatTensor): `[B, n_heads, key_len, d_k]`
+            mask (ByteTensor): `[B, 1, 1, key_len]`
+            q_begin (int): position of the first query in the block
+            diagonal (bool): hide future information
+        Returns:
+            cv (FloatTensor): `[B, n_heads, q_len, d_k]`
+
+        """
+        q_len = query.size(2)
+        key_len = key.size(3)
+        if diagonal:
+            # NOTE: key blocks after the last query are masked out entirely
+            key_len = min(key_len, q_begin + q_len)
+            causal_mask = self.make_causal_mask(q_begin + q_len, query.device)[q_begin:]
+
+        m, l, cv = None, None, None
+        for k_begin in range(0, key_len, self.block_size):
+            k_end = min(k_begin + self.block_size, key_len)
+            e = torch.matmul(query, key[:, :, :, k_begin:k_end]) * (self.d_k ** -0.5)
+            e = e.masked_fill_(mask[:, :, :, k_begin:k_end] == 0, -1024)
+            if diagonal:
+                e = e.masked_fill_(causal_mask[:, k_begin:k_end] == 0, -1024)
+
+            # Rescale the running sum and outputs with the new maximum
+            m_new = e.max(dim=-1, keepdim=True)[0]
+            if m is not None:
+                m_new = torch.max(m, m_new)
+            p = torch.exp(e - m_new)
+            if m is None:
+                l = p.sum(dim=-1, keepdim=True)
+                cv = torch.matmul(self.attn_dropout(p), value[:, :, k_begin:k_end])
+            else:
+                scale = torch.exp(m - m_new)
+                l = l * scale + p.sum(dim=-1, keepdim=True)
+                cv = cv * scale + torch.matmul(self.attn_dropout(p), value[:, :, k_begin:k_end])
+            m = m_new
+        return cv / l
+
     def forward(self, key, key_lens, value, query, aw=None, diagonal=False):
         """Forward computation.
 
@@ -92,25 +166,37 @@ class MultiheadAttentionMechanism(nn.Module):
 
         # Mask attention distribution
         if self.mask is None:
-            self.mask = key.new_ones(bs, self.n_heads, query_len, key_len).byte()
-            for b in range(bs):
-                if key_lens[b] < key_len:
-                    self.mask[b, :, :, key_lens[b]:] = 0
+            # NOTE: broadcast over heads and queries
+            self.mask = make_length_mask(key_lens, key_len, key.device).unsqueeze(1).unsqueeze(2)  # `[B, 1, 1, key_len]`
 
-            # hide future information for transformer decoder
+        query = self.w_query(query).view(bs, query_len, self.n_heads, self.d_k)
+        query = query.permute(0, 2, 1, 3).contiguous()  # `[B, n_heads, query_len, d_k]`
+
+        if self.block_size > 0:
             if diagonal:
                 assert query_len == key_len
-                subsequent_mask = torch.tril(key.new_ones((query_len, key_len)).byte(), diagonal=0)
-                subsequent_mask = subsequent_mask.unsqueeze(0).unsqueeze(1).expand(
-                    bs, self.n_heads, -1, -1)  # `[B, n_heads, query_len, key_len]`
-                self.mask = self.mask & subsequent_mask
+            cvs = []
+            for q_begin in range(0, query_len, self.block_size):
+                q_end = min(q_begin + self.block_size, query_len)
+                attend_block = functools.partial(self._attend_block, q_begin=q_begin, diagonal=diagonal)
+                if self.recompute and torch.is_grad_enabled():
+                    cvs.append(checkpoint(attend_block, query[:, :, q_begin:q_end], self.key, self.value, self.mask))
+                else:
+                    cvs.append(attend_block(query[:, :, q_begin:q_end], self.key, self.value, self.mask))
+            cv = torch.cat(cvs, dim=2)  # `[B, n_heads, query_len, d_k]`
+            cv = cv.permute(0, 2, 3, 1).contiguous().view(bs, query_len, self.d_k * self.n_heads)
+            cv = self.w_out(cv)
+            # NOTE: attention weights are not materialized
+            return cv, None
 
-        query = self.w_query(query).view(bs, query_len, self.n_heads, self.d_k)
-        query = query.permute(0, 2, 1, 3).contiguous()  # `[B, n_heads, query_len, d_k]`
         e = torch.matmul(query, self.key) * (self.d_k ** -0.5)
 
         # Compute attention weights
         e = e.masked_fill_(self.mask == 0, -1024)  # `[B, n_heads, query_len, key_len]`
+        if diagonal:
+            # hide future information for transformer decoder
+            assert query_len == key_len
+            e = e.masked_fill_(self.make_causal_mask(query_len, e.device) == 0, -1024)
         aw = F.softmax(e, dim=-1)
         aw = self.attn_dropout(aw)
         cv = torch.matmul(aw, self.value)  # `[B, n_heads, query_len, d_k]`
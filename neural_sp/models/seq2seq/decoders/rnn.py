@@ -33,9 +33,10 @@ from neural_sp.models.seq2seq.decoders.ctc_beam_search import BeamSearchDecoder
 from neural_sp.models.seq2seq.decoders.ctc_beam_search import CTCPrefixScore
 from neural_sp.models.seq2seq.decoders.ctc_greedy import GreedyDecoder
 from neural_sp.models.seq2seq.decoders.multihead_attention import MultiheadAttentionMechanism
+from neural_sp.models.torch_utils import append_sos_eos
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
-from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import pad_ids
 from neural_sp.models.torch_utils import tensor2np
 
 random.seed(1)
@@ -348,7 +349,8 @@ class RNNDecoder(nn.Module):
         Args:
             eouts (FloatTensor): `[B, T, dec_n_units]`
             elens (list): A list of length `[B]`
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
             task (str): all or ys or ys_sub*
             ys_hist (list):
         Returns:
@@ -406,7 +408,8 @@ class RNNDecoder(nn.Module):
         Args:
             eouts (FloatTensor): `[B, T, dec_n_units]`
             elens (list): A list of length `[B]`
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
         Returns:
             loss (FloatTensor): `[B, L, vocab]`
 
@@ -415,14 +418,15 @@ class RNNDecoder(nn.Module):
 
         # Compute the auxiliary CTC loss
         elensmbl_ctc = np2tensor(np.fromiter(elens, dtype=np.int64), -1).int()
-        ys_ctc = [np2tensor(np.fromiter(y, dtype=np.int64)).long() for y in ys]  # always fwd
-        ylens = np2tensor(np.fromiter([y.size(0) for y in ys_ctc], dtype=np.int64), -1).int()
-        ys_ctc = torch.cat(ys_ctc, dim=0).int()
+        ys_ctc = ys if torch.is_tensor(ys) else pad_ids(ys, -1)  # always fwd
+        ylens = (ys_ctc >= 0).sum(1).int()
+        ys_ctc = ys_ctc[ys_ctc >= 0].int()
         # NOTE: Concatenate all elements in ys for warpctc_pytorch
         # NOTE: do not copy to GPUs here
 
         # Compute CTC loss
-        loss = self.warpctc_loss(logits.transpose(1, 0).cpu(),  # time-major
+        # NOTE: warpctc_pytorch supports only fp32
+        loss = self.warpctc_loss(logits.transpose(1, 0).float().cpu(),  # time-major
                                  ys_ctc, elensmbl_ctc, ylens)
         # NOTE: ctc loss has already been normalized by bs
         # NOTE: index 0 is reserved for blank in warpctc_pytorch
@@ -439,11 +443,11 @@ class RNNDecoder(nn.Module):
         return loss
 
     def forward_lmobj(self, ys):
-        A
         """Compute XE loss for LM objective.
 
         Args:
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
         Returns:
             loss (FloatTensor): `[1]`
             acc (float):
@@ -454,13 +458,7 @@ class RNNDecoder(nn.Module):
         w = next(self.parameters())
 
         # Append <sos> and <eos>
-        eos = w.new_zeros((1,)).fill_(self.eos).long()
-        ys = [np2tensor(np.fromiter(y[::-1] if self.bwd else y, dtype=np.int64),
-                        self.device_id).long() for y in ys]
-        ys_in = [torch.cat([eos, y], dim=0) for y in ys]
-        ys_out = [torch.cat([y, eos], dim=0) for y in ys]
-        ys_in_pad = pad_list(ys_in, self.pad)
-        ys_out_pad = pad_list(ys_out, self.pad)
+        ys_in_pad, ys_out_pad, _ = append_sos_eos(ys, self.eos, self.pad, self.bwd, self.device_id)
 
         # Initialization
         dstates = self.init_dec_state(bs)
@@ -485,7 +483,7 @@ class RNNDecoder(nn.Module):
 
         # Compute XE loss for LM objective
         logits = torch.cat(logits, dim=1)
-        loss = F.cross_entropy(logits.view((-1, logits.size(2))), ys_out_pad.view(-1),
+        loss = F.cross_entropy(logits.view((-1, logits.size(2))).float(), ys_out_pad.view(-1),
                                ignore_index=self.pad, size_average=False) / bs
 
         # Compute token-level accuracy in teacher-forcing
@@ -500,7 +498,8 @@ class RNNDecoder(nn.Module):
         Args:
             eouts (FloatTensor): `[B, T, dec_n_units]`
             elens (list): A list of length `[B]`
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
             ys_hist (list):
         Returns:
             loss (FloatTensor): `[B, L, vocab]`
@@ -511,12 +510,8 @@ class RNNDecoder(nn.Module):
         bs = eouts.size(0)
 
         # Append <sos> and <eos>
-        eos = eouts.new_zeros(1).fill_(self.eos).long()
-        _ys = [np2tensor(np.fromiter(y[::-1] if self.bwd else y, dtype=np.int64), self.device_id).long() for y in ys]
-        ys_in = [torch.cat([eos, y], dim=0) for y in _ys]
-        ys_out = [torch.cat([y, eos], dim=0) for y in _ys]
-        ys_in_pad = pad_list(ys_in, self.pad)
-        ys_out_pad = pad_list(ys_out, self.pad)
+        ys_in_pad, ys_out_pad, ylens = append_sos_eos(ys, self.eos, self.pad, self.bwd, self.device_id)
+        ylens_out = (ylens + 1).tolist()
 
         # Initialization
         if self.contextualize:
@@ -569,16 +564,16 @@ class RNNDecoder(nn.Module):
             if self.lsm_prob > 0:
                 # Label smoothing
                 loss = cross_entropy_lsm(logits, ys_out_pad,
-                                         ylens=[y.size(0) for y in ys_out],
+                                         ylens=ylens_out,
                                          lsm_prob=self.lsm_prob, size_average=False) / bs
             else:
-                loss = F.cross_entropy(logits.view((-1, logits.size(2))), ys_out_pad.view(-1),
+                loss = F.cross_entropy(logits.view((-1, logits.size(2))).float(), ys_out_pad.view(-1),
                                        ignore_index=self.pad, size_average=False) / bs
 
             # Focal loss
             if self.fl_weight > 0:
                 fl = focal_loss(logits, ys_out_pad,
-                                ylens=[y.size(0) for y in ys_out],
+                                ylens=ylens_out,
                                 gamma=self.fl_gamma, size_average=False) / bs
                 loss = loss * (1 - self.fl_weight) + fl * self.fl_weight
         else:
@@ -892,10 +887,6 @@ class RNNDecoder(nn.Module):
         asr_state_carry_over = params['recog_asr_state_carry_over']
         lm_state_carry_over = params['recog_lm_state_carry_over']
         n_caches = params['recog_n_caches']
-        cache_theta_sp = params['recog_cache_theta_speech']
-        cache_lambda_sp = params['recog_cache_lambda_speech']
-        cache_theta_lm = params['recog_cache_theta_lm']
-        cache_lambda_lm = params['recog_cache_lambda_lm']
         cache_type = params['recog_cache_type']
 
         if lm is not None:
@@ -916,13 +907,8 @@ class RNNDecoder(nn.Module):
             # Initialization per utterance
             dstates = self.init_dec_state(1)
             cv = eouts.new_zeros(1, 1, self.dec_n_units if self.input_feeding else self.enc_n_units)
-            self.score.reset()
             lm_hxs, lm_cxs = None, None
 
-            hxs_hist = eouts.new_zeros((1, self.dec_n_units))
-            cxs_hist = eouts.new_zeros((1, self.dec_n_units))
-            cv_hist = eouts.new_zeros(bs, 1, self.dec_n_units)
-
             # Ensemble initialization
             ensmbl_dstates = []
             ensmbl_cv = []
@@ -930,7 +916,6 @@ class RNNDecoder(nn.Module):
                 for dec in ensmbl_decs:
                     ensmbl_dstates += [dec.init_dec_state(1)]
                     ensmbl_cv += [eouts.new_zeros(1, 1, dec.dec_n_units if dec.input_feeding else dec.enc_n_units)]
-                    dec.score.reset()
 
             if speakers is not None and speakers[b] != self.prev_spk:
                 self.reset_global_cache()
@@ -941,6 +926,16 @@ class RNNDecoder(nn.Module):
                     dstates = self.dstates_final
             self.prev_spk = speakers[b]
 
+            # NOTE: states of all hypotheses generated in the same step are stacked in the batch dimension,
+            # and each hypothesis keeps its index in the batch
+            states = {'dstates': dstates,
+                      'cv': cv,
+                      'aw': None,
+                      'lmstate': (lm_hxs, lm_cxs),
+                      'ensmbl_dstates': ensmbl_dstates,
+                      'ensmbl_cv': ensmbl_cv,
+                      'ensmbl_aw': [None] * (n_models - 1)}
+
             complete = []
             beam = [{'hyp_id': [self.eos],
                      'ref_id': [self.eos],
@@ -949,21 +944,13 @@ class RNNDecoder(nn.Module):
                      'score_attn': 0.0,
                      'score_ctc': 0.0,
                      'score_lm': 0.0,
-                     'dstates': dstates,
-                     'cv': cv,
-                     'cv_hist': cv_hist,
-                     'hxs_hist': hxs_hist,
-                     'cxs_hist': cxs_hist,
+                     'score_cp': 0.0,
                      'aws': [None],
-                     'lm_hxs': lm_hxs,
-                     'lm_cxs': lm_cxs,
-                     'ensmbl_dstates': ensmbl_dstates,
-                     'ensmbl_cv': ensmbl_cv,
-                     'ensmbl_aws':[[None]] * (n_models - 1),
+                     'states': states,
+                     'beam_idx': 0,
                      'ctc_state': ctc_prefix_score.initial_state() if ctc_weight > 0 and ctc_log_probs is not None else None,
                      'ctc_score': 0.0,
                      'cache_ids': [],
-                     'dict_cache_sp': {},
                      'cache_sp_key': [],
                      'cache_lm_key': [],
                      'cache_idx_hist': [],
@@ -975,282 +962,229 @@ class RNNDecoder(nn.Module):
                 ylen_max = len(refs_id[b]) + 1
             else:
                 ylen_max = int(math.floor(elens[b] * max_len_ratio)) + 1
+            n_hyps_prev = 0
             for t in range(ylen_max):
-                new_beam = []
-                for i_beam in range(len(beam)):
-                    prev_idx = ([self.eos] + refs_id[b])[t] if oracle else beam[i_beam]['hyp_id'][-1]
-
-                    # Recurrency for the main model
-                    y = eouts.new_zeros(1, 1).fill_(prev_idx).long()
-                    dstates = self.recurrency(self.embed(y),
-                                              beam[i_beam]['cv'],
-                                              beam[i_beam]['dstates']['dstate'])
-                    # Recurrency for the ensemble
-                    ensmbl_dstates = []
-                    if n_models > 1:
-                        for i_e, dec in enumerate(ensmbl_decs):
-                            ensmbl_dstates += [dec.recurrency(dec.embed(y),
-                                                              beam[i_beam]['ensmbl_cv'][i_e],
-                                                              beam[i_beam]['ensmbl_dstates'][i_e]['dstate'])]
-
-                    # Score for the main model
-                    cv, aw = self.score(eouts[b:b + 1, :elens[b]],
-                                        elens[b:b + 1],
-                                        eouts[b:b + 1, :elens[b]],
-                                        dstates['dout_score'],
-                                        beam[i_beam]['aws'][-1])
-                    # Score for the ensemble
-                    ensmbl_cv = []
-                    ensmbl_aws = []
-                    if n_models > 1:
-                        for i_e, dec in enumerate(ensmbl_decs):
-                            cv_e, aw_e = dec.score(
-                                ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]],
-                                ensmbl_elens[i_e][b:b + 1],
-                                ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]],
-                                ensmbl_dstates[i_e]['dout_score'],
-                                beam[i_beam]['ensmbl_aws'][i_e][-1])
-                            ensmbl_cv += [cv_e]
-                            ensmbl_aws += [aw_e.unsqueeze(0)]  # TODO(hirofumi)] why unsqueeze?
-
-                    lmout, lmstate = None, None
+                n_hyps = len(beam)
+
+                # Reorder states by the surviving hypotheses
+                beam_ids = eouts.new_tensor([hyp['beam_idx'] for hyp in beam], dtype=torch.long)
+                states = self._select_states(beam[0]['states'], beam_ids)
+
+                if n_hyps != n_hyps_prev:
+                    # NOTE: encoder-side features in the attention layer are cached for the batch size
+                    self.score.reset()
+                    for dec in ensmbl_decs:
+                        dec.score.reset()
+                    n_hyps_prev = n_hyps
+                eouts_b = eouts[b:b + 1, :elens[b]].expand(n_hyps, -1, -1)
+
+                if oracle:
+                    y = eouts.new_zeros(n_hyps, 1).fill_(([self.eos] + refs_id[b])[t]).long()
+                else:
+                    y = eouts.new_tensor([[hyp['hyp_id'][-1]] for hyp in beam], dtype=torch.long)
+
+                # Recurrency for the main model
+                dstates = self.recurrency(self.embed(y), states['cv'], states['dstates']['dstate'])
+                # Recurrency for the ensemble
+                ensmbl_dstates = []
+                if n_models > 1:
+                    for i_e, dec in enumerate(ensmbl_decs):
+                        ensmbl_dstates += [dec.recurrency(dec.embed(y),
+                                                          states['ensmbl_cv'][i_e],
+                                                          states['ensmbl_dstates'][i_e]['dstate'])]
+
+                # Score for the main model
+                cv, aw = self.score(eouts_b, [elens[b]] * n_hyps, eouts_b,
+                                    dstates['dout_score'], states['aw'])
+                # Score for the ensemble
+                ensmbl_cv = []
+                ensmbl_aw = []
+                if n_models > 1:
+                    for i_e, dec in enumerate(ensmbl_decs):
+                        eouts_e = ensmbl_eouts[i_e][b:b + 1, :ensmbl_elens[i_e][b]].expand(n_hyps, -1, -1)
+                        cv_e, aw_e = dec.score(eouts_e, [ensmbl_elens[i_e][b]] * n_hyps, eouts_e,
+                                               ensmbl_dstates[i_e]['dout_score'], states['ensmbl_aw'][i_e])
+                        ensmbl_cv += [cv_e]
+                        ensmbl_aw += [aw_e]
+
+                lmout, lmstate = None, (None, None)
+                if self.lm is not None:
+                    # Update LM states for LM fusion
+                    lmout, lmstate = self.lm.decode(self.lm.encode(y), states['lmstate'])
+                elif lm_weight > 0 and lm is not None:
+                    # Update LM states for shallow fusion
+                    lmout, lmstate = lm.decode(lm.encode(y), states['lmstate'])
+
+                # Generate for the main model
+                attn_v, lm_feat = self.generate(cv, dstates['dout_gen'], lmout)
+                if self.adaptive_softmax is None:
+                    probs = F.softmax(self.output(attn_v).squeeze(1).float(), dim=1)
+                else:
+                    probs = self.adaptive_softmax.log_prob(attn_v.view(-1, attn_v.size(2)))
+
+                # Generate for LM
+                lm_probs = None
+                if lm_weight > 0:
                     if self.lm is not None:
-                        # Update LM states for LM fusion
-                        lmout, lmstate = self.lm.decode(
-                            self.lm.encode(eouts.new_zeros(1, 1).fill_(prev_idx).long()),
-                            (beam[i_beam]['lm_hxs'], beam[i_beam]['lm_cxs']))
-                    elif lm_weight > 0 and lm is not None:
-                        # Update LM states for shallow fusion
-                        lmout, lmstate = lm.decode(
-                            lm.encode(eouts.new_zeros(1, 1).fill_(prev_idx).long()),
-                            (beam[i_beam]['lm_hxs'], beam[i_beam]['lm_cxs']))
-
-                    # Generate for the main model
-                    attn_v, lm_feat = self.generate(cv, dstates['dout_gen'], lmout)
-                    if self.adaptive_softmax is None:
-                        probs = F.softmax(self.output(attn_v).squeeze(1), dim=1)
-                    else:
-                        probs = self.adaptive_softmax.log_prob(attn_v.view(-1, attn_v.size(2)))
-
-                    # Generate for LM
-                    if lm_weight > 0:
-                        if self.lm is not None:
-                            lm_probs = F.softmax(self.lm.generate(lmout).squeeze(1), dim=-1)
-                        elif lm is not None:
-                            lm_probs = F.softmax(lm.generate(lmout).squeeze(1), dim=-1)
-                        # TODO(hirofumi): support adaptive softmax for LM
-
-                    # Cache decoding
-                    cache_ids = None
-                    cache_sp_attn = None
-                    cache_lm_attn = None
-                    cache_probs_sp = probs.new_zeros(probs.size())
-                    cache_probs_lm = probs.new_zeros(probs.size())
-                    if n_caches > 0:
-                        assert self.adaptive_softmax is None
-
-                        # Compute inner-product over caches
-                        if 'speech_fifo' in cache_type:
-                            is_cache = True
-                            if 'online' in cache_type and len(self.fifo_cache_ids + beam[i_beam]['cache_ids']) > 0:
-                                cache_ids = (self.fifo_cache_ids + beam[i_beam]['cache_ids'])[-n_caches:]
-                                cache_sp_key = beam[i_beam]['cache_sp_key'][-n_caches:]
-                                if len(cache_sp_key) > 0:
-                                    cache_sp_key = torch.cat(cache_sp_key, dim=1)
-                                    if self.fifo_cache_sp_key is not None:
-                                        cache_sp_key = torch.cat([self.fifo_cache_sp_key, cache_sp_key], dim=1)
-                                else:
-                                    cache_sp_key = self.fifo_cache_sp_key  # for the first token
-                                # Truncate
-                                cache_sp_key = cache_sp_key[:, -n_caches:]  # `[1, L, enc_n_units]`
-                            elif 'online' not in cache_type and len(self.fifo_cache_ids) > 0:
-                                cache_ids = self.fifo_cache_ids
-                                cache_sp_key = self.fifo_cache_sp_key
-                            else:
-                                is_cache = False
-
-                            if is_cache:
-                                cache_sp_attn = F.softmax(cache_theta_sp * torch.matmul(
-                                    cache_sp_key, torch.cat([cv, dstates['dout_gen']], dim=-1).transpose(2, 1)), dim=1)  # `[1, L, 1]`
-                                # Sum all probabilities
-                                for c in set(beam[i_beam]['cache_ids']):
-                                    for offset in [i for i, key in enumerate(cache_ids) if key == c]:
-                                        cache_probs_sp[0, c] += cache_sp_attn[0, offset, 0]
-                                probs = (1 - cache_lambda_sp) * probs + cache_lambda_sp * cache_probs_sp
-
-                        if 'lm_fifo' in cache_type:
-                            is_cache = True
-                            if 'online' in cache_type and len(self.fifo_cache_ids + beam[i_beam]['cache_ids']) > 0:
-                                assert lm_weight > 0
-                                cache_ids = (self.fifo_cache_ids + beam[i_beam]['cache_ids'])[-n_caches:]
-                                cache_lm_key = beam[i_beam]['cache_lm_key'][-n_caches:]
-                                if len(cache_lm_key) > 0:
-                                    cache_lm_key = torch.cat(cache_lm_key, dim=1)
-                                    if self.fifo_cache_lm_key is not None:
-                                        cache_lm_key = torch.cat([self.fifo_cache_lm_key, cache_lm_key], dim=1)
-                                else:
-                                    cache_lm_key = self.fifo_cache_lm_key   # for the first token
-                                # Truncate
-                                cache_lm_key = cache_lm_key[:, -n_caches:]  # `[1, L, lm_n_units]`
-                            elif 'online' not in cache_type and len(self.fifo_cache_ids) > 0:
-                                cache_ids = self.fifo_cache_ids
-                                cache_lm_key = self.fifo_cache_lm_key
-                            else:
-                                is_cache = False
-
-                            if is_cache:
-                                cache_lm_attn = F.softmax(cache_theta_lm * torch.matmul(
-                                    cache_lm_key, lmout.transpose(2, 1)), dim=1)  # `[1, L, 1]`
-                                # Sum all probabilities
-                                for c in set(beam[i_beam]['cache_ids']):
-                                    for offset in [i for i, key in enumerate(cache_ids) if key == c]:
-                                        cache_probs_lm[0, c] += cache_lm_attn[0, offset, 0]
-                                lm_probs = (1 - cache_lambda_lm) * lm_probs + cache_lambda_lm * cache_probs_lm
-
-                        if 'speech_dict' in cache_type and len(self.dict_cache_sp.keys()) > 0:
-                            cache_ids = sorted(list(self.dict_cache_sp.keys()))
-                            cache_ids = [self.unk if idx < 0 else idx for idx in cache_ids]
-                            cache_sp_key = [v['key']for k, v in sorted(self.dict_cache_sp.items(), key=lambda x: x[0])]
-                            cache_sp_key = torch.cat(cache_sp_key, dim=1)
-                            cache_sp_attn = F.softmax(cache_theta_sp * torch.matmul(
-                                cache_sp_key, torch.cat([cv, dstates['dout_gen']], dim=-1).transpose(2, 1)), dim=1)  # `[1, L, 1]`
-                            # Sum all probabilities
-                            for offset, c in enumerate(cache_ids):
-                                cache_probs_sp[0, c] += cache_sp_attn[0, offset, 0]
-                            probs = (1 - cache_lambda_sp) * probs + cache_lambda_sp * cache_probs_sp
-
-                        if 'lm_dict' in cache_type and len(self.dict_cache_lm.keys()) > 0:
-                            cache_ids = sorted(list(self.dict_cache_lm.keys()))
-                            cache_lm_key = [v['key']for k, v in sorted(self.dict_cache_lm.items(), key=lambda x: x[0])]
-                            cache_lm_key = torch.cat(cache_lm_key, dim=1)
-                            cache_lm_attn = F.softmax(cache_theta_lm * torch.matmul(
-                                cache_lm_key, lmout.transpose(2, 1)), dim=1)  # `[1, L, 1]`
-                            # Sum all probabilities
-                            for offset, c in enumerate(cache_ids):
-                                cache_probs_lm[0, c] += cache_lm_attn[0, offset, 0]
-                            probs = (1 - cache_lambda_lm) * probs + cache_lambda_lm * cache_probs_lm
-
-                    if self.adaptive_softmax is None:
-                        local_scores_attn = torch.log(probs)
+                        lm_probs = F.softmax(self.lm.generate(lmout).squeeze(1).float(), dim=-1)
+                    elif lm is not None:
+                        lm_probs = F.softmax(lm.generate(lmout).squeeze(1).float(), dim=-1)
+                    # TODO(hirofumi): support adaptive softmax for LM
+
+                # Cache decoding
+                cache_ids = [None] * n_hyps
+                cache_sp_attn = [None] * n_hyps
+                cache_lm_attn = [None] * n_hyps
+                if n_caches > 0:
+                    assert self.adaptive_softmax is None
+                    probs_cache, lm_probs_cache = [], []
+                    for i in range(n_hyps):
+                        probs_i, lm_probs_i, cache_ids[i], cache_sp_attn[i], cache_lm_attn[i] = self._cache_probs(
+                            probs[i:i + 1], lm_probs[i:i + 1] if lm_probs is not None else None,
+                            cv[i:i + 1], dstates['dout_gen'][i:i + 1], lmout[i:i + 1] if lmout is not None else None,
+                            beam[i], params)
+                        probs_cache += [probs_i]
+                        lm_probs_cache += [lm_probs_i]
+                    probs = torch.cat(probs_cache, dim=0)
+                    if lm_probs is not None:
+                        lm_probs = torch.cat(lm_probs_cache, dim=0)
+
+                if self.adaptive_softmax is None:
+                    local_scores_attn = torch.log(probs)
+                else:
+                    local_scores_attn = probs  # NOTE: already log-scaled
+                # Generate for the ensemble
+                if n_models > 1:
+                    for i_e, dec in enumerate(ensmbl_decs):
+                        attn_v_e, _ = dec.generate(ensmbl_cv[i_e],
+                                                   ensmbl_dstates[i_e]['dout_gen'],
+                                                   lmout)
+                        if dec.adaptive_softmax is None:
+                            local_scores_attn += F.log_softmax(dec.output(attn_v_e).squeeze(1).float(), dim=1)
+                        else:
+                            local_scores_attn += dec.adaptive_softmax.log_prob(
+                                attn_v_e.view(-1, attn_v_e.size(2)))
+                    local_scores_attn /= n_models
+
+                # Attention scores
+                scores_attn = local_scores_attn.new_tensor(
+                    [hyp['score_attn'] for hyp in beam]).unsqueeze(1) + local_scores_attn  # `[n_hyps, vocab]`
+                global_scores = scores_attn * (1 - ctc_weight)
+
+                # Pick up the top-k scores for each hypothesis
+                global_scores_topk, topk_ids = torch.topk(
+                    global_scores, k=beam_width, dim=1, largest=True, sorted=True)  # `[n_hyps, beam_width]`
+
+                # Add LM score
+                scores_lm = None
+                if lm_weight > 0 and lm is not None:
+                    scores_lm = local_scores_attn.new_tensor(
+                        [hyp['score_lm'] for hyp in beam]).unsqueeze(1) + torch.log(lm_probs).gather(1, topk_ids)
+                    global_scores_topk += scores_lm * lm_weight
+
+                # Add length penalty
+                # NOTE: all hypotheses in the beam have the same length
+                if lp_weight > 0:
+                    if gnmt_decoding:
+                        lp = (math.pow(5 + (t + 1), lp_weight)) / math.pow(6, lp_weight)
+                        global_scores_topk /= lp
                     else:
-                        local_scores_attn = probs  # NOTE: already log-scaled
-                    # Generate for the ensemble
-                    if n_models > 1:
-                        for i_e, dec in enumerate(ensmbl_decs):
-                            attn_v_e, _ = dec.generate(ensmbl_cv[i_e],
-                                                       ensmbl_dstates[i_e]['dout_gen'],
-                                                       lmout)
-                            if dec.adaptive_softmax is None:
-                                local_scores_attn += F.log_softmax(dec.output(attn_v_e).squeeze(1), dim=1)
-                            else:
-                                local_scores_attn += dec.adaptive_softmax.log_prob(
-                                    attn_v_e.view(-1, attn_v_e.size(2))).unsqueeze(1)
-                        local_scores_attn /= n_models
-
-                    # Attention scores
-                    scores_attn = beam[i_beam]['score_attn'] + local_scores_attn
-                    global_scores = scores_attn * (1 - ctc_weight)
-
-                    # Pick up the top-k scores
-                    global_scores_topk, topk_ids = torch.topk(
-                        global_scores, k=beam_width, dim=1, largest=True, sorted=True)
-
-                    # Add LM score
-                    if lm_weight > 0 and lm is not None:
-                        global_scores_lm = beam[i_beam]['score_lm'] + torch.log(lm_probs)[0, topk_ids[0]]
-                        global_scores_topk += global_scores_lm * lm_weight
+                        global_scores_topk += (t + 1) * lp_weight
+
+                # Add coverage penalty
+                cp = global_scores_topk.new_zeros(n_hyps)
+                if cp_weight > 0:
+                    aw_mat = torch.cat([torch.stack(hyp['aws'][1:] + [aw[i:i + 1]], dim=-1)
+                                        for i, hyp in enumerate(beam)], dim=0)  # `[n_hyps, T, n_heads, len(hyp)]`
+                    aw_mat = aw_mat[:, :, :, 0]
+                    if gnmt_decoding:
+                        aw_mat = torch.log(aw_mat.sum(-1))
+                        cp = torch.where(aw_mat < 0, aw_mat, aw_mat.new_zeros(aw_mat.size())).sum(-1)
+                        # TODO (hirofumi): mask by elens[b]
                     else:
-                        global_scores_lm = torch.zeros((beam_width), dtype=torch.float32)
-
-                    # Add length penalty
-                    lp = 1.0
-                    if lp_weight > 0:
-                        if gnmt_decoding:
-                            lp = (math.pow(5 + (len(beam[i_beam]['hyp_id']) - 1 + 1),
-                                           lp_weight)) / math.pow(6, lp_weight)
-                            global_scores_topk /= lp
-                        else:
-                            global_scores_topk += (len(beam[i_beam]['hyp_id']) - 1 + 1) * lp_weight
-
-                    # Add coverage penalty
-                    cp = 0.0
-                    aw_mat = None
-                    if cp_weight > 0:
-                        aw_mat = torch.stack(beam[i_beam]['aws'][1:] + [aw], dim=-1)  # `[B, T, len(hyp), n_heads]`
-                        aw_mat = aw_mat[:, :, :, 0]
-                        if gnmt_decoding:
-                            aw_mat = torch.log(aw_mat.sum(-1))
-                            cp = torch.where(aw_mat < 0, aw_mat, aw_mat.new_zeros(aw_mat.size())).sum()
-                            # TODO (hirofumi): mask by elens[b]
-                            global_scores_topk += cp * cp_weight
+                        # Recompute converage penalty in each step
+                        if cp_threshold == 0:
+                            cp = aw_mat.sum(-1).sum(-1) / self.score.n_heads
                         else:
-                            # Recompute converage penalty in each step
-                            if cp_threshold == 0:
-                                cp = aw_mat.sum() / self.score.n_heads
-                            else:
-                                cp = torch.where(aw_mat > cp_threshold, aw_mat,
-                                                 aw_mat.new_zeros(aw_mat.size())).sum() / self.score.n_heads
-                            global_scores_topk += cp * cp_weight
-
-                    # CTC score
-                    if ctc_weight > 0 and ctc_log_probs is not None:
-                        ctc_scores, ctc_states = ctc_prefix_score(
-                            beam[i_beam]['hyp_id'], tensor2np(topk_ids[0]), beam[i_beam]['ctc_state'])
-                        global_scores_ctc = torch.from_numpy(ctc_scores).cuda(self.device_id)
-                        global_scores_topk += global_scores_ctc * ctc_weight
-                        # Sort again
-                        global_scores_topk, joint_ids_topk = torch.topk(
-                            global_scores_topk, k=beam_width, dim=1, largest=True, sorted=True)
-                        topk_ids = topk_ids[:, joint_ids_topk[0]]
-                    else:
-                        global_scores_ctc = torch.zeros((beam_width,), dtype=torch.float32)
-
-                    for k in range(beam_width):
-                        idx = topk_ids[0, k].item()
-                        score = global_scores_topk[0, k].item()
-
-                        # Exclude short hypotheses
-                        if idx == self.eos:
-                            if len(beam[i_beam]['hyp_id']) - 1 < elens[b] * min_len_ratio:
-                                continue
-                            # EOS threshold
-                            max_score_except_eos = local_scores_attn[0, :idx].max(0)[0].item()
-                            max_score_except_eos = max(
-                                max_score_except_eos, local_scores_attn[0, idx + 1:].max(0)[0].item())
-                            if local_scores_attn[0, idx].item() <= eos_threshold * max_score_except_eos:
-                                continue
-
-                        new_beam.append(
-                            {'hyp_id': beam[i_beam]['hyp_id'] + [idx],
-                             'ref_id': beam[i_beam]['ref_id'] + refs_id[b][t:t + 1] if oracle else [],
-                             'score': score,  # total score
-                             'hist_score': beam[i_beam]['hist_score'] + [score],
-                             'score_attn': scores_attn[0, idx].item(),
-                             'score_cp': cp,
-                             'score_ctc': global_scores_ctc[k].item(),
-                             'score_lm': global_scores_lm[k].item(),
-                             'dstates': dstates,
-                             'cv': attn_v if self.input_feeding else cv,
-                             'cv_hist': cv_hist,
-                             'hxs_hist': hxs_hist,
-                             'cxs_hist': cxs_hist,
-                             'aws': beam[i_beam]['aws'] + [aw],
-                             'lm_hxs': lmstate[0][:] if lmstate is not None else None,
-                             'lm_cxs': lmstate[1][:] if lmstate is not None else None,
-                             'ensmbl_dstates': ensmbl_dstates,
-                             'ensmbl_cv': ensmbl_cv,
-                             'ensmbl_aws': ensmbl_aws,
-                             'ctc_state': ctc_states[joint_ids_topk[0, k]] if ctc_log_probs is not None else None,
-                             'ctc_score': ctc_scores[joint_ids_topk[0, k]] if ctc_log_probs is not None else None,
-                             'cache_ids': beam[i_beam]['cache_ids'] + [idx],
-                             'cache_sp_key': beam[i_beam]['cache_sp_key'] + [torch.cat([cv, dstates['dout_gen']], dim=-1)],
-                             'cache_lm_key': beam[i_beam]['cache_lm_key'] + [lmout],
-                             'cache_idx_hist': beam[i_beam]['cache_idx_hist'] + [cache_ids],
-                             'cache_sp_attn_hist': beam[i_beam]['cache_sp_attn_hist'] + [cache_sp_attn] if cache_sp_attn is not None else [],
-                             'cache_lm_attn_hist': beam[i_beam]['cache_lm_attn_hist'] + [cache_lm_attn] if cache_lm_attn is not None else [],
-                             })
-
-                new_beam = sorted(new_beam, key=lambda x: x['score'], reverse=True)
+                            cp = torch.where(aw_mat > cp_threshold, aw_mat,
+                                             aw_mat.new_zeros(aw_mat.size())).sum(-1).sum(-1) / self.score.n_heads
+                    global_scores_topk += cp.unsqueeze(1) * cp_weight
+
+                # CTC score
+                if ctc_weight > 0 and ctc_log_probs is not None:
+                    ctc_scores, ctc_states = [], []
+                    for i, hyp in enumerate(beam):
+                        ctc_scores_i, ctc_states_i = ctc_prefix_score(
+                            hyp['hyp_id'], tensor2np(topk_ids[i]), hyp['ctc_state'])
+                        ctc_scores += [ctc_scores_i]
+                        ctc_states += [ctc_states_i]
+                    global_scores_ctc = torch.from_numpy(np.stack(ctc_scores, axis=0)).to(global_scores_topk)
+                    global_scores_topk += global_scores_ctc * ctc_weight
+
+                # Exclude short hypotheses
+                is_eos = topk_ids == self.eos
+                if t < elens[b] * min_len_ratio:
+                    global_scores_topk.masked_fill_(is_eos, float('-inf'))
+                else:
+                    # EOS threshold
+                    max_score_except_eos = torch.cat([local_scores_attn[:, :self.eos],
+                                                      local_scores_attn[:, self.eos + 1:]], dim=1).max(1)[0]
+                    below_threshold = local_scores_attn[:, self.eos] <= eos_threshold * max_score_except_eos
+                    global_scores_topk.masked_fill_(is_eos & below_threshold.unsqueeze(1), float('-inf'))
+
+                # Pick up the top-k scores over all hypotheses
+                global_scores_topk, flat_ids = torch.topk(
+                    global_scores_topk.view(-1), k=min(beam_width, global_scores_topk.numel()),
+                    largest=True, sorted=True)
+                global_scores_topk = global_scores_topk.tolist()
+                flat_ids = flat_ids.tolist()
+                cand_beam_ids = [j // beam_width for j in flat_ids]
+                cand_ids = [j % beam_width for j in flat_ids]
+                cand_token_ids = topk_ids[cand_beam_ids, cand_ids].tolist()
+                scores_attn_topk = scores_attn[cand_beam_ids, cand_token_ids].tolist()
+                if scores_lm is not None:
+                    scores_lm_topk = scores_lm[cand_beam_ids, cand_ids].tolist()
+                cp = cp.tolist()
+
+                # States of the hypotheses generated in this step
+                states = {'dstates': dstates,
+                          'cv': attn_v if self.input_feeding else cv,
+                          'aw': aw,
+                          'lmstate': lmstate,
+                          'ensmbl_dstates': ensmbl_dstates,
+                          'ensmbl_cv': ensmbl_cv,
+                          'ensmbl_aw': ensmbl_aw}
+
+                new_beam = []
+                for k in range(len(flat_ids)):
+                    score = global_scores_topk[k]
+                    if score == float('-inf'):
+                        continue
+                    i, idx = cand_beam_ids[k], cand_token_ids[k]
+                    hyp = beam[i]
+
+                    new_beam.append(
+                        {'hyp_id': hyp['hyp_id'] + [idx],
+                         'ref_id': hyp['ref_id'] + refs_id[b][t:t + 1] if oracle else [],
+                         'score': score,  # total score
+                         'hist_score': hyp['hist_score'] + [score],
+                         'score_attn': scores_attn_topk[k],
+                         'score_cp': cp[i],
+                         'score_ctc': float(ctc_scores[i][cand_ids[k]]) if ctc_weight > 0 and ctc_log_probs is not None else 0.0,
+                         'score_lm': scores_lm_topk[k] if scores_lm is not None else 0.0,
+                         'aws': hyp['aws'] + [aw[i:i + 1]],
+                         'states': states,
+                         'beam_idx': i,
+                         'ctc_state': ctc_states[i][cand_ids[k]] if ctc_weight > 0 and ctc_log_probs is not None else None,
+                         'ctc_score': ctc_scores[i][cand_ids[k]] if ctc_weight > 0 and ctc_log_probs is not None else None,
+                         'cache_ids': hyp['cache_ids'] + [idx],
+                         'cache_sp_key': hyp['cache_sp_key'] + [torch.cat([cv[i:i + 1], dstates['dout_gen'][i:i + 1]], dim=-1)] if n_caches > 0 else [],
+                         'cache_lm_key': hyp['cache_lm_key'] + [lmout[i:i + 1] if lmout is not None else None] if n_caches > 0 else [],
+                         'cache_idx_hist': hyp['cache_idx_hist'] + [cache_ids[i]],
+                         'cache_sp_attn_hist': hyp['cache_sp_attn_hist'] + [cache_sp_attn[i]] if cache_sp_attn[i] is not None else [],
+                         'cache_lm_attn_hist': hyp['cache_lm_attn_hist'] + [cache_lm_attn[i]] if cache_lm_attn[i] is not None else [],
+                         })
+                # NOTE: new_beam is already sorted by the score
 
                 # Remove complete hypotheses
                 not_complete = []
@@ -1271,6 +1205,8 @@ class RNNDecoder(nn.Module):
                     complete = complete[: beam_width]
                     break
                 beam = not_complete[: beam_width]
+                if len(beam) == 0:
+                    break
 
             # Pruning
             if len(complete) == 0:
@@ -1297,7 +1233,7 @@ class RNNDecoder(nn.Module):
                         lm_out_rev, (lm_rev_hxs, lm_rev_cxs) = lm_rev.decode(
                             lm_rev.encode(eouts.new_zeros(1, 1).fill_(complete[i]['hyp_id'][-1 - t]).long()),
                             (lm_hxs, lm_rev_cxs))
-                        lm_log_probs = F.log_softmax(lm_rev.generate(lm_out_rev).squeeze(1), dim=-1)
+                        lm_log_probs = F.log_softmax(lm_rev.generate(lm_out_rev).squeeze(1).float(), dim=-1)
                         score_lm_rev += lm_log_probs[0, complete[i]['hyp_id'][-2 - t]]
                     if gnmt_decoding:
                         score_lm_rev /= lp  # normalize
@@ -1468,14 +1404,165 @@ class RNNDecoder(nn.Module):
                 self.total_step += len(complete[0]['hyp_id'][1:])
 
         # Store ASR/LM state
-        self.dstates_final = complete[0]['dstates']
-        self.lmstate_final = (complete[0]['lm_hxs'], complete[0]['lm_cxs'])
+        states = self._select_states(complete[0]['states'], eouts.new_tensor([complete[0]['beam_idx']], dtype=torch.long))
+        self.dstates_final = states['dstates']
+        self.lmstate_final = states['lmstate']
 
         if 'speech' in cache_type:
             return nbest_hyps_idx, aws, scores, (cache_sp_attn_hist, cache_idx_hist)
         else:
             return nbest_hyps_idx, aws, scores, (cache_lm_attn_hist, cache_idx_hist)
 
+    def _select_states(self, states, beam_ids):
+        """Select states of hypotheses stacked in the batch dimension.
+
+        Args:
+            states (dict): states of hypotheses generated in the same step
+            beam_ids (LongTensor): `[n_hyps]` indices in the batch dimension
+        Returns:
+            states (dict): states of the selected hypotheses
+
+        """
+        def select_dstates(dstates):
+            hxs, cxs = dstates['dstate']
+            dstates_new = {k: v.index_select(0, beam_ids) if torch.is_tensor(v) else v
+                           for k, v in dstates.items() if k != 'dstate'}
+            dstates_new['dstate'] = ([h.index_select(0, beam_ids) for h in hxs],
+                                     [c.index_select(0, beam_ids) for c in cxs])
+            return dstates_new
+
+        # NOTE: the batch dimension of LM states is the 2nd one
+        lmstate = states['lmstate']
+        if torch.is_tensor(lmstate):
+            lmstate = lmstate.index_select(1, beam_ids)
+        else:
+            lmstate = tuple(s.index_select(1, beam_ids) if torch.is_tensor(s) else s for s in lmstate)
+
+        return {'dstates': select_dstates(states['dstates']),
+                'cv': states['cv'].index_select(0, beam_ids),
+                'aw': states['aw'].index_select(0, beam_ids) if states['aw'] is not None else None,
+                'lmstate': lmstate,
+                'ensmbl_dstates': [select_dstates(dstates) for dstates in states['ensmbl_dstates']],
+                'ensmbl_cv': [cv.index_select(0, beam_ids) for cv in states['ensmbl_cv']],
+                'ensmbl_aw': [aw.index_select(0, beam_ids) if aw is not None else None
+                              for aw in states['ensmbl_aw']]}
+
+    def _cache_probs(self, probs, lm_probs, cv, dout_gen, lmout, hyp, params):
+        """Interpolate output probabilities of a hypothesis with the cache.
+
+        Args:
+            probs (FloatTensor): `[1, vocab]`
+            lm_probs (FloatTensor): `[1, vocab]`
+            cv (FloatTensor): `[1, 1, enc_n_units]`
+            dout_gen (FloatTensor): `[1, 1, dec_n_units]`
+            lmout (FloatTensor): `[1, 1, lm_n_units]`
+            hyp (dict): hypothesis in the beam
+            params (dict): hyperparameters for decoding
+        Returns:
+            probs (FloatTensor): `[1, vocab]`
+            lm_probs (FloatTensor): `[1, vocab]`
+            cache_ids (list): token indices in the cache
+            cache_sp_attn (FloatTensor): `[1, L, 1]`
+            cache_lm_attn (FloatTensor): `[1, L, 1]`
+
+        """
+        lm_weight = params['recog_lm_weight']
+        n_caches = params['recog_n_caches']
+        cache_theta_sp = params['recog_cache_theta_speech']
+        cache_lambda_sp = params['recog_cache_lambda_speech']
+        cache_theta_lm = params['recog_cache_theta_lm']
+        cache_lambda_lm = params['recog_cache_lambda_lm']
+        cache_type = params['recog_cache_type']
+
+        cache_ids = None
+        cache_sp_attn = None
+        cache_lm_attn = None
+        cache_probs_sp = probs.new_zeros(probs.size())
+        cache_probs_lm = probs.new_zeros(probs.size())
+
+        # Compute inner-product over caches
+        if 'speech_fifo' in cache_type:
+            is_cache = True
+            if 'online' in cache_type and len(self.fifo_cache_ids + hyp['cache_ids']) > 0:
+                cache_ids = (self.fifo_cache_ids + hyp['cache_ids'])[-n_caches:]
+                cache_sp_key = hyp['cache_sp_key'][-n_caches:]
+                if len(cache_sp_key) > 0:
+                    cache_sp_key = torch.cat(cache_sp_key, dim=1)
+                    if self.fifo_cache_sp_key is not None:
+                        cache_sp_key = torch.cat([self.fifo_cache_sp_key, cache_sp_key], dim=1)
+                else:
+                    cache_sp_key = self.fifo_cache_sp_key  # for the first token
+                # Truncate
+                cache_sp_key = cache_sp_key[:, -n_caches:]  # `[1, L, enc_n_units]`
+            elif 'online' not in cache_type and len(self.fifo_cache_ids) > 0:
+                cache_ids = self.fifo_cache_ids
+                cache_sp_key = self.fifo_cache_sp_key
+            else:
+                is_cache = False
+
+            if is_cache:
+                cache_sp_attn = F.softmax(cache_theta_sp * torch.matmul(
+                    cache_sp_key, torch.cat([cv, dout_gen], dim=-1).transpose(2, 1)), dim=1)  # `[1, L, 1]`
+                # Sum all probabilities
+                for c in set(hyp['cache_ids']):
+                    for offset in [i for i, key in enumerate(cache_ids) if key == c]:
+                        cache_probs_sp[0, c] += cache_sp_attn[0, offset, 0]
+                probs = (1 - cache_lambda_sp) * probs + cache_lambda_sp * cache_probs_sp
+
+        if 'lm_fifo' in cache_type:
+            is_cache = True
+            if 'online' in cache_type and len(self.fifo_cache_ids + hyp['cache_ids']) > 0:
+                assert lm_weight > 0
+                cache_ids = (self.fifo_cache_ids + hyp['cache_ids'])[-n_caches:]
+                cache_lm_key = hyp['cache_lm_key'][-n_caches:]
+                if len(cache_lm_key) > 0:
+                    cache_lm_key = torch.cat(cache_lm_key, dim=1)
+                    if self.fifo_cache_lm_key is not None:
+                        cache_lm_key = torch.cat([self.fifo_cache_lm_key, cache_lm_key], dim=1)
+                else:
+                    cache_lm_key = self.fifo_cache_lm_key   # for the first token
+                # Truncate
+                cache_lm_key = cache_lm_key[:, -n_caches:]  # `[1, L, lm_n_units]`
+            elif 'online' not in cache_type and len(self.fifo_cache_ids) > 0:
+                cache_ids = self.fifo_cache_ids
+                cache_lm_key = self.fifo_cache_lm_key
+            else:
+                is_cache = False
+
+            if is_cache:
+                cache_lm_attn = F.softmax(cache_theta_lm * torch.matmul(
+                    cache_lm_key, lmout.transpose(2, 1)), dim=1)  # `[1, L, 1]`
+                # Sum all probabilities
+                for c in set(hyp['cache_ids']):
+                    for offset in [i for i, key in enumerate(cache_ids) if key == c]:
+                        cache_probs_lm[0, c] += cache_lm_attn[0, offset, 0]
+                lm_probs = (1 - cache_lambda_lm) * lm_probs + cache_lambda_lm * cache_probs_lm
+
+        if 'speech_dict' in cache_type and len(self.dict_cache_sp.keys()) > 0:
+            cache_ids = sorted(list(self.dict_cache_sp.keys()))
+            cache_ids = [self.unk if idx < 0 else idx for idx in cache_ids]
+            cache_sp_key = [v['key']for k, v in sorted(self.dict_cache_sp.items(), key=lambda x: x[0])]
+            cache_sp_key = torch.cat(cache_sp_key, dim=1)
+            cache_sp_attn = F.softmax(cache_theta_sp * torch.matmul(
+                cache_sp_key, torch.cat([cv, dout_gen], dim=-1).transpose(2, 1)), dim=1)  # `[1, L, 1]`
+            # Sum all probabilities
+            for offset, c in enumerate(cache_ids):
+                cache_probs_sp[0, c] += cache_sp_attn[0, offset, 0]
+            probs = (1 - cache_lambda_sp) * probs + cache_lambda_sp * cache_probs_sp
+
+        if 'lm_dict' in cache_type and len(self.dict_cache_lm.keys()) > 0:
+            cache_ids = sorted(list(self.dict_cache_lm.keys()))
+            cache_lm_key = [v['key']for k, v in sorted(self.dict_cache_lm.items(), key=lambda x: x[0])]
+            cache_lm_key = torch.cat(cache_lm_key, dim=1)
+            cache_lm_attn = F.softmax(cache_theta_lm * torch.matmul(
+                cache_lm_key, lmout.transpose(2, 1)), dim=1)  # `[1, L, 1]`
+            # Sum all probabilities
+            for offset, c in enumerate(cache_ids):
+                cache_probs_lm[0, c] += cache_lm_attn[0, offset, 0]
+            probs = (1 - cache_lambda_lm) * probs + cache_lambda_lm * cache_probs_lm
+
+        return probs, lm_probs, cache_ids, cache_sp_attn, cache_lm_attn
+
     def reset_global_cache(self):
         """Reset global cache when the speaker/session is changed."""
         self.fifo_cache_ids = []
@@ -1498,7 +1585,7 @@ class RNNDecoder(nn.Module):
             best_hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
 
         """
-        log_probs = F.log_softmax(self.output_ctc(eouts), dim=-1)
+        log_probs = F.log_softmax(self.output_ctc(eouts).float(), dim=-1)
         if beam_width == 1:
             best_hyps = self.decode_ctc_greedy(log_probs, xlens)
         else:
@@ -1507,10 +1594,11 @@ class RNNDecoder(nn.Module):
         return best_hyps
 
     def ctc_log_probs(self, eouts, temperature=1):
-        return F.log_softmax(self.output_ctc(eouts) / temperature, dim=-1)
+        # NOTE: CTCPrefixScore is computed with fp32 log-probabilities
+        return F.log_softmax(self.output_ctc(eouts).float() / temperature, dim=-1)
 
     def ctc_probs_topk(self, eouts, temperature, topk):
-        probs = F.softmax(self.output_ctc(eouts) / temperature, dim=-1)
+        probs = F.softmax(self.output_ctc(eouts).float() / temperature, dim=-1)
         if topk is None:
             topk = probs.size(-1)
         _, topk_ids = torch.topk(probs.sum(1), k=topk, dim=-1, largest=True, sorted=True)
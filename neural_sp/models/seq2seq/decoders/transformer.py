@@ -34,9 +34,10 @@ from neural_sp.models.seq2seq.decoders.multihead_attention import MultiheadAtten
 from neural_sp.models.seq2seq.decoders.ctc_beam_search import BeamSearchDecoder
 from neural_sp.models.seq2seq.decoders.ctc_beam_search import CTCPrefixScore
 from neural_sp.models.seq2seq.decoders.ctc_greedy import GreedyDecoder
+from neural_sp.models.torch_utils import append_sos_eos
 from neural_sp.models.torch_utils import compute_accuracy
 from neural_sp.models.torch_utils import np2tensor
-from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import pad_ids
 from neural_sp.models.torch_utils import tensor2np
 
 random.seed(1)
@@ -220,7 +221,8 @@ class TransformerDecoder(nn.Module):
         Args:
             eouts (FloatTensor): `[B, T, d_model]`
             elens (list): A list of length `[B]`
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
         Returns:
             loss (FloatTensor): `[1]`
 
@@ -229,14 +231,15 @@ class TransformerDecoder(nn.Module):
 
         # Compute the auxiliary CTC loss
         elens_ctc = np2tensor(np.fromiter(elens, dtype=np.int32), -1).int()
-        ys_ctc = [np2tensor(np.fromiter(y, dtype=np.int64)).long() for y in ys]  # always fwd
-        ylens = np2tensor(np.fromiter([y.size(0) for y in ys_ctc], dtype=np.int32), -1).int()
-        ys_ctc = torch.cat(ys_ctc, dim=0).int()
+        ys_ctc = ys if torch.is_tensor(ys) else pad_ids(ys, -1)  # always fwd
+        ylens = (ys_ctc >= 0).sum(1).int()
+        ys_ctc = ys_ctc[ys_ctc >= 0].int()
         # NOTE: Concatenate all elements in ys for warpctc_pytorch
         # NOTE: do not copy to GPUs here
 
         # Compute CTC loss
-        loss = self.warpctc_loss(logits.transpose(1, 0).cpu(),  # time-major
+        # NOTE: warpctc_pytorch supports only fp32
+        loss = self.warpctc_loss(logits.transpose(1, 0).float().cpu(),  # time-major
                                  ys_ctc, elens_ctc, ylens)
         # NOTE: ctc loss has already been normalized by bs
         # NOTE: index 0 is reserved for blank in warpctc_pytorch
@@ -258,7 +261,8 @@ class TransformerDecoder(nn.Module):
         Args:
             eouts (FloatTensor): `[B, T, d_model]`
             elens (list): A list of length `[B]`
-            ys (list): A list of length `[B]`, which contains a list of size `[L]`
+            ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+                or `[B, L_max]` padded with -1 by the data loader
         Returns:
             loss (FloatTensor): `[1]`
             acc (float):
@@ -268,14 +272,8 @@ class TransformerDecoder(nn.Module):
         bs = eouts.size(0)
 
         # Append <sos> and <eos>
-        eos = eouts.new_zeros((1,)).fill_(self.eos).long()
-        ylens = [len(y) for y in ys]
-        ys = [np2tensor(np.fromiter(y[::-1] if self.backward else y, dtype=np.int64), self.device_id).long()
-              for y in ys]
-        ys_in = [torch.cat([eos, y], dim=0) for y in ys]
-        ys_out = [torch.cat([y, eos], dim=0) for y in ys]
-        ys_in_pad = pad_list(ys_in, self.pad)
-        ys_out_pad = pad_list(ys_out, self.pad)
+        ys_in_pad, ys_out_pad, ylens = append_sos_eos(ys, self.eos, self.pad, self.backward, self.device_id)
+        ylens = ylens.tolist()
 
         # Add positional embedding
         ys_emb = self.embed(ys_in_pad) * (self.d_model ** 0.5)
@@ -294,10 +292,10 @@ class TransformerDecoder(nn.Module):
             if self.lsm_prob > 0:
                 # Label smoothing
                 loss = cross_entropy_lsm(logits, ys_out_pad,
-                                         ylens=[y.size(0) for y in ys_out],
+                                         ylens=[ylen + 1 for ylen in ylens],
                                          lsm_prob=self.lsm_prob, size_average=False) / bs
             else:
-                loss = F.cross_entropy(logits.view((-1, logits.size(2))), ys_out_pad.view(-1),
+                loss = F.cross_entropy(logits.view((-1, logits.size(2))).float(), ys_out_pad.view(-1),
                                        ignore_index=self.pad, size_average=False) / bs
         else:
             loss = self.adaptive_softmax(logits.view((-1, logits.size(2))),
@@ -420,7 +418,7 @@ class TransformerDecoder(nn.Module):
             best_hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
 
         """
-        log_probs = F.log_softmax(self.output_ctc(eouts), dim=-1)
+        log_probs = F.log_softmax(self.output_ctc(eouts).float(), dim=-1)
         if beam_width == 1:
             best_hyps = self.decode_ctc_greedy(log_probs, xlens)
         else:
@@ -441,7 +439,8 @@ class TransformerDecoderBlock(nn.Module):
             attn_n_heads (int): number of heads for multi-head attention
             dropout (float): dropout probabilities for linear layers
             dropout_att (float): dropout probabilities for attention probabilities
-            attn_type (str): type of self-attention, scaled_dot_product or average
+            attn_type (str): type of self-attention, scaled_dot_product or average.
+                local is regarded as scaled_dot_product since it is used in the encoder only.
             layer_norm_eps (float):
 
     """
@@ -456,10 +455,11 @@ class TransformerDecoderBlock(nn.Module):
                  layer_norm_eps):
         super(TransformerDecoderBlock, self).__init__()
 
-        self.attn_type = attn_type
+        # NOTE: local attention is used in the encoder only
+        self.attn_type = "scaled_dot_product" if attn_type == "local" else attn_type
 
         # self-attention
-        if attn_type == "scaled_dot_product":
+        if self.attn_type == "scaled_dot_product":
             self.self_attn = MultiheadAttentionMechanism(key_dim=d_model,
                                                          query_dim=d_model,
                                                          attn_dim=d_model,
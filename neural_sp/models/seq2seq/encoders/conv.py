@@ -10,12 +10,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import checkpoint
 
 
 class Conv1LBlock(nn.Module):
@@ -130,6 +132,21 @@ class Conv2LBlock(nn.Module):
         self.residual = residual
         self.input_dim = input_dim
 
+    def output_lens(self, xlens):
+        """Return lengths in the time dimension after this block.
+
+        Args:
+            xlens (list): A list of length `[B]`
+        Returns:
+            xlens (IntTensor): `[B]`
+
+        """
+        xlens = update_lens(xlens, self.conv1, dim=0)
+        xlens = update_lens(xlens, self.conv2, dim=0)
+        if self.pool is not None:
+            xlens = update_lens(xlens, self.pool, dim=0)
+        return xlens
+
     def forward(self, xs, xlens):
         """Forward computation.
 
@@ -184,6 +201,7 @@ class ConvEncoder(nn.Module):
         batch_norm (bool): apply batch normalization
         residual (bool): add residual connections
         bottleneck_dim (int): dimension of the bottleneck layer after the last layer
+        checkpoint (bool): recompute activations of each block in backward
 
     """
 
@@ -197,7 +215,8 @@ class ConvEncoder(nn.Module):
                  dropout,
                  batch_norm=False,
                  residual=False,
-                 bottleneck_dim=0):
+                 bottleneck_dim=0,
+                 checkpoint=False):
 
         super(ConvEncoder, self).__init__()
 
@@ -206,6 +225,7 @@ class ConvEncoder(nn.Module):
         self.input_freq = input_dim // in_channel
         self.residual = residual
         self.bottleneck_dim = bottleneck_dim
+        self.checkpoint = checkpoint
 
         assert len(channels) > 0
         assert len(channels) == len(kernel_sizes) == len(strides) == len(poolings)
@@ -237,6 +257,33 @@ class ConvEncoder(nn.Module):
     def output_dim(self):
         return self._output_dim
 
+    @property
+    def subsampling_factor(self):
+        """Subsampling factor in the time dimension."""
+        factor = 1
+        for block in self.layers:
+            factor *= block.conv1.stride[0] * block.conv2.stride[0]
+            if block.pool is not None:
+                factor *= block.pool.stride[0]
+        return factor
+
+    @property
+    def context_size(self):
+        """Number of input frames on the left and right sides that each output frame
+           depends on beyond the subsampling_factor frames it corresponds to.
+           Zero padding in these frames changes the output.
+        """
+        n_left, n_right, jump = 0, 0, 1
+        for block in self.layers:
+            for conv in [block.conv1, block.conv2]:
+                n_left += conv.padding[0] * jump
+                n_right += (conv.kernel_size[0] - 1 - conv.padding[0]) * jump
+                jump *= conv.stride[0]
+            if block.pool is not None:
+                n_right += (block.pool.kernel_size[0] - 1) * jump
+                jump *= block.pool.stride[0]
+        return n_left, n_right - (jump - 1)
+
     def forward(self, xs, xlens):
         """Forward computation.
 
@@ -254,7 +301,12 @@ class ConvEncoder(nn.Module):
         xs = xs.view(bs, time, self.in_channel, input_dim // self.in_channel).contiguous().transpose(2, 1)
 
         for block in self.layers:
-            xs, xlens = block(xs, xlens)
+            if self.checkpoint and torch.is_grad_enabled():
+                # NOTE: only xs is passed through checkpoint because xlens does not depend on it
+                xs = checkpoint(functools.partial(self._forward_block, block=block, xlens=xlens), xs)
+                xlens = block.output_lens(xlens)
+            else:
+                xs, xlens = block(xs, xlens)
 
         # Collapse feature dimension
         bs, out_ch, time, freq = xs.size()
@@ -267,6 +319,12 @@ class ConvEncoder(nn.Module):
         return xs, xlens
 
 
+    @staticmethod
+    def _forward_block(xs, block, xlens):
+        """Return only the features of a CNN block for checkpointing."""
+        return block(xs, xlens)[0]
+
+
 def update_lens(xlens, layer, dim=0):
     assert type(layer) in [nn.Conv2d, nn.MaxPool2d]
     if type(layer) == nn.MaxPool2d:
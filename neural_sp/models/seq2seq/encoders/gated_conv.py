@@ -11,11 +11,13 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.linear import LinearND
 from neural_sp.models.modules.glu import GLUBlock
+from neural_sp.models.torch_utils import checkpoint
 
 
 class GatedConvEncoder(nn.Module):
@@ -31,6 +33,7 @@ class GatedConvEncoder(nn.Module):
         dropout (float) probability to drop nodes in hidden-hidden connection
         batch_norm (bool): if True, apply batch normalization
         bottleneck_dim (int): dimension of the bottleneck layer after the last layer
+        checkpoint (bool): recompute activations of each block in backward
 
     """
 
@@ -40,7 +43,8 @@ class GatedConvEncoder(nn.Module):
                  channels,
                  kernel_sizes,
                  dropout,
-                 bottleneck_dim=0):
+                 bottleneck_dim=0,
+                 checkpoint=False):
 
         super(GatedConvEncoder, self).__init__()
 
@@ -48,6 +52,7 @@ class GatedConvEncoder(nn.Module):
         assert input_dim % in_channel == 0
         self.input_freq = input_dim // in_channel
         self.bottleneck_dim = bottleneck_dim
+        self.checkpoint = checkpoint
 
         assert len(channels) > 0
         assert len(channels) == len(kernel_sizes)
@@ -91,7 +96,11 @@ class GatedConvEncoder(nn.Module):
         # Reshape to `[B, in_ch (input_dim), T, 1]`
         xs = xs.transpose(2, 1).unsqueeze(3)
 
-        xs = self.layers(xs)  # `[B, out_ch (feat_dim), T, 1]`
+        if self.checkpoint and torch.is_grad_enabled():
+            for layer in self.layers:
+                xs = checkpoint(layer, xs)
+        else:
+            xs = self.layers(xs)  # `[B, out_ch (feat_dim), T, 1]`
 
         # Collapse feature dimension
         bs, out_ch, time, freq = xs.size()
@@ -10,6 +10,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
 import numpy as np
 import torch
 import torch.nn as nn
@@ -21,6 +22,7 @@ from neural_sp.models.modules.linear import LinearND
 from neural_sp.models.seq2seq.encoders.conv import ConvEncoder
 from neural_sp.models.seq2seq.encoders.gated_conv import GatedConvEncoder
 from neural_sp.models.seq2seq.encoders.tds import TDSEncoder
+from neural_sp.models.torch_utils import checkpoint
 
 
 class RNNEncoder(nn.Module):
@@ -52,6 +54,8 @@ class RNNEncoder(nn.Module):
         n_layers_sub2 (int): number of layers in the 2nd auxiliary task
         nin (bool): insert 1*1 conv + batch normalization + ReLU
         task_specific_layer (bool):
+        checkpoint (bool): recompute activations of each layer in backward.
+            The layer-wise implementation is used for RNNs.
 
     """
 
@@ -79,7 +83,8 @@ class RNNEncoder(nn.Module):
                  n_layers_sub1=0,
                  n_layers_sub2=0,
                  nin=False,
-                 task_specific_layer=False):
+                 task_specific_layer=False,
+                 checkpoint=False):
 
         super(RNNEncoder, self).__init__()
 
@@ -96,6 +101,7 @@ class RNNEncoder(nn.Module):
         self.n_dirs = 2 if self.bidirectional else 1
         self.n_projs = n_projs
         self.n_layers = n_layers
+        self.checkpoint = checkpoint
 
         # Setting for hierarchical encoder
         self.n_layers_sub1 = n_layers_sub1
@@ -142,13 +148,15 @@ class RNNEncoder(nn.Module):
                                        in_channel=conv_in_channel,
                                        channels=channels,
                                        kernel_sizes=kernel_sizes,
-                                       dropout=dropout)
+                                       dropout=dropout,
+                                       checkpoint=checkpoint)
             elif rnn_type == 'gated_conv':
                 self.conv = GatedConvEncoder(input_dim=input_dim * n_stacks,
                                              in_channel=conv_in_channel,
                                              channels=channels,
                                              kernel_sizes=kernel_sizes,
-                                             dropout=dropout)
+                                             dropout=dropout,
+                                             checkpoint=checkpoint)
             else:
                 assert n_stacks == 1 and n_splices == 1
                 self.conv = ConvEncoder(input_dim,
@@ -160,7 +168,8 @@ class RNNEncoder(nn.Module):
                                         dropout=0,
                                         batch_norm=conv_batch_norm,
                                         residual=conv_residual,
-                                        bottleneck_dim=conv_bottleneck_dim)
+                                        bottleneck_dim=conv_bottleneck_dim,
+                                        checkpoint=checkpoint)
             self._output_dim = self.conv.output_dim
         else:
             self._output_dim = input_dim * n_splices * n_stacks
@@ -169,7 +178,9 @@ class RNNEncoder(nn.Module):
         if rnn_type not in ['conv', 'tds', 'gated_conv']:
             # Fast implementation without processes between each layer
             self.fast_impl = False
-            if np.prod(self.subsample) == 1 and self.n_projs == 0 and not residual and n_layers_sub1 == 0 and not nin:
+            # NOTE: activations of a multi-layer RNN cannot be recomputed layer by layer
+            if np.prod(self.subsample) == 1 and self.n_projs == 0 and not residual and n_layers_sub1 == 0 and not nin \
+                    and not checkpoint:
                 self.fast_impl = True
                 if 'lstm' in rnn_type:
                     rnn = nn.LSTM
@@ -268,6 +279,78 @@ class RNNEncoder(nn.Module):
     def output_dim(self):
         return self._output_dim
 
+    @property
+    def subsampling_factor(self):
+        """Subsampling factor in the time dimension."""
+        factor = self.conv.subsampling_factor if isinstance(self.conv, ConvEncoder) else 1
+        if self.rnn_type not in ['conv', 'tds', 'gated_conv'] and not self.fast_impl:
+            # NOTE: subsampling is not conducted in the last layer
+            factor *= int(np.prod(self.subsample[:len(self.rnn) - 1]))
+        return factor
+
+    def _subsample(self, xs, l):
+        """Subsample outputs of the l-th layer in the time dimension.
+
+        Args:
+            xs (FloatTensor): `[B, T, n_units (*2)]`
+            l (int): index of the layer
+        Returns:
+            xs (FloatTensor): `[B, T // subsample[l], n_units (*2)]`
+
+        """
+        if self.subsample_type == 'drop':
+            xs = xs[:, 1::self.subsample[l], :]
+            # NOTE: Pick up features at even time step
+        elif self.subsample_type == 'concat':
+            # Concatenate the successive frames
+            bs, time, n_units = xs.size()
+            time //= self.subsample[l]
+            # NOTE: Exclude the last frames if the length of xs is not divisible
+            xs = xs[:, :time * self.subsample[l]].contiguous().view(
+                bs, time, n_units * self.subsample[l])
+            # xs = torch.tanh(self.concat[l](xs))
+
+            # Projection + batch normalization, ReLU
+            xs = self.concat_proj[l](xs)
+            bs, time = xs.size()[:2]
+            xs = xs.view(bs * time, -1)
+            xs = self.concat_bn[l](xs)
+            xs = xs.view(bs, time, -1)
+            xs = F.relu(xs)
+
+        elif self.subsample_type == 'max_pool':
+            # NOTE: Exclude the last frames if the length of xs is not divisible
+            xs = F.max_pool1d(xs.transpose(2, 1), kernel_size=self.subsample[l],
+                              stride=self.subsample[l]).transpose(2, 1)
+        return xs
+
+    def _rnn(self, xs, xlens, l):
+        """Path through the l-th RNN layer and dropout.
+
+        Args:
+            xs (FloatTensor): `[B, T, input_dim]`
+            xlens (list): `[B]` (sorted in the descending order)
+            l (int): index of the layer
+        Returns:
+            xs (FloatTensor): `[B, T, n_units (*2)]`
+
+        """
+        xs = pack_padded_sequence(xs, xlens, batch_first=True)
+        xs, _ = self.rnn[l](xs, hx=None)
+        xs = pad_packed_sequence(xs, batch_first=True)[0]
+        xs = self.dropout[l](xs)
+        return xs
+
+    def _nin(self, xs, l):
+        """NiN (1*1 conv + batch normalization + ReLU) after the l-th layer."""
+        xs = xs.contiguous().transpose(2, 1).unsqueeze(3)  # `[B, n_unis (*2), T, 1]`
+        # NOTE: consider feature dimension as input channel
+        xs = self.nin_conv[l](xs)
+        xs = self.nin_bn[l](xs)
+        xs = F.relu(xs)  # `[B, n_unis (*2), T, 1]`
+        xs = xs.transpose(2, 1).squeeze(3)  # `[B, T, n_unis (*2)]`
+        return xs
+
     def forward(self, xs, xlens, task):
         """Forward computation.
 
@@ -321,10 +404,11 @@ class RNNEncoder(nn.Module):
                 # NOTE: this is necessary for multi-GPUs setting
 
                 # Path through RNN
-                xs = pack_padded_sequence(xs, xlens.tolist(), batch_first=True)
-                xs, _ = self.rnn[l](xs, hx=None)
-                xs = pad_packed_sequence(xs, batch_first=True)[0]
-                xs = self.dropout[l](xs)
+                if self.checkpoint and torch.is_grad_enabled():
+                    # NOTE: xlens is updated in-place after subsampling
+                    xs = checkpoint(functools.partial(self._rnn, xlens=xlens.tolist(), l=l), xs)
+                else:
+                    xs = self._rnn(xs, xlens.tolist(), l)
 
                 # Pick up outputs in the sub task before the projection layer
                 if l == self.n_layers_sub1 - 1:
@@ -367,44 +451,14 @@ class RNNEncoder(nn.Module):
                 if l != len(self.rnn) - 1:
                     # Subsampling
                     if self.subsample[l] > 1:
-                        if self.subsample_type == 'drop':
-                            xs = xs[:, 1::self.subsample[l], :]
-                            # NOTE: Pick up features at even time step
-                        elif self.subsample_type == 'concat':
-                            # Concatenate the successive frames
-                            xs = xs.transpose(1, 0).contiguous()
-                            xs = [torch.cat([xs[t - r:t - r + 1] for r in range(self.subsample[l] - 1, -1, -1)], dim=-1)
-                                  for t in range(xs.size(0)) if (t + 1) % self.subsample[l] == 0]
-                            # NOTE: Exclude the last frame if the length of xs is odd
-                            xs = torch.cat(xs, dim=0).transpose(1, 0)
-                            # xs = torch.tanh(self.concat[l](xs))
-
-                            # Projection + batch normalization, ReLU
-                            xs = self.concat_proj[l](xs)
-                            bs, time = xs.size()[:2]
-                            xs = xs.view(bs * time, -1)
-                            xs = self.concat_bn[l](xs)
-                            xs = xs.view(bs, time, -1)
-                            xs = F.relu(xs)
-
-                        elif self.subsample_type == 'max_pool':
-                            xs = xs.transpose(1, 0).contiguous()
-                            xs = [torch.max(xs[t - self.subsample[l] + 1:t + 1], dim=0)[0].unsqueeze(0)
-                                  for t in range(xs.size(0)) if (t + 1) % self.subsample[l] == 0]
-                            # NOTE: Exclude the last frame if the length of xs is odd
-                            xs = torch.cat(xs, dim=0).transpose(1, 0)
+                        xs = self._subsample(xs, l)
 
                         # Update xlens
                         xlens //= self.subsample[l]
 
                     # NiN (1*1 conv + batch normalization + ReLU)
                     if self.nin:
-                        xs = xs.contiguous().transpose(2, 1).unsqueeze(3)  # `[B, n_unis (*2), T, 1]`
-                        # NOTE: consider feature dimension as input channel
-                        xs = self.nin_conv[l](xs)
-                        xs = self.nin_bn[l](xs)
-                        xs = F.relu(xs)  # `[B, n_unis (*2), T, 1]`
-                        xs = xs.transpose(2, 1).squeeze(3)  # `[B, T, n_unis (*2)]`
+                        xs = self._nin(xs, l)
 
                     # Residual connection
                     if self.residual and residual is not None:
@@ -427,6 +481,88 @@ class RNNEncoder(nn.Module):
 
         return eouts
 
+    def forward_chunk(self, xs, state=None, n_left=0, n_lookahead=0, n_caches=0):
+        """Encode a chunk of streams for streaming inference.
+           Unidirectional RNNs carry hidden states over chunks, and the output is
+           identical to that of forward() when chunk sizes are multiples of subsampling_factor.
+           With CNN blocks, n_left and n_lookahead must also cover conv.context_size.
+           Otherwise the zero padding at chunk edges makes the output approximate.
+           Bidirectional RNNs re-encode the left context and lookahead frames with
+           every chunk from zero states, which approximates forward().
+
+        Args:
+            xs (FloatTensor): `[B, n_left + chunk_size + n_lookahead, input_dim]`
+            state (list): hidden states returned for the previous chunk (None for the first chunk)
+            n_left (int): number of left context frames at the beginning of xs.
+                This is used as the context of the CNN blocks and bidirectional RNNs.
+            n_lookahead (int): number of lookahead frames at the end of xs
+            n_caches (int): not used (for compatibility with TransformerEncoder)
+        Returns:
+            xs (FloatTensor): `[B, chunk_size // subsampling_factor, n_units (*2)]`
+            state (list): hidden states at the end of the chunk
+
+        """
+        if self.conv is not None and not isinstance(self.conv, ConvEncoder):
+            raise NotImplementedError('Streaming inference is not supported for %s.' % self.rnn_type)
+
+        bs, time = xs.size()[:2]
+        n_center = time - n_left - n_lookahead
+
+        xs = self.dropout_in(xs)
+
+        # Path through CNN blocks before RNN layers
+        if self.conv is not None:
+            factor = self.conv.subsampling_factor
+            xs, _ = self.conv(xs, [time] * bs)
+            n_left //= factor
+            n_center = xs.size(1) - n_left - int(np.ceil(n_lookahead / factor))
+            if self.rnn_type == 'conv':
+                return xs[:, n_left:n_left + n_center], state
+
+        if not self.bidirectional:
+            # NOTE: the left context is summarized in the hidden states
+            xs = xs[:, n_left:n_left + n_center]
+            n_left = 0
+
+        if self.fast_impl:
+            self.rnn.flatten_parameters()
+            xs, hx = self.rnn(xs, hx=state if not self.bidirectional else None)
+            xs = self.dropout_top(xs)
+            state = hx if not self.bidirectional else None
+        else:
+            new_state = []
+            residual = None
+            for l in range(len(self.rnn)):
+                self.rnn[l].flatten_parameters()
+                hx = state[l] if state is not None and not self.bidirectional else None
+                xs, hx = self.rnn[l](xs, hx=hx)
+                new_state.append(hx)
+                xs = self.dropout[l](xs)
+
+                # Projection layer
+                if self.n_projs > 0:
+                    xs = torch.tanh(self.proj[l](xs))
+
+                # NOTE: Exclude the last layer
+                if l != len(self.rnn) - 1:
+                    # Subsampling
+                    if self.subsample[l] > 1:
+                        xs = self._subsample(xs, l)
+                        n_left //= self.subsample[l]
+                        n_center //= self.subsample[l]
+
+                    # NiN (1*1 conv + batch normalization + ReLU)
+                    if self.nin:
+                        xs = self._nin(xs, l)
+
+                    # Residual connection
+                    if self.residual and residual is not None:
+                        xs += residual
+                    residual = xs
+            state = new_state if not self.bidirectional else None
+
+        return xs[:, n_left:n_left + n_center], state
+
 
 def to2d(xs, size):
     return xs.contiguous().view((int(np.prod(size[: -1])), int(size[-1])))
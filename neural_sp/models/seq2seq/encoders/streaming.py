@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Chunk-wise encoder for streaming inference."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+
+from neural_sp.models.seq2seq.encoders.conv import ConvEncoder
+
+
+class StreamingEncoder(object):
+    """Encode streams of features incrementally in fixed-size chunks.
+
+       Features are buffered until a chunk and its lookahead frames are available.
+       Each chunk is encoded by encoder.forward_chunk() together with the left context
+       and lookahead frames, and the state of the encoder is carried to the next chunk.
+
+       Outputs of unidirectional RNN encoders are identical to encoder.forward() only if
+       the CNN front-end (if any) sees its whole receptive field, i.e., n_left and
+       n_lookahead are not smaller than encoder.conv.context_size (rounded up to
+       multiples of subsampling_factor). Otherwise, CNN outputs near chunk edges are
+       computed with zero padding instead of the neighboring frames, and the encoder
+       outputs are approximate. Outputs of bidirectional RNN and Transformer encoders
+       are always approximate.
+
+    Args:
+        encoder (RNNEncoder or TransformerEncoder):
+        chunk_size (int): number of input frames in each chunk
+        n_left (int): number of left context frames. For Transformer encoders,
+            the same number of frames (after subsampling) are cached in each layer.
+        n_lookahead (int): number of lookahead frames
+
+    """
+
+    def __init__(self, encoder, chunk_size, n_left=0, n_lookahead=0):
+        factor = encoder.subsampling_factor
+        for n in [chunk_size, n_left, n_lookahead]:
+            if n % factor != 0:
+                raise ValueError('chunk_size, n_left and n_lookahead must be multiples of %d.' % factor)
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be positive.')
+        conv = getattr(encoder, 'conv', None)
+        if isinstance(conv, ConvEncoder):
+            for block in conv.layers:
+                for layer in [block.conv1, block.conv2]:
+                    if layer.kernel_size[0] != 2 * layer.padding[0] + 1:
+                        raise NotImplementedError('CNN blocks must keep the number of frames '
+                                                  '(kernel size %d in time).' % (2 * layer.padding[0] + 1))
+
+        self.encoder = encoder
+        self.chunk_size = chunk_size
+        self.n_left = n_left
+        self.n_lookahead = n_lookahead
+        self.n_caches = n_left // factor
+        self.reset()
+
+    def reset(self):
+        """Start new streams."""
+        self.buffer = None  # features from offset
+        self.offset = 0  # index of the first frame in the buffer
+        self.n_frames = 0  # number of frames fed so far
+        self.n_encoded = 0  # number of frames encoded so far
+        self.state = None
+
+    def feed(self, xs, is_last=False):
+        """Append features to streams and encode all chunks available.
+
+        Args:
+            xs (FloatTensor): `[B, T, input_dim]`. T may be 0.
+            is_last (bool): if True, encode the remaining frames without waiting for lookahead frames
+        Returns:
+            eouts (FloatTensor): `[B, T', enc_dim]` encoder outputs for chunks completed in this call
+
+        """
+        self.buffer = xs if self.buffer is None else torch.cat([self.buffer, xs], dim=1)
+        self.n_frames += xs.size(1)
+
+        eouts = []
+        while self.n_encoded < self.n_frames:
+            n_center = min(self.chunk_size, self.n_frames - self.n_encoded)
+            n_lookahead = min(self.n_lookahead, self.n_frames - self.n_encoded - n_center)
+            if not is_last and (n_center < self.chunk_size or n_lookahead < self.n_lookahead):
+                break
+            n_left = min(self.n_left, self.n_encoded)
+
+            begin = self.n_encoded - n_left - self.offset
+            end = self.n_encoded + n_center + n_lookahead - self.offset
+            eout, self.state = self.encoder.forward_chunk(self.buffer[:, begin:end], self.state,
+                                                          n_left=n_left,
+                                                          n_lookahead=n_lookahead,
+                                                          n_caches=self.n_caches)
+            eouts.append(eout)
+            self.n_encoded += n_center
+
+        # Discard frames out of the left context
+        n_discard = max(0, self.n_encoded - self.n_left - self.offset)
+        self.buffer = self.buffer[:, n_discard:]
+        self.offset += n_discard
+
+        if len(eouts) == 0:
+            return xs.new_zeros(xs.size(0), 0, self.encoder.output_dim)
+        return torch.cat(eouts, dim=1)
@@ -11,10 +11,12 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import checkpoint
 
 
 class TDSBlock(nn.Module):
@@ -147,6 +149,7 @@ class TDSEncoder(nn.Module):
         dropout (float) probability to drop nodes in hidden-hidden connection
         batch_norm (bool): if True, apply batch normalization
         bottleneck_dim (int): dimension of the bottleneck layer after the last layer
+        checkpoint (bool): recompute activations of each block in backward
 
     """
 
@@ -156,7 +159,8 @@ class TDSEncoder(nn.Module):
                  channels,
                  kernel_sizes,
                  dropout,
-                 bottleneck_dim=0):
+                 bottleneck_dim=0,
+                 checkpoint=False):
 
         super(TDSEncoder, self).__init__()
 
@@ -164,6 +168,7 @@ class TDSEncoder(nn.Module):
         assert input_dim % in_channel == 0
         self.input_freq = input_dim // in_channel
         self.bottleneck_dim = bottleneck_dim
+        self.checkpoint = checkpoint
 
         assert len(channels) > 0
         assert len(channels) == len(kernel_sizes)
@@ -215,7 +220,11 @@ class TDSEncoder(nn.Module):
         # Reshape to `[B, in_ch, T, input_dim // in_ch]`
         xs = xs.contiguous().view(bs, time, self.in_channel, input_dim // self.in_channel).transpose(2, 1)
 
-        xs = self.layers(xs)  # `[B, out_ch, T, feat_dim]`
+        if self.checkpoint and torch.is_grad_enabled():
+            for layer in self.layers:
+                xs = checkpoint(layer, xs)
+        else:
+            xs = self.layers(xs)  # `[B, out_ch, T, feat_dim]`
 
         # Collapse feature dimension
         bs, out_ch, time, freq = xs.size()
@@ -10,6 +10,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+import numpy as np
+import torch
 import torch.nn as nn
 
 from neural_sp.models.modules.linear import LinearND
@@ -17,7 +20,9 @@ from neural_sp.models.modules.transformer import SublayerConnection
 from neural_sp.models.modules.transformer import PositionwiseFeedForward
 from neural_sp.models.modules.transformer import PositionalEncoding
 from neural_sp.models.seq2seq.encoders.conv import ConvEncoder
+from neural_sp.models.seq2seq.decoders.local_attention import LocalMultiheadAttentionMechanism
 from neural_sp.models.seq2seq.decoders.multihead_attention import MultiheadAttentionMechanism
+from neural_sp.models.torch_utils import checkpoint
 
 
 class TransformerEncoder(nn.Module):
@@ -25,7 +30,7 @@ class TransformerEncoder(nn.Module):
 
     Args:
         input_dim (int): dimension of input features (freq * channel)
-        attn_type (str): type of attention
+        attn_type (str): type of attention, scaled_dot_product or local
         attn_n_heads (int): number of heads for multi-head attention
         n_layers (int): number of blocks
         d_model (int): dimension of keys/values/queries in
@@ -47,6 +52,12 @@ class TransformerEncoder(nn.Module):
         conv_batch_norm (bool): apply batch normalization only in the CNN blocks
         conv_residual (bool): add residual connection between each CNN block
         conv_bottleneck_dim (int): dimension of the bottleneck layer between CNN and self-attention layers
+        attn_window_left (int): number of frames in the left window for local attention
+        attn_window_right (int): number of frames in the right window for local attention
+        attn_global_stride (int): interval of global frames for local attention
+        attn_block_size (int): size of query/key blocks for memory-efficient full attention (0 disables it)
+        attn_recompute (bool): recompute attention weights in backward for memory-efficient full attention
+        checkpoint (bool): recompute activations of each block in backward
 
     """
 
@@ -71,12 +82,19 @@ class TransformerEncoder(nn.Module):
                  conv_poolings=[],
                  conv_batch_norm=False,
                  conv_residual=False,
-                 conv_bottleneck_dim=0):
+                 conv_bottleneck_dim=0,
+                 attn_window_left=32,
+                 attn_window_right=32,
+                 attn_global_stride=0,
+                 attn_block_size=0,
+                 attn_recompute=False,
+                 checkpoint=False):
 
         super(TransformerEncoder, self).__init__()
 
         self.d_model = d_model
         self.pe_type = pe_type
+        self.checkpoint = checkpoint
 
         # Setting for CNNs before RNNs
         if conv_channels:
@@ -104,7 +122,8 @@ class TransformerEncoder(nn.Module):
                                     dropout=0,
                                     batch_norm=conv_batch_norm,
                                     residual=conv_residual,
-                                    bottleneck_dim=d_model)
+                                    bottleneck_dim=d_model,
+                                    checkpoint=checkpoint)
             self._output_dim = self.conv.output_dim
         else:
             self._output_dim = input_dim * n_splices * n_stacks
@@ -120,7 +139,10 @@ class TransformerEncoder(nn.Module):
         # Self-attention layers
         self.layers = nn.ModuleList(
             [TransformerEncoderBlock(d_model, d_ff, attn_type, attn_n_heads,
-                                     dropout, dropout_att, layer_norm_eps) for l in range(n_layers)])
+                                     dropout, dropout_att, layer_norm_eps,
+                                     attn_window_left, attn_window_right, attn_global_stride,
+                                     attn_block_size, attn_recompute)
+             for l in range(n_layers)])
         self.layer_norm_top = nn.LayerNorm(d_model, eps=layer_norm_eps)
 
         self._output_dim = d_model
@@ -129,6 +151,11 @@ class TransformerEncoder(nn.Module):
     def output_dim(self):
         return self._output_dim
 
+    @property
+    def subsampling_factor(self):
+        """Subsampling factor in the time dimension."""
+        return self.conv.subsampling_factor if self.conv is not None else 1
+
     def forward(self, xs, xlens, task):
         """Forward computation.
 
@@ -161,7 +188,10 @@ class TransformerEncoder(nn.Module):
         xs = self.layer_norm_in(xs)
 
         for i in range(len(self.layers)):
-            xs, xx_aw = self.layers[i](xs, xlens)
+            if self.checkpoint and torch.is_grad_enabled():
+                xs, xx_aw = checkpoint(functools.partial(self.layers[i], xlens=xlens), xs)
+            else:
+                xs, xx_aw = self.layers[i](xs, xlens)
         xs = self.layer_norm_top(xs)
 
         eouts['ys']['xs'] = xs
@@ -169,6 +199,63 @@ class TransformerEncoder(nn.Module):
 
         return eouts
 
+    def forward_chunk(self, xs, state=None, n_left=0, n_lookahead=0, n_caches=0):
+        """Encode a chunk of streams for streaming inference.
+           Inputs of each layer in the last n_caches frames of the previous chunks are
+           cached, and frames in the chunk attend to them and the lookahead frames.
+           This approximates forward() with a limited context.
+
+        Args:
+            xs (FloatTensor): `[B, n_left + chunk_size + n_lookahead, input_dim]`
+            state (dict): caches returned for the previous chunk (None for the first chunk)
+            n_left (int): number of left context frames at the beginning of xs.
+                This is used as the context of the CNN blocks only.
+            n_lookahead (int): number of lookahead frames at the end of xs
+            n_caches (int): number of frames (after subsampling) cached in each layer
+        Returns:
+            xs (FloatTensor): `[B, chunk_size // subsampling_factor, d_model]`
+            state (dict):
+                offset (int): number of frames encoded so far
+                caches (list): `[B, n_caches, d_model]` for each layer
+
+        """
+        if state is None:
+            state = {'offset': 0, 'caches': [None] * len(self.layers)}
+
+        bs, time = xs.size()[:2]
+        n_center = time - n_left - n_lookahead
+
+        # Path through CNN blocks before RNN layers
+        if self.conv is None:
+            # Transform to d_model dimension
+            xs = self.embed_in(xs) * (self.d_model ** 0.5)
+        else:
+            factor = self.conv.subsampling_factor
+            xs, _ = self.conv(xs, [time] * bs)
+            n_left //= factor
+            n_center = xs.size(1) - n_left - int(np.ceil(n_lookahead / factor))
+        xs = xs[:, n_left:]
+
+        # Positional encoding & layer normalization
+        if self.pe_type:
+            xs = self.pos_emb_in(xs, offset=state['offset'])
+        xs = self.layer_norm_in(xs)
+
+        caches = []
+        for i in range(len(self.layers)):
+            cache = state['caches'][i]
+            if n_caches > 0:
+                # NOTE: lookahead frames are re-encoded in the next chunk
+                cache_new = xs[:, :n_center] if cache is None else torch.cat([cache, xs[:, :n_center]], dim=1)
+                caches.append(cache_new[:, -n_caches:])
+            else:
+                caches.append(None)
+            xs, _ = self.layers[i](xs, [xs.size(1)] * bs, cache=cache)
+        xs = self.layer_norm_top(xs)
+
+        state = {'offset': state['offset'] + n_center, 'caches': caches}
+        return xs[:, :n_center], state
+
 
 class TransformerEncoderBlock(nn.Module):
     """A single layer of the transformer encoder.
@@ -178,11 +265,16 @@ class TransformerEncoderBlock(nn.Module):
                    MultiheadAttentionMechanism, also the input size of
                    the first-layer of the PositionwiseFeedForward
         d_ff (int): second-layer of the PositionwiseFeedForward
-        attn_type (str):
+        attn_type (str): type of self-attention, scaled_dot_product or local
         attn_n_heads (int): number of heads for multi-head attention
         dropout (float): dropout probabilities for linear layers
         dropout_att (float): dropout probabilities for attention distributions
         layer_norm_eps (float):
+        attn_window_left (int): number of frames in the left window for local attention
+        attn_window_right (int): number of frames in the right window for local attention
+        attn_global_stride (int): interval of global frames for local attention
+        attn_block_size (int): size of query/key blocks for memory-efficient full attention (0 disables it)
+        attn_recompute (bool): recompute attention weights in backward for memory-efficient full attention
 
     """
 
@@ -193,35 +285,61 @@ class TransformerEncoderBlock(nn.Module):
                  attn_n_heads,
                  dropout,
                  dropout_att,
-                 layer_norm_eps):
+                 layer_norm_eps,
+                 attn_window_left=32,
+                 attn_window_right=32,
+                 attn_global_stride=0,
+                 attn_block_size=0,
+                 attn_recompute=False):
         super(TransformerEncoderBlock, self).__init__()
 
         # self-attention
-        self.self_attn = MultiheadAttentionMechanism(key_dim=d_model,
-                                                     query_dim=d_model,
-                                                     attn_dim=d_model,
-                                                     n_heads=attn_n_heads,
-                                                     dropout=dropout_att)
+        if attn_type == 'local':
+            self.self_attn = LocalMultiheadAttentionMechanism(key_dim=d_model,
+                                                              query_dim=d_model,
+                                                              attn_dim=d_model,
+                                                              n_heads=attn_n_heads,
+                                                              dropout=dropout_att,
+                                                              window_left=attn_window_left,
+                                                              window_right=attn_window_right,
+                                                              global_stride=attn_global_stride)
+        else:
+            self.self_attn = MultiheadAttentionMechanism(key_dim=d_model,
+                                                         query_dim=d_model,
+                                                         attn_dim=d_model,
+                                                         n_heads=attn_n_heads,
+                                                         dropout=dropout_att,
+                                                         block_size=attn_block_size,
+                                                         recompute=attn_recompute)
         self.add_norm_self_attn = SublayerConnection(d_model, dropout, layer_norm_eps)
 
         # feed-forward
         self.ff = PositionwiseFeedForward(d_model, d_ff, dropout)
         self.add_norm_ff = SublayerConnection(d_model, dropout, layer_norm_eps)
 
-    def forward(self, xs, xlens):
+    def forward(self, xs, xlens, cache=None):
         """Transformer encoder layer definition.
 
         Args:
             xs (FloatTensor): `[B, T, d_model]`
-            xlens (list): `[B]`
+            xlens (list): `[B]`. Ignored if cache is given.
+            cache (FloatTensor): `[B, n_caches, d_model]` inputs of this layer in
+                the previous chunks (for streaming inference)
         Returns:
             xs (FloatTensor): `[B, T, d_model]`
             xx_aw (FloatTensor):
 
         """
         # self-attention
-        xs, xx_aw = self.add_norm_self_attn(xs, sublayer=lambda xs: self.self_attn(
-            key=xs, key_lens=xlens, value=xs, query=xs))
+        if cache is None:
+            xs, xx_aw = self.add_norm_self_attn(xs, sublayer=lambda xs: self.self_attn(
+                key=xs, key_lens=xlens, value=xs, query=xs))
+        else:
+            # NOTE: all streams in a mini-batch have the same length
+            cache = self.add_norm_self_attn.layer_norm(cache)
+            xs, xx_aw = self.add_norm_self_attn(xs, sublayer=lambda xs: self.self_attn(
+                key=torch.cat([cache, xs], dim=1), key_lens=[cache.size(1) + xs.size(1)] * xs.size(0),
+                value=torch.cat([cache, xs], dim=1), query=xs))
         self.self_attn.reset()
 
         # position-wise feed-forward
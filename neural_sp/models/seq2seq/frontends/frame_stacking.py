@@ -11,6 +11,9 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import torch
+
+from neural_sp.models.torch_utils import make_length_mask
 
 
 def stack_frame(feat, n_stacks, n_skips, dtype=np.float32):
@@ -21,16 +24,19 @@ def stack_frame(feat, n_stacks, n_skips, dtype=np.float32):
            "Fast and accurate recurrent neural network acoustic models for speech recognition."
            arXiv preprint arXiv:1507.06947 (2015).
 
+       The t-th output frame is the concatenation of input frames from t * n_skips
+       to t * n_skips + n_stacks - 1. Frames beyond the end are filled with 0.
+
     Args:
         feat (list): `[T, input_dim]`
         n_stacks (int): the number of frames to stack
         n_skips (int): the number of frames to skip
         dtype ():
     Returns:
-        stacked_feat (np.ndarray): `[floor(T / n_skips), input_dim * n_stacks]`
+        stacked_feat (np.ndarray): `[floor((T + 1) / n_skips), input_dim * n_stacks]`
 
     """
-    if n_stacks == 1 and n_stacks == 1:
+    if n_stacks == 1 and n_skips == 1:
         return feat
 
     if n_stacks < n_skips:
@@ -39,39 +45,57 @@ def stack_frame(feat, n_stacks, n_skips, dtype=np.float32):
     n_frames, input_dim = feat.shape
     n_frames_new = (n_frames + 1) // n_skips
 
-    stacked_feat = np.zeros((n_frames_new, input_dim * n_stacks), dtype=dtype)
-    stack_count = 0
-    stack = []
-    for t, frame_t in enumerate(feat):
-        if t == len(feat) - 1:  # final frame
-            # Stack the final frame
-            stack.append(frame_t)
-
-            while stack_count != int(n_frames_new):
-                # Concatenate stacked frames
-                for i in range(len(stack)):
-                    stacked_feat[stack_count][input_dim
-                                              * i:input_dim * (i + 1)] = stack[i]
-                stack_count += 1
-
-                # Delete some frames to skip
-                for _ in range(n_skips):
-                    if len(stack) != 0:
-                        stack.pop(0)
-
-        elif len(stack) < n_stacks:  # first & middle frames
-            # Stack some frames until stack is filled
-            stack.append(frame_t)
-
-        if len(stack) == n_stacks:
-            # Concatenate stacked frames
-            for i in range(n_stacks):
-                stacked_feat[stack_count][input_dim
-                                          * i:input_dim * (i + 1)] = stack[i]
-            stack_count += 1
-
-            # Delete some frames to skip
-            for _ in range(n_skips):
-                stack.pop(0)
+    # Append zero frames so that every window is inside the padded features
+    n_pads = max(0, (n_frames_new - 1) * n_skips + n_stacks - n_frames)
+    feat_pad = np.zeros((n_frames + n_pads, input_dim), dtype=dtype)
+    feat_pad[:n_frames] = feat
 
+    # Gather all windows at once: `[T_new, n_stacks]` -> `[T_new, n_stacks, input_dim]`
+    indices = np.arange(n_frames_new)[:, None] * n_skips + np.arange(n_stacks)[None, :]
+    stacked_feat = feat_pad[indices].reshape(n_frames_new, input_dim * n_stacks)
     return stacked_feat
+
+
+def stack_frame_pad(xs, xlens, n_stacks, n_skips):
+    """Stack & skip some frames of padded features in a mini-batch on any device.
+       The output is identical to that of stack_frame applied to each utterance.
+
+    Args:
+        xs (FloatTensor): `[B, T, input_dim]`
+        xlens (IntTensor or list): `[B]`
+        n_stacks (int): the number of frames to stack
+        n_skips (int): the number of frames to skip
+    Returns:
+        xs (FloatTensor): `[B, floor((max(xlens) + 1) / n_skips), input_dim * n_stacks]`,
+            padded with 0
+        xlens (IntTensor): `[B]`
+
+    """
+    xlens = torch.as_tensor(xlens, dtype=torch.int32)
+    if n_stacks == 1 and n_skips == 1:
+        return xs, xlens
+
+    if n_stacks < n_skips:
+        raise ValueError('n_skips must be less than n_stacks.')
+
+    bs, n_frames, input_dim = xs.size()
+    xlens_new = (xlens + 1) // n_skips
+    n_frames_new = int(xlens_new.max())
+
+    # Zero out frames beyond the length of each utterance
+    mask = make_length_mask(xlens, n_frames, xs.device)
+    xs = xs.masked_fill(mask.unsqueeze(2) == 0, 0)
+
+    # Append zero frames so that every window is inside the padded features
+    n_pads = max(0, (n_frames_new - 1) * n_skips + n_stacks - n_frames)
+    if n_pads > 0:
+        xs = torch.cat([xs, xs.new_zeros(bs, n_pads, input_dim)], dim=1)
+
+    # `[B, T_new, input_dim, n_stacks]` -> `[B, T_new, n_stacks * input_dim]`
+    xs = xs.unfold(1, n_stacks, n_skips)[:, :n_frames_new]
+    xs = xs.transpose(2, 3).contiguous().view(bs, n_frames_new, n_stacks * input_dim)
+
+    # Zero out windows beyond the new length of each utterance
+    mask = make_length_mask(xlens_new, n_frames_new, xs.device)
+    xs = xs.masked_fill(mask.unsqueeze(2) == 0, 0)
+    return xs, xlens_new
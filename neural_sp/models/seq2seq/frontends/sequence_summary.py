@@ -14,6 +14,7 @@ import torch
 import torch.nn as nn
 
 from neural_sp.models.modules.linear import LinearND
+from neural_sp.models.torch_utils import make_length_mask
 
 
 class SequenceSummaryNetwork(nn.Module):
@@ -58,9 +59,9 @@ class SequenceSummaryNetwork(nn.Module):
         """
         bs, time = xs.size()[:2]
 
-        aw_ave = xs.new_zeros((bs, 1, time))
-        for b in range(bs):
-            aw_ave[b, :, :xlens[b]] = 1 / xlens[b]
+        xlens = torch.as_tensor(xlens, device=xs.device)
+        aw_ave = make_length_mask(xlens, time).to(xs.dtype) / xlens.unsqueeze(1).to(xs.dtype)
+        aw_ave = aw_ave.unsqueeze(1)  # `[B, 1, T]`
 
         s = xs.clone()
         for l in range(self.n_layers - 1):
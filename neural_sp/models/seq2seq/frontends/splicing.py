@@ -11,6 +11,36 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import torch
+
+from neural_sp.models.torch_utils import make_length_mask
+
+
+def _splice_indices(n_frames, n_splices, n_stacks):
+    """Make indices to gather spliced frames.
+
+       The i-th of the `n_splices * n_stacks` slots at time t is filled with the
+       stack[i]-th stacked frame of the input frame at time[t, i]. Input frames
+       before the first frame are replaced with the first frame. Slots over
+       `n_splices + n_stacks - 1` are filled with 0.
+
+    Args:
+        n_frames (int): the number of input frames
+        n_splices (int): frames to n_splices
+        n_stacks (int): the number of frames stacked in each input frame
+    Returns:
+        time (np.ndarray): `[n_frames, n_splices * n_stacks]`
+        stack (np.ndarray): `[n_splices * n_stacks]`
+        valid (np.ndarray): `[n_splices * n_stacks]`
+
+    """
+    slots = np.arange(n_splices * n_stacks)
+    splices = np.minimum(slots, n_splices - 1)
+    stack = np.minimum(slots - splices, n_stacks - 1)
+    valid = slots - splices < n_stacks
+    time = np.arange(n_frames)[:, None] + splices[None, :] - n_splices
+    time = np.maximum(time, 0)
+    return time, stack, valid
 
 
 def splice(feat, n_splices=1, n_stacks=1, dtype=np.float32):
@@ -38,31 +68,56 @@ def splice(feat, n_splices=1, n_stacks=1, dtype=np.float32):
 
     max_xlen, input_dim = feat.shape
     freq = (input_dim // 3) // n_stacks
-    feat_splice = np.zeros((max_xlen, freq * (n_splices * n_stacks) * 3), dtype=dtype)
+    time, stack, valid = _splice_indices(max_xlen, n_splices, n_stacks)
 
-    for i_time in range(max_xlen):
-        spliced_frames = np.zeros((n_splices * n_stacks, freq, 3))
-        for i_splice in range(0, n_splices, 1):
-            if i_time <= n_splices - 1 and i_splice < n_splices - i_time:
-                # copy the first frame to left side (padding left frames)
-                copy_frame = feat[0]
-            elif max_xlen - n_splices <= i_time and i_time + (i_splice - n_splices) > max_xlen - 1:
-                # copy the last frame to right side (padding right frames)
-                copy_frame = feat[-1]
-            else:
-                copy_frame = feat[i_time + (i_splice - n_splices)]
+    # `[T, freq * 3 * n_stacks]` -> `[T, n_stacks, freq, 3]`
+    feat = feat.reshape((max_xlen, freq, 3, n_stacks)).transpose((0, 3, 1, 2))
 
-            # `[freq * 3 * n_stacks]` -> `[freq, 3, n_stacks]`
-            copy_frame = copy_frame.reshape((freq, 3, n_stacks))
+    # `[T, n_splices * n_stacks, freq, 3]`
+    spliced_frames = feat[time, stack[None, :]] * valid[None, :, None, None]
 
-            # `[freq, 3, n_stacks]` -> `[n_stacks, freq, 3]`
-            copy_frame = np.transpose(copy_frame, (2, 0, 1))
+    # `[T, n_splices * n_stacks, freq, 3] -> `[T, freq, n_splices * n_stacks, 3]`
+    spliced_frames = spliced_frames.transpose((0, 2, 1, 3))
 
-            spliced_frames[i_splice: i_splice + n_stacks] = copy_frame
+    feat_splice = spliced_frames.reshape((max_xlen, freq * (n_splices * n_stacks) * 3)).astype(dtype)
+    return feat_splice
 
-        # `[n_splices * n_stacks, freq, 3] -> `[freq, n_splices * n_stacks, 3]`
-        spliced_frames = np.transpose(spliced_frames, (1, 0, 2))
 
-        feat_splice[i_time] = spliced_frames.reshape((freq * (n_splices * n_stacks) * 3))
+def splice_pad(xs, xlens, n_splices=1, n_stacks=1):
+    """Splice padded input data in a mini-batch on any device.
+       The output is identical to that of splice applied to each utterance.
 
-    return feat_splice
+    Args:
+        xs (FloatTensor): `[B, T, input_dim (freq * 3 * n_stacks)]`
+        xlens (IntTensor or list): `[B]`
+        n_splices (int): frames to n_splices
+        n_stacks (int): the number of frames to stack
+    Returns:
+        xs (FloatTensor): `[B, T, freq * (n_splices * n_stacks) * 3]`, padded with 0
+
+    """
+    assert xs.size(-1) % 3 == 0
+
+    if n_splices == 1:
+        return xs
+
+    bs, max_xlen, input_dim = xs.size()
+    freq = (input_dim // 3) // n_stacks
+    time, stack, valid = _splice_indices(max_xlen, n_splices, n_stacks)
+    time = torch.from_numpy(time).to(xs.device)
+    stack = torch.from_numpy(stack).to(xs.device)
+    valid = torch.from_numpy(valid).to(xs.device, xs.dtype)
+
+    # `[B, T, freq * 3 * n_stacks]` -> `[B, T, n_stacks, freq, 3]`
+    xs = xs.view(bs, max_xlen, freq, 3, n_stacks).permute(0, 1, 4, 2, 3)
+
+    # `[B, T, n_splices * n_stacks, freq, 3]`
+    xs = xs[:, time, stack.unsqueeze(0)] * valid.view(1, 1, -1, 1, 1)
+
+    # `[B, T, n_splices * n_stacks, freq, 3] -> `[B, T, freq, n_splices * n_stacks, 3]`
+    xs = xs.transpose(2, 3).contiguous().view(bs, max_xlen, freq * (n_splices * n_stacks) * 3)
+
+    # Zero out frames beyond the length of each utterance
+    mask = make_length_mask(xlens, max_xlen, xs.device)
+    xs = xs.masked_fill(mask.unsqueeze(2) == 0, 0)
+    return xs
@@ -23,12 +23,16 @@ from neural_sp.models.seq2seq.decoders.fwd_bwd_attention import fwd_bwd_attentio
 from neural_sp.models.seq2seq.decoders.rnn import RNNDecoder
 from neural_sp.models.seq2seq.decoders.transformer import TransformerDecoder
 from neural_sp.models.seq2seq.encoders.rnn import RNNEncoder
+from neural_sp.models.seq2seq.encoders.streaming import StreamingEncoder
 from neural_sp.models.seq2seq.encoders.transformer import TransformerEncoder
 from neural_sp.models.seq2seq.frontends.sequence_summary import SequenceSummaryNetwork
 from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame
+from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame_pad
 from neural_sp.models.seq2seq.frontends.splicing import splice
+from neural_sp.models.seq2seq.frontends.splicing import splice_pad
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
+from neural_sp.models.torch_utils import reverse_padded
 
 
 logger = logging.getLogger("training")
@@ -123,7 +127,13 @@ class Seq2seq(ModelBase):
                 conv_poolings=args.conv_poolings,
                 conv_batch_norm=args.conv_batch_norm,
                 conv_residual=args.conv_residual,
-                conv_bottleneck_dim=args.conv_bottleneck_dim)
+                conv_bottleneck_dim=args.conv_bottleneck_dim,
+                attn_window_left=args.transformer_attn_window_left,
+                attn_window_right=args.transformer_attn_window_right,
+                attn_global_stride=args.transformer_attn_global_stride,
+                attn_block_size=args.transformer_attn_block_size,
+                attn_recompute=args.transformer_attn_recompute,
+                checkpoint=args.checkpoint_encoder_layers)
         else:
             self.enc = RNNEncoder(
                 input_dim=args.input_dim if args.input_type == 'speech' else args.emb_dim,
@@ -150,7 +160,8 @@ class Seq2seq(ModelBase):
                 conv_bottleneck_dim=args.conv_bottleneck_dim,
                 residual=args.enc_residual,
                 nin=args.enc_nin,
-                task_specific_layer=args.task_specific_layer)
+                task_specific_layer=args.task_specific_layer,
+                checkpoint=args.checkpoint_encoder_layers)
             # NOTE: pure CNN/TDS encoders are also included
 
         if args.freeze_encoder:
@@ -423,20 +434,25 @@ class Seq2seq(ModelBase):
         if self.input_type == 'speech':
             if self.mtl_per_batch:
                 flip = True if 'bwd' in task else False
-                enc_outs = self.encode(batch['xs'], task, flip=flip)
+                enc_outs = self.encode(batch['xs'], task, flip=flip, xlens=batch['xlens'])
             else:
                 flip = True if self.bwd_weight == 1 else False
-                enc_outs = self.encode(batch['xs'], 'all', flip=flip)
+                enc_outs = self.encode(batch['xs'], 'all', flip=flip, xlens=batch['xlens'])
         else:
             enc_outs = self.encode(batch['ys_sub1'])
 
+        # Use labels padded by the data loader if available
+        ys = batch.get('ys_pad', batch['ys'])
+
         observation = {}
-        loss = torch.zeros((1,), dtype=torch.float32).cuda(self.device_id)
+        loss = torch.zeros((1,), dtype=torch.float32)
+        if self.device_id >= 0:
+            loss = loss.cuda(self.device_id)
 
         # for the forward decoder in the main task
         if (self.fwd_weight > 0 or self.ctc_weight > 0) and task in ['all', 'ys', 'ys.ctc', 'ys.lmobj']:
             loss_fwd, obs_fwd = self.dec_fwd(enc_outs['ys']['xs'], enc_outs['ys']
-                                             ['xlens'], batch['ys'], task, batch['ys_hist'])
+                                             ['xlens'], ys, task, batch['ys_hist'])
             loss += loss_fwd
             observation['loss.att'] = obs_fwd['loss_att']
             observation['loss.ctc'] = obs_fwd['loss_ctc']
@@ -448,7 +464,7 @@ class Seq2seq(ModelBase):
 
         # for the backward decoder in the main task
         if self.bwd_weight > 0 and task in ['all', 'ys.bwd']:
-            loss_bwd, obs_bwd = self.dec_bwd(enc_outs['ys']['xs'], enc_outs['ys']['xlens'], batch['ys'], task)
+            loss_bwd, obs_bwd = self.dec_bwd(enc_outs['ys']['xs'], enc_outs['ys']['xlens'], ys, task)
             loss += loss_bwd
             observation['loss.att-bwd'] = obs_bwd['loss_att']
             observation['loss.ctc-bwd'] = obs_bwd['loss_ctc']
@@ -463,7 +479,8 @@ class Seq2seq(ModelBase):
             # for the forward decoder in the sub tasks
             if (getattr(self, 'fwd_weight_' + sub) > 0 or getattr(self, 'ctc_weight_' + sub) > 0) and task in ['all', 'ys_' + sub, 'ys_' + sub + '.ctc', 'ys_' + sub + '.lmobj']:
                 loss_sub, obs_fwd_sub = getattr(self, 'dec_fwd_' + sub)(
-                    enc_outs['ys_' + sub]['xs'], enc_outs['ys_' + sub]['xlens'], batch['ys_' + sub], task)
+                    enc_outs['ys_' + sub]['xs'], enc_outs['ys_' + sub]['xlens'],
+                    batch.get('ys_' + sub + '_pad', batch['ys_' + sub]), task)
                 loss += loss_sub
                 observation['loss.att-' + sub] = obs_fwd_sub['loss_att']
                 observation['loss.ctc-' + sub] = obs_fwd_sub['loss_ctc']
@@ -479,13 +496,20 @@ class Seq2seq(ModelBase):
 
         return loss, reporter
 
-    def encode(self, xs, task='all', flip=False):
+    def encode(self, xs, task='all', flip=False, xlens=None,
+               chunk_size=0, n_left=0, n_lookahead=0):
         """Encode acoustic or text features.
 
         Args:
-            xs (list): A list of length `[B]`, which contains Tensor of size `[T, input_dim]`
+            xs (list or FloatTensor): A list of length `[B]`, which contains Tensor of size `[T, input_dim]`,
+                or `[B, T, input_dim]` padded by the data loader
             task (str): all or ys* or ys_sub1* or ys_sub2*
             flip (bool): if True, flip acoustic features in the time-dimension
+            xlens (list): lengths of each element in xs (required when xs is padded)
+            chunk_size (int): if positive, encode acoustic features chunk by chunk
+                as in streaming inference (only for the main task)
+            n_left (int): number of left context frames for each chunk
+            n_lookahead (int): number of lookahead frames for each chunk
         Returns:
             enc_outs (dict):
 
@@ -496,7 +520,27 @@ class Seq2seq(ModelBase):
                      'ys_sub2': {'xs': None, 'xlens': None}}
             return eouts
         else:
-            if self.input_type == 'speech':
+            if self.input_type == 'speech' and torch.is_tensor(xs):
+                # Transfer the padded mini-batch at once
+                xlens = [int(xlen) for xlen in xlens]
+                if self.device_id >= 0:
+                    xs = xs.cuda(self.device_id, non_blocking=True)
+                xs = xs.float()
+
+                # Frame stacking
+                if self.n_stacks > 1:
+                    xs, xlens = stack_frame_pad(xs, xlens, self.n_stacks, self.n_skips)
+                    xlens = xlens.tolist()
+
+                # Splicing
+                if self.n_splices > 1:
+                    xs = splice_pad(xs, xlens, self.n_splices, self.n_stacks)
+
+                # Flip acoustic features in the reverse order
+                if flip:
+                    xs = reverse_padded(xs, xs.new_tensor(xlens).long())
+
+            elif self.input_type == 'speech':
                 # Frame stacking
                 if self.n_stacks > 1:
                     xs = [stack_frame(x, self.n_stacks, self.n_skips)for x in xs]
@@ -508,7 +552,7 @@ class Seq2seq(ModelBase):
                 xlens = [len(x) for x in xs]
                 # Flip acoustic features in the reverse order
                 if flip:
-                    xs = [torch.from_numpy(np.flip(x, axis=0).copy()).float().cuda(self.device_id) for x in xs]
+                    xs = [np2tensor(np.flip(x, axis=0).copy(), self.device_id).float() for x in xs]
                 else:
                     xs = [np2tensor(x, self.device_id).float() for x in xs]
                 xs = pad_list(xs, 0.0)
@@ -519,6 +563,9 @@ class Seq2seq(ModelBase):
                 xs = pad_list(xs, self.pad)
                 xs = self.embed_in(xs)
 
+            if chunk_size > 0:
+                return self.encode_streaming(xs, xlens, chunk_size, n_left, n_lookahead)
+
             # sequence summary network
             if self.ssn is not None:
                 xs += self.ssn(xs, xlens)
@@ -541,6 +588,40 @@ class Seq2seq(ModelBase):
 
             return enc_outs
 
+    def encode_streaming(self, xs, xlens, chunk_size, n_left=0, n_lookahead=0):
+        """Encode acoustic features chunk by chunk to emulate streaming inference.
+           Each utterance is fed to StreamingEncoder in pieces of chunk_size frames.
+
+        Args:
+            xs (FloatTensor): `[B, T, input_dim]` after frame stacking and splicing
+            xlens (list): A list of length `[B]`
+            chunk_size (int): number of input frames in each chunk
+            n_left (int): number of left context frames for each chunk
+            n_lookahead (int): number of lookahead frames for each chunk
+        Returns:
+            enc_outs (dict): encoder outputs of the main task
+
+        """
+        if self.input_type != 'speech' or not hasattr(self.enc, 'forward_chunk'):
+            raise NotImplementedError('Streaming inference is not supported for %s.' % self.enc_type)
+        if self.ssn is not None:
+            raise NotImplementedError('Streaming inference is not supported with the sequence summary network.')
+
+        streamer = StreamingEncoder(self.enc, chunk_size, n_left, n_lookahead)
+        eouts = []
+        for b in range(len(xlens)):
+            streamer.reset()
+            eout = [streamer.feed(xs[b:b + 1, t:t + chunk_size], is_last=t + chunk_size >= xlens[b])
+                    for t in range(0, xlens[b], chunk_size)]
+            eouts.append(torch.cat(eout, dim=1)[0])
+        enc_outs = {'ys': {'xs': pad_list(eouts, 0.0), 'xlens': [eout.size(0) for eout in eouts]}}
+
+        # Bridge between the encoder and decoder
+        if self.main_weight > 0 and self.is_bridge:
+            enc_outs['ys']['xs'] = self.bridge(enc_outs['ys']['xs'])
+
+        return enc_outs
+
     def get_ctc_probs(self, xs, task='ys', temperature=1, topk=None):
         self.eval()
         with torch.no_grad():
@@ -563,11 +644,12 @@ class Seq2seq(ModelBase):
 
     def decode(self, xs, params, idx2token, nbest=1, exclude_eos=False,
                refs_id=None, refs_text=None, utt_ids=None, speakers=None,
-               task='ys', ensemble_models=[]):
+               task='ys', ensemble_models=[], xlens=None):
         """Decoding in the inference stage.
 
         Args:
-            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+            xs (list or FloatTensor): A list of length `[B]`, which contains arrays of size `[T, input_dim]`,
+                or `[B, T, input_dim]` padded by the data loader
             params (dict): hyper-parameters for decoding
                 beam_width (int): the size of beam
                 min_len_ratio (float):
@@ -587,6 +669,7 @@ class Seq2seq(ModelBase):
             speakers (list):
             task (str): ys* or ys_sub1* or ys_sub2*
             ensemble_models (list): list of Seq2seq classes
+            xlens (list): lengths of each element in xs (required when xs is padded)
         Returns:
             best_hyps_id (list): A list of length `[B]`, which contains arrays of size `[L]`
             aws (list): A list of length `[B]`, which contains arrays of size `[L, T, n_heads]`
@@ -604,10 +687,18 @@ class Seq2seq(ModelBase):
                 raise ValueError(task)
 
             # encode
-            if self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir:
-                enc_outs = self.encode(xs, task, flip=True)
+            if params.get('recog_streaming_chunk_size', 0) > 0:
+                if task != 'ys' or 'bwd' in dir:
+                    raise NotImplementedError('Streaming inference is supported only for the forward main task.')
+                # NOTE: ensemble models encode whole utterances
+                enc_outs = self.encode(xs, task, flip=False, xlens=xlens,
+                                       chunk_size=params['recog_streaming_chunk_size'],
+                                       n_left=params.get('recog_streaming_n_left', 0),
+                                       n_lookahead=params.get('recog_streaming_n_lookahead', 0))
+            elif self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir:
+                enc_outs = self.encode(xs, task, flip=True, xlens=xlens)
             else:
-                enc_outs = self.encode(xs, task, flip=False)
+                enc_outs = self.encode(xs, task, flip=False, xlens=xlens)
 
             #########################
             # CTC
@@ -655,7 +746,7 @@ class Seq2seq(ModelBase):
                         ensmbl_decs_fwd = []
                         if len(ensemble_models) > 0:
                             for i_e, model in enumerate(ensemble_models):
-                                enc_outs_e_fwd = model.encode(xs, task, flip=False)
+                                enc_outs_e_fwd = model.encode(xs, task, flip=False, xlens=xlens)
                                 ensmbl_eouts_fwd += [enc_outs_e_fwd[task]['xs']]
                                 ensmbl_elens_fwd += [enc_outs_e_fwd[task]['xlens']]
                                 ensmbl_decs_fwd += [model.dec_fwd]
@@ -681,9 +772,9 @@ class Seq2seq(ModelBase):
                         if len(ensemble_models) > 0:
                             for i_e, model in enumerate(ensemble_models):
                                 if self.input_type == 'speech' and self.mtl_per_batch:
-                                    enc_outs_e_bwd = model.encode(xs, task, flip=True)
+                                    enc_outs_e_bwd = model.encode(xs, task, flip=True, xlens=xlens)
                                 else:
-                                    enc_outs_e_bwd = model.encode(xs, task, flip=False)
+                                    enc_outs_e_bwd = model.encode(xs, task, flip=False, xlens=xlens)
                                 ensmbl_eouts_bwd += [enc_outs_e_bwd[task]['xs']]
                                 ensmbl_elens_bwd += [enc_outs_e_bwd[task]['xlens']]
                                 ensmbl_decs_bwd += [model.dec_bwd]
@@ -693,7 +784,7 @@ class Seq2seq(ModelBase):
                         flip = False
                         if self.input_type == 'speech' and self.mtl_per_batch:
                             flip = True
-                            enc_outs_bwd = self.encode(xs, task, flip=True)
+                            enc_outs_bwd = self.encode(xs, task, flip=True, xlens=xlens)
                         else:
                             enc_outs_bwd = enc_outs
                         nbest_hyps_id_bwd, aws_bwd, scores_bwd, _ = self.dec_bwd.beam_search(
@@ -717,9 +808,9 @@ class Seq2seq(ModelBase):
                         if len(ensemble_models) > 0:
                             for i_e, model in enumerate(ensemble_models):
                                 if model.input_type == 'speech' and model.mtl_per_batch and 'bwd' in dir:
-                                    enc_outs_e = model.encode(xs, task, flip=True)
+                                    enc_outs_e = model.encode(xs, task, flip=True, xlens=xlens)
                                 else:
-                                    enc_outs_e = model.encode(xs, task, flip=False)
+                                    enc_outs_e = model.encode(xs, task, flip=False, xlens=xlens)
                                 ensmbl_eouts += [enc_outs_e[task]['xs']]
                                 ensmbl_elens += [enc_outs_e[task]['xlens']]
                                 ensmbl_decs += [getattr(model, 'dec_' + dir)]
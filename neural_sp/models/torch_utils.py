@@ -10,7 +10,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import numpy as np
 import torch
+import torch.utils.checkpoint
 
 
 def tensor2np(x):
@@ -22,6 +25,9 @@ def tensor2np(x):
         np.ndarray
 
     """
+    # NOTE: numpy does not support bfloat16, which is defined from torch 1.2
+    if x.dtype == torch.float16 or x.dtype == getattr(torch, 'bfloat16', None):
+        x = x.float()
     return x.cpu().numpy()
 
 
@@ -69,6 +75,94 @@ def pad_list(xs, pad_value=0.0, pad_left=False):
     return xs_pad
 
 
+def pad_ids(ys, pad_value=-1):
+    """Convert list of token indices to a single LongTensor with padding on CPU.
+
+    Args:
+        ys (list): A list of length `[B]`, which contains a list of size `[L]`
+        pad_value (int):
+    Returns:
+        ys_pad (LongTensor): `[B, L_max]`
+
+    """
+    ys_pad = np.full((len(ys), max([len(y) for y in ys] + [0])), pad_value, dtype=np.int64)
+    for b, y in enumerate(ys):
+        ys_pad[b, :len(y)] = y
+    return torch.from_numpy(ys_pad)
+
+
+def make_length_mask(lens, max_len=None, device=None):
+    """Make a mask of valid positions from sequence lengths in a single operation.
+
+    Args:
+        lens (list or IntTensor): `[B]`
+        max_len (int): length of the mask. max(lens) is used if None.
+        device (torch.device): device of the mask. The device of lens is used if None.
+    Returns:
+        mask (BoolTensor): `[B, max_len]`, True (1) for valid positions.
+            Use mask.unsqueeze() to broadcast it to other shapes.
+
+    """
+    lens = torch.as_tensor(lens, device=device)
+    if max_len is None:
+        max_len = int(lens.max()) if lens.numel() > 0 else 0
+    return torch.arange(max_len, device=lens.device).unsqueeze(0) < lens.unsqueeze(1)
+
+
+def reverse_padded(xs, xlens, pad_value=0):
+    """Flip each sequence in a padded batch within its length.
+
+    Args:
+        xs (Tensor): `[B, T, *]`
+        xlens (LongTensor): `[B]` on the same device as xs
+        pad_value (int or float):
+    Returns:
+        xs_rev (Tensor): `[B, T, *]`
+
+    """
+    max_time = xs.size(1)
+    index = xlens.unsqueeze(1) - 1 - torch.arange(max_time, device=xs.device).unsqueeze(0)  # `[B, T]`
+    mask = index < 0
+    index = index.clamp(min=0)
+    index_exp = index.view(index.size(0), max_time, *([1] * (xs.dim() - 2))).expand_as(xs)
+    xs_rev = xs.gather(1, index_exp)
+    return xs_rev.masked_fill(mask.view(index_exp.size()[:2] + (1,) * (xs.dim() - 2)), pad_value)
+
+
+def append_sos_eos(ys, eos, pad, bwd=False, device_id=-1):
+    """Make inputs and targets of the decoder with a single host-to-device transfer.
+
+    Args:
+        ys (list or LongTensor): A list of length `[B]`, which contains a list of size `[L]`,
+            or `[B, L_max]` padded with -1 by the data loader
+        eos (int): index for <sos> and <eos>
+        pad (int): index for padding
+        bwd (bool): reverse each sequence
+        device_id (int):
+    Returns:
+        ys_in_pad (LongTensor): `[B, L_max + 1]`, <sos> is prepended
+        ys_out_pad (LongTensor): `[B, L_max + 1]`, <eos> is appended
+        ylens (LongTensor): `[B]` lengths without <sos>/<eos>
+
+    """
+    if not torch.is_tensor(ys):
+        ys = pad_ids(ys, -1)
+    if device_id >= 0:
+        ys = ys.cuda(device_id, non_blocking=True)
+    ys = ys.long()
+    ylens = (ys >= 0).sum(1)
+    if bwd:
+        ys = reverse_padded(ys, ylens, pad_value=-1)
+
+    bs = ys.size(0)
+    ys_in_pad = torch.cat([ys.new_full((bs, 1), eos), ys], dim=1)
+    ys_out_pad = torch.cat([ys, ys.new_full((bs, 1), -1)], dim=1)
+    ys_out_pad.scatter_(1, ylens.unsqueeze(1), eos)
+    ys_in_pad.masked_fill_(ys_in_pad < 0, pad)
+    ys_out_pad.masked_fill_(ys_out_pad < 0, pad)
+    return ys_in_pad, ys_out_pad, ylens
+
+
 def compute_accuracy(logits, ys_ref, pad):
     """Compute accuracy.
     Args:
@@ -96,12 +190,60 @@ def to_onehot(ys, vocab, ylens=None):
     """
     bs, max_ylen = ys.size()[:2]
 
-    ys_onehot = torch.zeros_like(ys).expand(ys.size(0), ys.size(1), vocab)
-    for b in range(bs):
-        if ylens is None:
-            for t in range(max_ylen):
-                ys_onehot[b, t, ys[b, t]] = 1
-        else:
-            for t in range(ylens[b]):
-                ys_onehot[b, t, ys[b, t]] = 1
+    ys_onehot = ys.new_zeros(bs, max_ylen, vocab)
+    if ylens is None:
+        ys_onehot.scatter_(2, ys.unsqueeze(2), 1)
+    else:
+        mask = make_length_mask(ylens, max_ylen, ys.device)
+        ys_onehot.scatter_(2, ys.masked_fill(mask == 0, 0).unsqueeze(2), 1)
+        ys_onehot.masked_fill_(mask.unsqueeze(2) == 0, 0)
     return ys_onehot
+
+
+def checkpoint(function, *args):
+    """Run function without keeping intermediate activations, which are recomputed in backward.
+
+    Args:
+        function (callable): function of tensors
+        args: inputs of function, which must be tensors.
+            Other arguments should be bound to function with functools.partial.
+    Returns:
+        outputs of function
+
+    """
+    torch_version = tuple(int(v) for v in torch.__version__.split('.')[:2])
+    if torch_version >= (1, 11):
+        # NOTE: non-reentrant checkpointing works even if no input requires gradients
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+    if not any(arg.requires_grad for arg in args):
+        # NOTE: reentrant checkpointing drops gradients of parameters in function
+        # when no input requires gradients (e.g., the first layer fed with input features)
+        return function(*args)
+    return torch.utils.checkpoint.checkpoint(function, *args)
+
+
+def autocast(precision, device_id=-1):
+    """Context manager for automatic mixed precision.
+
+    Args:
+        precision (str): fp32 or fp16 or bf16
+        device_id (int): index of the GPU (negative values mean CPU)
+    Returns:
+        context manager to run eligible operations in half precision.
+            bf16 is supported on both CPU and GPU, and fp16 only on GPU.
+            fp16 and bf16 require torch>=1.10.
+
+    """
+    if precision == 'fp32':
+        return contextlib.suppress()
+    if precision in ['fp16', 'bf16'] and not hasattr(torch, 'autocast'):
+        raise ValueError('%s autocast requires torch>=1.10, but torch %s is installed. Use fp32.'
+                         % (precision, torch.__version__))
+    if precision == 'fp16':
+        if device_id < 0:
+            raise ValueError('fp16 autocast requires GPUs. Use bf16 on CPU.')
+        return torch.autocast(device_type='cuda', dtype=torch.float16)
+    elif precision == 'bf16':
+        return torch.autocast(device_type='cuda' if device_id >= 0 else 'cpu', dtype=torch.bfloat16)
+    else:
+        raise ValueError(precision)
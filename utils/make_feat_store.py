@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Convert Kaldi features into a single memory-mapped feature store.
+
+   The features of all utterances are concatenated into `<store>.npy` of size
+   `[total_n_frames, xdim]`. Each utterance is referred by `<store>.npy:begin:end`,
+   which is written in place of the Kaldi feat_path to the output tsv (or scp) file.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import codecs
+from distutils.util import strtobool
+import kaldi_io
+import numpy as np
+import os
+import pandas as pd
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tsv', type=str, default='', nargs='?',
+                    help='dataset tsv file')
+parser.add_argument('--feat', type=str, default='', nargs='?',
+                    help='feats.scp file (used when --tsv is not set)')
+parser.add_argument('--utt2num_frames', type=str, default='', nargs='?',
+                    help='utt2num_frames file (required for --feat)')
+parser.add_argument('--store', type=str,
+                    help='path to the output feature store (.npy)')
+parser.add_argument('--fp16', type=strtobool, default=False,
+                    help='save features in float16')
+args = parser.parse_args()
+
+
+def main():
+
+    if args.tsv:
+        df = pd.read_csv(args.tsv, encoding='utf-8', delimiter='\t')
+        utt_ids = list(df['utt_id'])
+        feat_paths = list(df['feat_path'])
+        xlens = [int(xlen) for xlen in df['xlen']]
+    else:
+        utt2featpath = {}
+        with codecs.open(args.feat, 'r', encoding="utf-8") as f:
+            for line in f:
+                utt_id, feat_path = line.strip().split(' ')
+                utt2featpath[utt_id] = feat_path
+        utt2num_frames = {}
+        with codecs.open(args.utt2num_frames, 'r', encoding="utf-8") as f:
+            for line in f:
+                utt_id, xlen = line.strip().split(' ')
+                utt2num_frames[utt_id] = int(xlen)
+        utt_ids = list(utt2featpath.keys())
+        feat_paths = [utt2featpath[utt_id] for utt_id in utt_ids]
+        xlens = [utt2num_frames[utt_id] for utt_id in utt_ids]
+
+    store_path = args.store if args.store.endswith('.npy') else args.store + '.npy'
+    store_path = os.path.abspath(store_path)
+    xdim = kaldi_io.read_mat(feat_paths[0]).shape[-1]
+    store = np.lib.format.open_memmap(store_path, mode='w+',
+                                      dtype=np.float16 if args.fp16 else np.float32,
+                                      shape=(sum(xlens), xdim))
+
+    # Copy features utterance by utterance
+    store_feat_paths = []
+    offset = 0
+    for feat_path, xlen in tqdm(zip(feat_paths, xlens), total=len(feat_paths)):
+        feat = kaldi_io.read_mat(feat_path)
+        if feat.shape[0] != xlen:
+            raise ValueError('Length mismatch (%d != %d): %s' % (feat.shape[0], xlen, feat_path))
+        store[offset:offset + xlen] = feat
+        store_feat_paths.append('%s:%d:%d' % (store_path, offset, offset + xlen))
+        offset += xlen
+    store.flush()
+    del store
+
+    # Write a new tsv (or scp) file to stdout
+    if args.tsv:
+        df['feat_path'] = store_feat_paths
+        print(df.to_csv(sep='\t', index=False, encoding='utf-8'), end='')
+    else:
+        for utt_id, feat_path in zip(utt_ids, store_feat_paths):
+            print('%s %s' % (utt_id, feat_path))
+
+
+if __name__ == '__main__':
+    main()
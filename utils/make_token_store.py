@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Encode token indices in a dataset tsv file into a memory-mapped token store for LM training.
+
+   Token indices of all sentences are concatenated into `<store>.npy`
+   (uint16, or uint32 for vocabularies larger than 65535) in the order of the tsv file.
+   The start position of each sentence followed by the total number of tokens
+   is saved to `<store>.offsets.npy` (int64).
+   Pass `<store>.npy` as the dataset of neural_sp/bin/lm/train.py.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import codecs
+import numpy as np
+import os
+import pandas as pd
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tsv', type=str,
+                    help='dataset tsv file')
+parser.add_argument('--dict', type=str,
+                    help='dictionary file')
+parser.add_argument('--store', type=str,
+                    help='path to the output token store (.npy)')
+parser.add_argument('--chunk_size', type=int, default=100000,
+                    help='number of lines of the tsv file to read at once')
+args = parser.parse_args()
+
+
+def main():
+
+    vocab = 1  # for <blank>
+    with codecs.open(args.dict, 'r', encoding="utf-8") as f:
+        for line in f:
+            if line.strip() != '':
+                vocab += 1
+    dtype = np.uint16 if vocab <= np.iinfo(np.uint16).max else np.uint32
+
+    # Count tokens
+    ylens = np.concatenate([chunk['ylen'].values for chunk in pd.read_csv(
+        args.tsv, encoding='utf-8', delimiter='\t', usecols=['ylen'], chunksize=args.chunk_size)])
+    offsets = np.zeros(len(ylens) + 1, dtype=np.int64)
+    np.cumsum(ylens, out=offsets[1:])
+
+    store_path = args.store if args.store.endswith('.npy') else args.store + '.npy'
+    store_path = os.path.abspath(store_path)
+    store = np.lib.format.open_memmap(store_path, mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+
+    # Copy token indices chunk by chunk
+    utt_idx = 0
+    for chunk in tqdm(pd.read_csv(args.tsv, encoding='utf-8', delimiter='\t', usecols=['token_id'],
+                                  chunksize=args.chunk_size, dtype={'token_id': str}, keep_default_na=False)):
+        ids = np.array(' '.join(chunk['token_id'].values).split(), dtype=np.int64)
+        begin, end = offsets[utt_idx], offsets[utt_idx + len(chunk)]
+        if len(ids) != end - begin:
+            raise ValueError('Length mismatch between token_id and ylen (%d != %d) in lines %d-%d' %
+                             (len(ids), end - begin, utt_idx + 2, utt_idx + len(chunk) + 1))
+        store[begin:end] = ids
+        utt_idx += len(chunk)
+    store.flush()
+    del store
+    np.save(store_path[:-len('.npy')] + '.offsets.npy', offsets)
+
+    print('%d sentences, %d tokens (%s): %s' % (len(ylens), offsets[-1], np.dtype(dtype).name, store_path))
+
+
+if __name__ == '__main__':
+    main()
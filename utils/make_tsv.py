@@ -14,6 +14,7 @@ import argparse
 import codecs
 from distutils.util import strtobool
 import kaldi_io
+import numpy as np
 import os
 import re
 import sentencepiece as spm
@@ -178,7 +179,10 @@ def main():
         ylen = len(token_ids)
 
         if xdim is None:
-            if args.feat:
+            if args.feat and '.npy:' in feat_path:
+                # feature store made by make_feat_store.py
+                xdim = np.load(feat_path.split(':')[0], mmap_mode='r').shape[-1]
+            elif args.feat:
                 xdim = kaldi_io.read_mat(feat_path).shape[-1]
             else:
                 xdim = 0